@@ -0,0 +1,288 @@
+# Annual maximum daily flows, as a fallback series for stations with long
+# daily records but too few annual instantaneous peaks.  The maxima of
+# every station and year are computed in one vectorized pass over the
+# daily flow archive and saved next to it, so a lookup is a slice:
+#
+#   python annual_maxima.py [--calendar-year]
+import os
+import sys
+import time
+import argparse
+import threading
+
+import numpy as np
+import pandas as pd
+
+from get_station_data import get_daily_archive, get_annual_inst_peaks
+
+# WSC water years run October to September and are named by the year
+# they end in; 1 gives calendar years
+WATER_YEAR_START_MONTH = 10
+
+# fraction of the days of a year that need a flow for its maximum to count
+MIN_COMPLETENESS = 0.9
+
+# stations with fewer instantaneous peaks fall back to the daily maxima
+MIN_INST_PEAKS = 2
+
+# stations per block when scanning the archive
+STATION_CHUNK_SIZE = 500
+
+MAXIMA_COLUMNS = ['STATION_NUMBER', 'YEAR', 'PEAK', 'MONTH', 'DAY', 'SYMBOL',
+                  'N_DAYS', 'N_FLAGGED', 'COMPLETENESS']
+
+# loaded tables by (archive path, year start month)
+ANNUAL_MAXIMA = {}
+_MAXIMA_LOCK = threading.Lock()
+_BUILD_LOCK = threading.Lock()
+# background builds (see start_prepare_annual_maxima) by year start month
+PREPARE_THREADS = {}
+_PREPARE_LOCK = threading.Lock()
+
+
+def year_labels(dates, year_start_month=WATER_YEAR_START_MONTH):
+    """
+    Year of each date, for years starting on the first of
+    year_start_month and named by the calendar year they end in.
+    """
+    months = dates.astype('datetime64[M]').astype(np.int64)
+    return (months + (13 - year_start_month) % 12) // 12 + 1970
+
+
+def year_lengths(years, year_start_month=WATER_YEAR_START_MONTH):
+    # number of days in each (water) year
+    shift = (13 - year_start_month) % 12
+    start = ((years - 1970) * 12 - shift).astype('datetime64[M]').astype('datetime64[D]')
+    stop = ((years - 1969) * 12 - shift).astype('datetime64[M]').astype('datetime64[D]')
+    return (stop - start).astype(np.int64)
+
+
+def annual_maxima_arrays(groups, dates, flows, flags, year_start_month=WATER_YEAR_START_MONTH):
+    """
+    Annual maximum of daily flows for records sorted by (group, date),
+    e.g. the daily series of several stations laid end to end.  Days
+    without a flow (NaN) are skipped.  The flag of the maximum day is
+    carried to the annual value, and the number of days with a flow and
+    with any flag are counted for the completeness rules.
+    :param groups: integer group (station) codes, non-decreasing
+    :param dates: datetime64[D] dates, increasing within each group
+    :param flows: daily flows
+    :param flags: flag of each day (symbols, or archive codes)
+    :return: dict of arrays with one entry per (group, year) with at least
+        one flow: GROUP, YEAR, PEAK, DATE, FLAG, N_DAYS, N_FLAGGED and
+        COMPLETENESS (N_DAYS over the length of the year)
+    """
+    groups = np.asarray(groups)
+    flows = np.asarray(flows, dtype=float)
+    flags = np.asarray(flags)
+    years = year_labels(np.asarray(dates, dtype='datetime64[D]'), year_start_month)
+
+    valid = ~np.isnan(flows)
+    groups, years, dates, flows, flags = (a[valid] for a in
+                                          (groups, years, np.asarray(dates), flows, flags))
+    if len(flows) == 0:
+        empty = np.array([], dtype=np.int64)
+        return {'GROUP': empty, 'YEAR': empty, 'PEAK': np.array([]),
+                'DATE': np.array([], dtype='datetime64[D]'), 'FLAG': flags[:0],
+                'N_DAYS': empty, 'N_FLAGGED': empty, 'COMPLETENESS': np.array([])}
+
+    new_year = np.r_[True, (groups[1:] != groups[:-1]) | (years[1:] != years[:-1])]
+    starts = np.flatnonzero(new_year)
+    year_id = np.cumsum(new_year) - 1
+    n_days = np.diff(np.r_[starts, len(flows)])
+
+    peak = np.maximum.reduceat(flows, starts)
+    # first day of each year on which the maximum occurs
+    at_max = np.flatnonzero(flows == peak[year_id])
+    first = at_max[np.r_[True, year_id[at_max][1:] != year_id[at_max][:-1]]]
+
+    if flags.dtype == object:
+        flagged = ~pd.isnull(flags) & (flags != ' ')
+    else:
+        flagged = flags != 0
+    year = years[starts]
+    return {'GROUP': groups[starts], 'YEAR': year, 'PEAK': peak,
+            'DATE': dates[first], 'FLAG': flags[first], 'N_DAYS': n_days,
+            'N_FLAGGED': np.add.reduceat(flagged.astype(np.int64), starts),
+            'COMPLETENESS': n_days / year_lengths(year, year_start_month)}
+
+
+def archive_annual_maxima(archive, year_start_month=WATER_YEAR_START_MONTH,
+                          chunk_size=STATION_CHUNK_SIZE):
+    """
+    Annual maxima of every station in the daily flow archive, reading
+    one contiguous block of stations at a time.
+    :return: DataFrame of MAXIMA_COLUMNS, sorted by station and year
+    """
+    frames = []
+    n_stations = len(archive.stations)
+    for i in range(0, n_stations, chunk_size):
+        j = min(i + chunk_size, n_stations)
+        start, stop = archive.offsets[i], archive.offsets[j]
+        n_days = np.diff(archive.offsets[i:j + 1])
+        groups = np.repeat(np.arange(i, j), n_days)
+        # position of each day on the shared date axis
+        day = np.arange(start, stop) + np.repeat(archive.first_day[i:j] - archive.offsets[i:j],
+                                                 n_days)
+        result = annual_maxima_arrays(groups, archive.dates[day], archive.flows[start:stop],
+                                      archive.flags[start:stop], year_start_month)
+        date = pd.DatetimeIndex(result['DATE'].astype('datetime64[ns]'))
+        frames.append(pd.DataFrame({
+            'STATION_NUMBER': archive.stations[result['GROUP']],
+            'YEAR': result['YEAR'], 'PEAK': result['PEAK'],
+            'MONTH': date.month, 'DAY': date.day,
+            'SYMBOL': archive.symbols(result['FLAG']),
+            'N_DAYS': result['N_DAYS'], 'N_FLAGGED': result['N_FLAGGED'],
+            'COMPLETENESS': result['COMPLETENESS']}))
+    if not frames:
+        return pd.DataFrame(columns=MAXIMA_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def annual_maxima_path(archive, year_start_month=WATER_YEAR_START_MONTH):
+    return os.path.join(archive.path, 'annual_max_m{:02d}.pkl'.format(year_start_month))
+
+
+def build_annual_maxima(archive, year_start_month=WATER_YEAR_START_MONTH):
+    """
+    Compute the annual maxima of all stations and save them in the
+    archive directory (removed with the archive when it goes stale).
+    :return: DataFrame of MAXIMA_COLUMNS
+    """
+    time0 = time.time()
+    df = archive_annual_maxima(archive, year_start_month)
+    path = annual_maxima_path(archive, year_start_month)
+    tmp = path + '.tmp{}'.format(os.getpid())
+    df.to_pickle(tmp)
+    os.replace(tmp, path)
+    print('Built annual maxima of daily flows for {} stations ({} years) in {:.1f} s'.format(
+        df['STATION_NUMBER'].nunique(), len(df), time.time() - time0))
+    return df
+
+
+def load_annual_maxima(archive, year_start_month=WATER_YEAR_START_MONTH, build=True):
+    """
+    The saved annual maxima table, built on first use (unless build is
+    False) and then held in memory, with the row range of each station.
+    :return: (DataFrame, dict of (start, stop) by station number), or
+        None if the table has not been built and build is False
+    """
+    key = (archive.path, year_start_month)
+    with _MAXIMA_LOCK:
+        if key in ANNUAL_MAXIMA:
+            return ANNUAL_MAXIMA[key]
+    path = annual_maxima_path(archive, year_start_month)
+    if not os.path.exists(path) and not build:
+        return None
+    with _BUILD_LOCK:
+        # another thread may have built it while this one waited
+        if os.path.exists(path):
+            df = pd.read_pickle(path)
+        else:
+            df = build_annual_maxima(archive, year_start_month)
+    stations, starts = np.unique(df['STATION_NUMBER'].values.astype(str), return_index=True)
+    bounds = np.append(starts, len(df))
+    index = {s: (bounds[i], bounds[i + 1]) for i, s in enumerate(stations)}
+    with _MAXIMA_LOCK:
+        ANNUAL_MAXIMA[key] = (df, index)
+    return df, index
+
+
+def prepare_annual_maxima(year_start_month=WATER_YEAR_START_MONTH):
+    """
+    Build the daily flow archive and annual maxima table if they are
+    missing.  This reads all of DLY_FLOWS: run it in a worker, not in a
+    document callback (post_install.py builds both ahead of time).
+    """
+    load_annual_maxima(get_daily_archive(), year_start_month)
+
+
+def _prepare_in_background(year_start_month):
+    try:
+        prepare_annual_maxima(year_start_month)
+    except Exception as e:
+        print('Error preparing the annual maxima of daily flows:')
+        print(e)
+        # let a later request try again
+        with _PREPARE_LOCK:
+            PREPARE_THREADS.pop(year_start_month, None)
+
+
+def start_prepare_annual_maxima(year_start_month=WATER_YEAR_START_MONTH):
+    """
+    Run prepare_annual_maxima in a daemon thread, at most once per process:
+    calls while a build is running (or after it finished) do nothing.
+    :return: True if this call started the build
+    """
+    with _PREPARE_LOCK:
+        if year_start_month in PREPARE_THREADS:
+            return False
+        thread = threading.Thread(target=_prepare_in_background, args=(year_start_month,),
+                                  name='prepare_annual_maxima', daemon=True)
+        PREPARE_THREADS[year_start_month] = thread
+    thread.start()
+    return True
+
+
+def annual_maxima_ready(year_start_month=WATER_YEAR_START_MONTH):
+    """
+    True if the annual maxima can be looked up without a build.
+    """
+    archive = get_daily_archive(build=False)
+    return archive is not None and \
+        ((archive.path, year_start_month) in ANNUAL_MAXIMA or
+         os.path.exists(annual_maxima_path(archive, year_start_month)))
+
+
+def get_annual_daily_maxima(station, year_start_month=WATER_YEAR_START_MONTH,
+                            min_completeness=MIN_COMPLETENESS, build=False):
+    """
+    Annual maximum daily flows of one station, for the years with at
+    least min_completeness of their days recorded, in the layout of
+    get_annual_inst_peaks (YEAR, MONTH, DAY, PEAK, SYMBOL).  Unless build
+    is True, nothing is built: if the archive or the table is missing the
+    result is empty (see annual_maxima_ready and prepare_annual_maxima).
+    :return: DataFrame (empty if the station has no daily flows)
+    """
+    archive = get_daily_archive(build=build)
+    loaded = load_annual_maxima(archive, year_start_month, build) if archive is not None else None
+    if loaded is None:
+        return pd.DataFrame(columns=MAXIMA_COLUMNS)
+    df, index = loaded
+    start, stop = index.get(station, (0, 0))
+    rows = df.iloc[start:stop]
+    return rows[rows['COMPLETENESS'] >= min_completeness].reset_index(drop=True)
+
+
+def get_station_series(station, year_start_month=WATER_YEAR_START_MONTH,
+                       min_completeness=MIN_COMPLETENESS, build=False):
+    """
+    The annual series a station's FFA uses, in the app and in batch runs:
+    the annual instantaneous peaks, or the annual maximum daily flows if
+    there are fewer than MIN_INST_PEAKS peaks and at least as many daily
+    maxima (see get_annual_daily_maxima for build).
+    :return: (DataFrame, 'instantaneous' or 'daily_max')
+    """
+    df = get_annual_inst_peaks(station)
+    if len(df) >= MIN_INST_PEAKS:
+        return df, 'instantaneous'
+    daily_max = get_annual_daily_maxima(station, year_start_month, min_completeness, build)
+    if len(daily_max) >= MIN_INST_PEAKS:
+        return daily_max, 'daily_max'
+    return df, 'instantaneous'
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Annual maximum daily flows of all stations.')
+    parser.add_argument('--calendar-year', action='store_true',
+                        help='use calendar years instead of water years')
+    parser.add_argument('--output', help='also write the table to this CSV file')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    maxima = build_annual_maxima(get_daily_archive(), 1 if args.calendar_year
+                                 else WATER_YEAR_START_MONTH)
+    if args.output:
+        maxima.to_csv(args.output, index=False)
@@ -0,0 +1,232 @@
+# Headless flood frequency analysis over all (or a filtered set of) WSC
+# stations in the HYDAT database.  Results are appended to a CSV file one
+# station at a time, so an interrupted run can be resumed with --resume
+# (which also retries the stations that failed).  Stations with too few
+# instantaneous peaks use their annual maximum daily flows, as in the app.
+# After a HYDAT update, --changed-since reruns only the stations whose
+# data changed and keeps the other rows:
+#
+#   python batch_ffa.py results.csv --prefix 08M --min-years 20 --processes 8
+#   python batch_ffa.py results.csv --prefix 08M --changed-since hydat_db/Hydat_20200101.sqlite3
+import os
+import csv
+import sys
+import time
+import zlib
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from ffa import design_flood_summary, DESIGN_RETURN_PERIODS
+from get_station_data import get_hydat_version, get_peaks_cache, find_newest_db_file
+from annual_maxima import get_station_series, prepare_annual_maxima
+from hydat_diff import changed_stations
+from stations import STATIONS_DF
+
+
+def station_seed(seed, station):
+    """
+    Seed for one station, derived from the master seed and the station
+    number, so a station's result does not depend on which other stations
+    are in the run or the order they are processed in.
+    """
+    return np.random.SeedSequence([seed, zlib.crc32(station.encode())])
+
+
+def select_stations(stations_df, prefix=None, province=None, min_record_length=None,
+                    min_area=None, max_area=None):
+    """
+    Filter the station table by station number prefix (e.g. '08' or '08M'),
+    province, record length (years, from the station list) and gross
+    drainage area (km2).
+    :return: list of station numbers
+    """
+    df = stations_df
+    if prefix:
+        df = df[df['Station Number'].str.startswith(prefix)]
+    if province:
+        df = df[df['Province'] == province]
+    if min_record_length is not None:
+        df = df[df['record_length'] >= min_record_length]
+    if min_area is not None:
+        df = df[df['Gross Drainage Area (km2)'] >= min_area]
+    if max_area is not None:
+        df = df[df['Gross Drainage Area (km2)'] <= max_area]
+    return df['Station Number'].tolist()
+
+
+def result_fields(return_periods=DESIGN_RETURN_PERIODS):
+    fields = ['station', 'hydat_version', 'status', 'series', 'n_years', 'sample_size',
+              'n_simulations', 'log_mean', 'log_std', 'log_skew']
+    for tr in return_periods:
+        fields += ['Q{}'.format(tr), 'Q{}_sim_mean'.format(tr),
+                   'Q{}_2_sigma_width'.format(tr), 'Q{}_95_pct_width'.format(tr)]
+    return fields
+
+
+def station_statuses(output):
+    """
+    Status of each station in the output file.
+    """
+    if not os.path.exists(output):
+        return {}
+    with open(output, newline='') as f:
+        return {row['station']: row['status'] for row in csv.DictReader(f)}
+
+
+def completed_stations(output):
+    """
+    Stations already in the output file without an error (the
+    checkpoint for --resume).
+    """
+    return {s for s, status in station_statuses(output).items()
+            if not status.startswith('error')}
+
+
+def output_fields(output):
+    # header of an existing output file (rows appended to it must match)
+    with open(output, newline='') as f:
+        return next(csv.reader(f))
+
+
+def drop_stations(output, stations):
+    """
+    Remove the rows of the given stations from the output file
+    (rewritten under a temporary name and renamed into place).
+    :return: number of rows removed
+    """
+    if not os.path.exists(output):
+        return 0
+    tmp = output + '.tmp{}'.format(os.getpid())
+    n_dropped = 0
+    with open(output, newline='') as f, open(tmp, 'w', newline='') as out:
+        reader = csv.DictReader(f)
+        writer = csv.DictWriter(out, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for row in reader:
+            if row['station'] in stations:
+                n_dropped += 1
+            else:
+                writer.writerow(row)
+    os.replace(tmp, output)
+    return n_dropped
+
+
+def process_station(args):
+    # one pool task: (station, sample_size, n_simulations, seed, min_years)
+    station, sample_size, n_simulations, seed, min_years = args
+    row = {'station': station, 'hydat_version': get_hydat_version()}
+    try:
+        df, row['series'] = get_station_series(station)
+        peaks = df['PEAK'].dropna().values
+        peaks = peaks[peaks > 0]
+        if len(peaks) < max(min_years, 3):
+            row.update({'status': 'insufficient_data', 'n_years': len(peaks)})
+            return row
+        row.update(design_flood_summary(peaks, sample_size, n_simulations,
+                                        seed=station_seed(seed, station)))
+        row['status'] = 'ok'
+    except Exception as e:
+        row['status'] = 'error: {}'.format(e)
+    return row
+
+
+def run_batch(stations, output, sample_size=10, n_simulations=1000, seed=0,
+              min_years=10, processes=None, resume=False, changed=None):
+    """
+    Run the FFA for each station across a process pool and append one
+    row per station to the output CSV as results arrive.
+    :param changed: stations whose data changed since the output was
+        written (see hydat_diff.changed_stations); their rows are dropped
+        and rerun, the others are kept as done (implies resume)
+    """
+    fields = result_fields()
+    if changed is not None:
+        resume = True
+        print('Dropped {} rows of changed stations'.format(drop_stations(output, set(changed))))
+    if resume:
+        failed = {s for s, status in station_statuses(output).items()
+                  if status.startswith('error')}
+        if failed:
+            print('Retrying {} stations that failed'.format(drop_stations(output, failed)))
+    done = completed_stations(output) if resume else set()
+    todo = [s for s in stations if s not in done]
+    print('{} stations selected, {} already done, {} to run'.format(
+        len(stations), len(stations) - len(todo), len(todo)))
+
+    # build the shared peak flow cache and daily maxima once, before the
+    # workers fork
+    get_peaks_cache()
+    prepare_annual_maxima()
+
+    mode = 'a' if resume and os.path.exists(output) else 'w'
+    if mode == 'a':
+        fields = output_fields(output)
+    tasks = [(s, sample_size, n_simulations, seed, min_years) for s in todo]
+    time0 = time.time()
+    with open(output, mode, newline='') as f, Pool(processes) as pool:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        if mode == 'w':
+            writer.writeheader()
+        for i, row in enumerate(pool.imap_unordered(process_station, tasks, chunksize=4)):
+            writer.writerow(row)
+            # flush each row so the file is a valid checkpoint at all times
+            f.flush()
+            if (i + 1) % 100 == 0:
+                print('{} / {} stations in {:.0f} s'.format(i + 1, len(todo), time.time() - time0))
+    print('Finished {} stations in {:.0f} s'.format(len(todo), time.time() - time0))
+
+
+def to_parquet(output):
+    """
+    Convert the results CSV to Parquet next to it (requires pyarrow).
+    """
+    import pandas as pd
+    parquet_file = os.path.splitext(output)[0] + '.parquet'
+    pd.read_csv(output, dtype={'station': str, 'hydat_version': str}).to_parquet(parquet_file)
+    print('Wrote {}'.format(parquet_file))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Batch flood frequency analysis over HYDAT stations.')
+    parser.add_argument('output', help='results CSV file')
+    parser.add_argument('--prefix', help='station number prefix, e.g. 08 or 08M')
+    parser.add_argument('--province', help='province code, e.g. BC')
+    parser.add_argument('--min-record-length', type=int,
+                        help='minimum record length (years) in the station list')
+    parser.add_argument('--min-area', type=float, help='minimum gross drainage area (km2)')
+    parser.add_argument('--max-area', type=float, help='maximum gross drainage area (km2)')
+    parser.add_argument('--min-years', type=int, default=10,
+                        help='minimum number of annual peaks to run the FFA')
+    parser.add_argument('--sample-size', type=int, default=10)
+    parser.add_argument('--n-simulations', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip stations already in the output file')
+    parser.add_argument('--changed-since', metavar='OLD_DB',
+                        help='HYDAT file the output was computed with: rerun only the '
+                             'stations that changed since, keep the other rows')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write the results as Parquet when finished')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stations = select_stations(STATIONS_DF, prefix=args.prefix, province=args.province,
+                               min_record_length=args.min_record_length,
+                               min_area=args.min_area, max_area=args.max_area)
+    run_batch(stations, args.output, sample_size=args.sample_size,
+              n_simulations=args.n_simulations, seed=args.seed,
+              min_years=args.min_years, processes=args.processes, resume=args.resume,
+              changed=changed_stations(args.changed_since, find_newest_db_file())
+              if args.changed_since else None)
+    if args.parquet:
+        to_parquet(args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,80 @@
+# Compare the vectorized DLY_FLOWS reshape in get_station_data against
+# the previous melt-based implementation, for one or more stations in
+# the installed HYDAT database.
+#
+#   python benchmarks/bench_dly_flows.py 08MH016 08GA010
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from get_station_data import get_connection_pool, select_dly_flows_by_station_ID
+from stations import IDS_AND_DAS
+
+
+def select_dly_flows_melt(conn, station):
+    """
+    The melt-based implementation this benchmark is measured against
+    (with the id_vars restricted to the columns that survive the drop).
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM DLY_FLOWS WHERE STATION_NUMBER=?", (station,))
+    rows = cur.fetchall()
+    column_headers = [description[0] for description in cur.description]
+
+    df = pd.DataFrame(rows, columns=column_headers)
+    df.drop(['MONTHLY_MEAN', 'MONTHLY_TOTAL', 'FIRST_DAY_MIN',
+             'MIN', 'FIRST_DAY_MAX', 'MAX'], axis=1, inplace=True)
+    id_var_headers = [c for c in column_headers[:11] if c in df.columns]
+
+    all_val_vars = [e for e in column_headers if 'FLOW' in e]
+    flag_val_vars = [e for e in all_val_vars if 'FLOW_SYMBOL' in e]
+    flow_val_vars = [e for e in all_val_vars if '_' not in e]
+
+    df_flows = pd.melt(df, id_vars=id_var_headers, value_vars=flow_val_vars,
+                       value_name='DAILY_FLOW', var_name='DAY').sort_values(by=['YEAR', 'MONTH'])
+    df_flows['DAY'] = df_flows['DAY'].str.extract(r'(\d+)', expand=False)
+    df_flags = pd.melt(df, id_vars=id_var_headers, value_vars=flag_val_vars,
+                       value_name='FLAG', var_name='DAY').sort_values(by=['YEAR', 'MONTH'])
+    df_flows['FLAG'] = df_flags['FLAG']
+    df_flows = df_flows[df_flows['DAY'].astype(
+        int) <= df_flows['NO_DAYS'].astype(int)].dropna(subset=['DAILY_FLOW'])
+
+    dates = df_flows['YEAR'].astype(
+        str) + '-' + df_flows['MONTH'].astype(str) + '-' + df_flows['DAY'].astype(str)
+    df_flows['DATE'] = pd.to_datetime(dates, format='%Y-%m-%d')
+
+    out = pd.DataFrame()
+    out['DATE'] = df_flows['DATE']
+    if IDS_AND_DAS[station] > 0:
+        out['DAILY_UR_{}'.format(station)] = df_flows['DAILY_FLOW'] / IDS_AND_DAS[station] * 1000
+    out['FLAG_{}'.format(station)] = df_flows['FLAG']
+    out.set_index('DATE', inplace=True)
+    return out
+
+
+def best_of(func, conn, station, repeat):
+    times = []
+    for _ in range(repeat):
+        time0 = time.perf_counter()
+        result = func(conn, station)
+        times.append(time.perf_counter() - time0)
+    return min(times), result
+
+
+def main(stations, repeat=5):
+    pool = get_connection_pool()
+    for station in stations:
+        with pool.connection() as conn:
+            t_melt, expected = best_of(select_dly_flows_melt, conn, station, repeat)
+            t_new, result = best_of(select_dly_flows_by_station_ID, conn, station, repeat)
+        pd.testing.assert_frame_equal(result, expected, check_index_type=False)
+        print('{}: {} days, melt {:.1f} ms, vectorized {:.1f} ms, speedup x{:.1f}'.format(
+            station, len(result), 1000 * t_melt, 1000 * t_new, t_melt / t_new))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or ['08MH016'])
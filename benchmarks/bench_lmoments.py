@@ -0,0 +1,61 @@
+# Compare the product moment LP3 fit with the L-moment estimators on
+# batches of subsamples: throughput (fits per second) and the bias and
+# spread of the 100-year estimate, for samples drawn from a known LP3
+# parent, at the sample sizes the app simulates.
+#
+#   python benchmarks/bench_lmoments.py --n-simulations 20000 --skew 0.5
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import scipy.stats as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frequency_factors import z_from_Tr
+from simulation import ESTIMATORS, estimate_quantiles, get_rng
+
+SAMPLE_SIZES = (10, 20, 30, 50)
+
+
+def parent_sample(rng, shape, log_mean, log_std, log_skew):
+    return np.power(10, st.pearson3.rvs(log_skew, loc=log_mean, scale=log_std,
+                                        size=shape, random_state=rng))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-simulations', type=int, default=20000)
+    parser.add_argument('--log-mean', type=float, default=2.)
+    parser.add_argument('--log-std', type=float, default=0.25)
+    parser.add_argument('--skew', type=float, default=0.3)
+    parser.add_argument('--return-period', type=float, default=100.)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    z = z_from_Tr(np.array([args.return_period]))
+    true_q = np.power(10, st.pearson3.ppf(1 - 1 / args.return_period, args.skew,
+                                          loc=args.log_mean, scale=args.log_std))
+    print('LP3 parent: log mean {}, log std {}, skew {}; true Q{:g} = {:.1f}'.format(
+        args.log_mean, args.log_std, args.skew, args.return_period, true_q))
+    print('{:>4} {:>14} {:>12} {:>9} {:>9} {:>9}'.format(
+        'N', 'estimator', 'fits/s', 'bias %', 'std %', 'rmse %'))
+
+    rng = get_rng(args.seed)
+    for n in SAMPLE_SIZES:
+        samples = parent_sample(rng, (args.n_simulations, n),
+                                args.log_mean, args.log_std, args.skew)
+        for estimator in ESTIMATORS:
+            time0 = time.perf_counter()
+            q = estimate_quantiles(samples, z, estimator)[:, 0]
+            elapsed = time.perf_counter() - time0
+            err = (q[np.isfinite(q)] - true_q) / true_q * 100
+            print('{:>4} {:>14} {:>12,.0f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                n, estimator, args.n_simulations / elapsed, err.mean(), err.std(),
+                np.sqrt(np.mean(err**2))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Time the station catalogue load at app startup: parsing the CSV and
+# building the lookup tables (the previous import-time behaviour) versus
+# loading the pickled snapshot.  Each measurement runs in a fresh
+# interpreter; numpy/pandas are imported before the timer starts.
+#
+#   python benchmarks/bench_startup.py
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETUP = """
+import sys, time
+sys.path.insert(0, {!r})
+import numpy, pandas
+time0 = time.perf_counter()
+""".format(BASE_DIR)
+
+CASES = {
+    'csv parse + tables (before)': """
+import stations
+stations.build_catalogue(stations.STATIONS_CSV)
+""",
+    'import stations (lazy, untouched)': """
+import stations
+""",
+    'snapshot load, app tables (after)': """
+import stations
+stations.IDS_TO_NAMES, stations.NAMES_TO_IDS, stations.STATION_NAMES
+""",
+    'snapshot load, all tables (after)': """
+import stations
+[getattr(stations, t) for t in stations.CATALOGUE_TABLES]
+""",
+}
+
+
+def run(code, repeat):
+    times = []
+    for _ in range(repeat):
+        out = subprocess.check_output(
+            [sys.executable, '-c', SETUP + code + "print(time.perf_counter() - time0)"])
+        times.append(float(out.decode().strip().splitlines()[-1]))
+    return min(times)
+
+
+def main(repeat=5):
+    # make sure the snapshot exists and is current
+    run(CASES['snapshot load, all tables (after)'], 1)
+    for label, code in CASES.items():
+        print('{:<40} {:7.1f} ms'.format(label, 1000 * run(code, repeat)))
+
+
+if __name__ == '__main__':
+    main()
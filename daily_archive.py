@@ -0,0 +1,179 @@
+import os
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from peaks_cache import CACHE_DIR, make_build_dir, install_build_dir, remove_stale_dirs
+
+DLY_FLOWS_TABLE = 'DLY_FLOWS'
+
+# stations per DLY_FLOWS query while building the archive
+STATION_CHUNK_SIZE = 200
+
+# flag code of a day without a symbol (or without a flow)
+NO_FLAG = 0
+
+
+def daily_archive_dir(version, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, 'daily_{}'.format(version))
+
+
+def station_spans(conn):
+    """
+    First and last month (as months since 1970-01) of every station
+    in DLY_FLOWS, sorted by station number.
+    """
+    return conn.execute(
+        "SELECT STATION_NUMBER, MIN((YEAR - 1970) * 12 + MONTH - 1), "
+        "MAX((YEAR - 1970) * 12 + MONTH - 1) FROM {} GROUP BY STATION_NUMBER "
+        "ORDER BY STATION_NUMBER".format(DLY_FLOWS_TABLE)).fetchall()
+
+
+def build_daily_archive(conn, version, cache_dir=CACHE_DIR, chunk_size=STATION_CHUNK_SIZE):
+    """
+    Extract the DLY_FLOWS table for all stations into one float32 flow
+    array and one uint8 flag code array, each station a contiguous run
+    of every day from the start of its first month to the end of its
+    last (NaN / NO_FLAG where there is no flow), plus a per-station
+    offset index into a shared date axis.  The arrays are written in
+    place with np.lib.format.open_memmap, so memory use is bounded to
+    one chunk of stations.  The directory is written under a temporary
+    name and renamed into place.
+    :param conn: sqlite3 Connection to the HYDAT database
+    :param version: HYDAT version string the archive is keyed on
+    :return: path of the archive directory
+    """
+    # imported here: get_station_data imports this module
+    from get_station_data import iter_dly_flows_rows, reshape_dly_flows
+
+    time0 = time.time()
+    spans = station_spans(conn)
+    stations = np.array([s for s, _, _ in spans], dtype=str)
+    month_start = np.array([m for _, m, _ in spans], dtype=np.int64)
+    month_end = np.array([m for _, _, m in spans], dtype=np.int64) + 1
+    day_start = month_start.astype('datetime64[M]').astype('datetime64[D]')
+    day_end = month_end.astype('datetime64[M]').astype('datetime64[D]')
+    n_days = (day_end - day_start).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(n_days)]).astype(np.int64)
+
+    axis_start = day_start.min() if len(spans) else np.datetime64('1970-01-01')
+    axis_end = day_end.max() if len(spans) else axis_start
+    first_day = (day_start - axis_start).astype(np.int64)
+
+    out_dir = daily_archive_dir(version, cache_dir)
+    tmp_dir = make_build_dir(out_dir)
+    np.save(os.path.join(tmp_dir, 'stations.npy'), stations)
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp_dir, 'first_day.npy'), first_day)
+    np.save(os.path.join(tmp_dir, 'dates.npy'), np.arange(axis_start, axis_end))
+
+    flows = np.lib.format.open_memmap(os.path.join(tmp_dir, 'flows.npy'), mode='w+',
+                                      dtype=np.float32, shape=(offsets[-1],))
+    flags = np.lib.format.open_memmap(os.path.join(tmp_dir, 'flags.npy'), mode='w+',
+                                      dtype=np.uint8, shape=(offsets[-1],))
+    flows[:] = np.nan
+    flags[:] = NO_FLAG
+
+    # symbol -> code, in order of first appearance
+    flag_codes = {None: NO_FLAG}
+    position = {s: i for i, s in enumerate(stations)}
+    for station, rows in iter_dly_flows_rows(conn, stations.tolist(), chunk_size):
+        i = position[station]
+        dates, values, symbols = reshape_dly_flows(rows)
+        idx = offsets[i] + (dates - day_start[i]).astype(np.int64)
+        flows[idx] = values
+        codes, uniques = pd.factorize(symbols)
+        for symbol in uniques:
+            if symbol not in flag_codes:
+                if len(flag_codes) > np.iinfo(np.uint8).max:
+                    raise ValueError('More than 255 distinct flow symbols.')
+                flag_codes[symbol] = len(flag_codes)
+        lookup = np.array([flag_codes[s] for s in uniques] + [NO_FLAG], dtype=np.uint8)
+        # factorize codes None as -1, the last entry of lookup
+        flags[idx] = lookup[codes]
+    flows.flush()
+    flags.flush()
+    del flows, flags
+
+    meta = {'version': version, 'table': DLY_FLOWS_TABLE, 'n_days': int(offsets[-1]),
+            'flag_codes': [s for s, _ in sorted(flag_codes.items(), key=lambda kv: kv[1])]}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    install_build_dir(tmp_dir, out_dir)
+    print('Built daily flow archive for {} stations ({} days) in {:.1f} s'.format(
+        len(stations), offsets[-1], time.time() - time0))
+    return out_dir
+
+
+class DailyArchive:
+    """
+    Read-only, memory-mapped view of an archive written by
+    build_daily_archive.  Pickles as its path, so process pool workers
+    reopen the same memory-mapped pages instead of copying arrays.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.version = self.meta['version']
+        # code -> symbol (None for NO_FLAG)
+        self.flag_codes = np.array(self.meta['flag_codes'], dtype=object)
+
+        self.stations = np.load(os.path.join(path, 'stations.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.first_day = np.load(os.path.join(path, 'first_day.npy'))
+        self.index = {s: i for i, s in enumerate(self.stations)}
+
+        self.dates = np.load(os.path.join(path, 'dates.npy'), mmap_mode='r')
+        self.flows = np.load(os.path.join(path, 'flows.npy'), mmap_mode='r')
+        self.flags = np.load(os.path.join(path, 'flags.npy'), mmap_mode='r')
+
+    def __reduce__(self):
+        return self.__class__, (self.path,)
+
+    def __contains__(self, station):
+        return station in self.index
+
+    def get(self, station):
+        """
+        Zero-copy views of one station's daily record: every day from the
+        start of its first month to the end of its last, with NaN flows
+        (and NO_FLAG) on days without data.
+        :return: (dates as datetime64[D], float32 flows, uint8 flag codes),
+            or None if the station has no daily flows
+        """
+        i = self.index.get(station)
+        if i is None:
+            return None
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        first = self.first_day[i]
+        return (self.dates[first:first + stop - start], self.flows[start:stop],
+                self.flags[start:stop])
+
+    def symbols(self, codes):
+        """
+        Flow symbols (e.g. 'B', 'E', or None) of an array of flag codes.
+        """
+        return self.flag_codes[codes]
+
+
+def open_daily_archive(version, cache_dir=CACHE_DIR):
+    """
+    Open the archive for the given HYDAT version, or return None
+    if it has not been built.
+    """
+    path = daily_archive_dir(version, cache_dir)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    return DailyArchive(path)
+
+
+def remove_stale_archives(version, cache_dir=CACHE_DIR):
+    """
+    Delete daily flow archives built from other HYDAT versions.
+    """
+    remove_stale_dirs(daily_archive_dir(version, cache_dir), 'daily_', cache_dir)
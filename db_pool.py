@@ -0,0 +1,128 @@
+import sqlite3
+import threading
+import time
+import queue
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+# read-only tuning applied to every pooled connection
+MMAP_SIZE = 1024 * 1024 * 1024     # bytes of the db file to memory-map
+CACHE_SIZE_KB = 64 * 1024          # page cache per connection
+
+
+def open_read_only(db_filename, mmap_size=MMAP_SIZE, cache_size_kb=CACHE_SIZE_KB):
+    """
+    Open the HYDAT database read-only.  immutable=1 tells sqlite the file
+    will not change underneath it, so no locks or change checks are made.
+    New HYDAT releases are installed under a new filename, never in place.
+    """
+    uri = 'file:{}?mode=ro&immutable=1'.format(pathname2url(db_filename))
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute('PRAGMA mmap_size={:d}'.format(mmap_size))
+    conn.execute('PRAGMA cache_size={:d}'.format(-cache_size_kb))
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA query_only=1')
+    return conn
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of read-only sqlite connections to one database file,
+    shared by all sessions of the bokeh server process.  Connections are
+    created on demand up to max_size; beyond that callers wait for one to
+    be returned.
+    """
+
+    def __init__(self, db_filename, max_size=8, timeout=30, **connect_kwargs):
+        self.db_filename = db_filename
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._n_open = 0
+        self._closed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.acquire_time = 0.
+        self.hold_time = 0.
+
+    def _acquire(self):
+        time0 = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+            kind = 'hits'
+        except queue.Empty:
+            with self._lock:
+                create = self._n_open < self.max_size
+                if create:
+                    self._n_open += 1
+            if create:
+                try:
+                    conn = open_read_only(self.db_filename, **self.connect_kwargs)
+                except sqlite3.Error:
+                    with self._lock:
+                        self._n_open -= 1
+                    raise
+                kind = 'misses'
+            else:
+                conn = self._idle.get(timeout=self.timeout)
+                kind = 'waits'
+        with self._lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+            self.acquire_time += time.perf_counter() - time0
+        return conn
+
+    def _release(self, conn):
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._n_open -= 1
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block:
+            with pool.connection() as conn:
+                ...
+        """
+        conn = self._acquire()
+        time0 = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self.hold_time += time.perf_counter() - time0
+            self._release(conn)
+
+    def stats(self):
+        with self._lock:
+            n = self.hits + self.misses + self.waits
+            return {'db_filename': self.db_filename,
+                    'open': self._n_open,
+                    'idle': self._idle.qsize(),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'waits': self.waits,
+                    'hit_rate': self.hits / n if n else 0.,
+                    'mean_acquire_ms': 1000 * self.acquire_time / n if n else 0.,
+                    'mean_hold_ms': 1000 * self.hold_time / n if n else 0.}
+
+    def close(self):
+        """
+        Close idle connections; connections still in use are closed
+        when they are returned.
+        """
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._n_open -= 1
@@ -0,0 +1,136 @@
+# Offline build of the nationwide design flood table: full-record LP3
+# quantiles at the standard return periods, with the log-moments and
+# record length, for every station in a HYDAT version.  Run after
+# installing a new HYDAT file:
+#
+#   python design_flood_index.py
+import os
+import sys
+import time
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from ffa import DESIGN_RETURN_PERIODS
+from frequency_factors import z_from_Tr
+from simulation import lp3_quantiles, moments_from_power_sums
+from peaks_cache import CACHE_DIR
+
+INDEX_PATH = os.path.join(CACHE_DIR, 'design_floods.sqlite3')
+INDEX_TABLE = 'DESIGN_FLOODS'
+
+MIN_YEARS = 3
+
+
+def quantile_columns(return_periods=DESIGN_RETURN_PERIODS):
+    return ['Q{}'.format(tr) for tr in return_periods]
+
+
+def grouped_log_moments(peaks_cache, data_type='Q', peak_code='H'):
+    """
+    Log-moments of the annual peaks of every station in one pass over
+    the peak flow cache, using per-station weighted counts (np.bincount)
+    over the station-sorted arrays (see simulation.moments_from_power_sums).
+    :return: DataFrame indexed by station number
+    """
+    station_ids, row_station, keep = peaks_cache.row_stations(data_type, peak_code)
+    peak = np.asarray(peaks_cache.arrays['PEAK'], dtype=float)
+    keep &= np.isfinite(peak) & (peak > 0)
+    row_station = row_station[keep]
+    logs = np.log10(peak[keep])
+
+    n_stations = len(station_ids)
+    n = np.bincount(row_station, minlength=n_stations).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.bincount(row_station, logs, n_stations) / n
+    dev = logs - shift[row_station]
+    mean, stdev, skew = moments_from_power_sums(
+        n, *(np.bincount(row_station, dev**p, n_stations) for p in (1, 2, 3)), shift=shift)
+
+    df = pd.DataFrame({'N_YEARS': n.astype(int), 'LOG_MEAN': mean,
+                       'LOG_STD': stdev, 'LOG_SKEW': skew},
+                      index=pd.Index(station_ids, name='STATION_NUMBER'))
+    return df[df['N_YEARS'] >= MIN_YEARS]
+
+
+def build_design_flood_index(peaks_cache, version, path=INDEX_PATH,
+                             return_periods=DESIGN_RETURN_PERIODS):
+    """
+    Compute the design flood table for all stations and store it in a
+    sqlite table keyed by (STATION_NUMBER, HYDAT_VERSION), replacing any
+    rows previously built for this version.
+    :return: the table as a DataFrame
+    """
+    time0 = time.time()
+    df = grouped_log_moments(peaks_cache)
+    z = z_from_Tr(np.asarray(return_periods, dtype=float))
+    q = lp3_quantiles(z, df['LOG_MEAN'].values, df['LOG_STD'].values, df['LOG_SKEW'].values)
+    for j, col in enumerate(quantile_columns(return_periods)):
+        df[col] = q[:, j]
+    df.insert(0, 'HYDAT_VERSION', version)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cols = ['STATION_NUMBER'] + list(df.columns)
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS {} (STATION_NUMBER TEXT, HYDAT_VERSION TEXT, "
+                "N_YEARS INTEGER, LOG_MEAN REAL, LOG_STD REAL, LOG_SKEW REAL, {}, "
+                "PRIMARY KEY (STATION_NUMBER, HYDAT_VERSION)) WITHOUT ROWID".format(
+                    INDEX_TABLE, ', '.join('{} REAL'.format(c)
+                                           for c in quantile_columns(return_periods))))
+            conn.execute("DELETE FROM {} WHERE HYDAT_VERSION=?".format(INDEX_TABLE), (version,))
+            conn.executemany(
+                "INSERT INTO {} ({}) VALUES ({})".format(
+                    INDEX_TABLE, ', '.join(cols), ', '.join('?' * len(cols))),
+                df.reset_index()[cols].itertuples(index=False, name=None))
+    finally:
+        conn.close()
+    LOADED_INDEXES.pop(version, None)
+    print('Built design flood index for {} stations (HYDAT {}) in {:.1f} s'.format(
+        len(df), version, time.time() - time0))
+    return df
+
+
+# design flood tables by version (None for a version that is not in the
+# index, so a miss does not query the file again)
+LOADED_INDEXES = {}
+
+
+def load_design_flood_index(version, path=INDEX_PATH):
+    """
+    The design flood table for one HYDAT version, indexed by station
+    number, or None if it has not been built.  Loaded (or found missing)
+    once per process; build_design_flood_index updates the entry.
+    """
+    if version not in LOADED_INDEXES:
+        df = None
+        if os.path.exists(path):
+            conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+            try:
+                df = pd.read_sql_query(
+                    "SELECT * FROM {} WHERE HYDAT_VERSION=?".format(INDEX_TABLE),
+                    conn, params=(version,), index_col='STATION_NUMBER')
+            finally:
+                conn.close()
+        LOADED_INDEXES[version] = df if df is not None and len(df) else None
+    return LOADED_INDEXES[version]
+
+
+def get_design_floods(station, version, path=INDEX_PATH):
+    """
+    Design flood quantiles and log-moments for one station,
+    as a dict, or None if the station is not in the index.
+    """
+    df = load_design_flood_index(version, path)
+    if df is None or station not in df.index:
+        return None
+    return df.loc[station].to_dict()
+
+
+if __name__ == '__main__':
+    from get_station_data import get_peaks_cache, get_hydat_version
+    build_design_flood_index(get_peaks_cache(), get_hydat_version(),
+                             path=sys.argv[1] if len(sys.argv) > 1 else INDEX_PATH)
@@ -0,0 +1,202 @@
+import os
+import time
+import signal
+import warnings
+import threading
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import scipy.stats as st
+
+from data.cdf_file import cdfs
+from result_cache import ResultCache
+from peaks_cache import CACHE_DIR
+
+# log-Pearson III is fitted as a Pearson III to log10 of the peaks
+LOG_DISTRIBUTIONS = {'lp3': 'pearson3'}
+
+FFA_DISTRIBUTIONS = ['genextreme', 'gumbel_r', 'lp3', 'lognorm', 'genpareto', 'pearson3']
+
+# circular distributions have periodic densities, so their likelihood
+# is meaningless for flows
+CIRCULAR_DISTRIBUTIONS = ('vonmises', 'wrapcauchy')
+
+# default candidates: the usual flood frequency distributions
+CANDIDATES = list(FFA_DISTRIBUTIONS)
+
+# the full sweep (pass candidates=ALL_CANDIDATES): the flood frequency
+# candidates first, then the rest of cdf_file.py.  With loc and scale free,
+# bounded-support fits that pin an endpoint often win on AIC alone.
+ALL_CANDIDATES = FFA_DISTRIBUTIONS + [name for name in cdfs if name not in FFA_DISTRIBUTIONS
+                                      and name not in CIRCULAR_DISTRIBUTIONS]
+
+# fits whose Kolmogorov-Smirnov test rejects them at this level are not ranked
+GOF_ALPHA = 0.05
+
+# seconds allowed for each distribution fit
+FIT_TIMEOUT = 10
+
+RANK_CRITERIA = ('aic', 'ks_stat', 'ad_stat')
+
+# fitted parameters per (station, data version), kept on disk
+FIT_CACHE = ResultCache(max_entries=1024, disk_dir=os.path.join(CACHE_DIR, 'fits'))
+
+
+class FitTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise FitTimeout()
+
+
+def scipy_distribution(name):
+    """
+    :return: (scipy distribution, True if it applies to log10 flows)
+    """
+    return getattr(st, LOG_DISTRIBUTIONS.get(name, name)), name in LOG_DISTRIBUTIONS
+
+
+def frozen_distribution(name, params):
+    dist, is_log = scipy_distribution(name)
+    return dist(*params), is_log
+
+
+def cdf(name, params, x):
+    dist, is_log = frozen_distribution(name, params)
+    x = np.asarray(x, dtype=float)
+    return dist.cdf(np.log10(x) if is_log else x)
+
+
+def fit_quantiles(name, params, tr):
+    """
+    Flow quantiles of a fitted distribution at return periods tr
+    (NaN for Tr <= 1, as in frequency_factors.z_from_Tr).
+    """
+    dist, is_log = frozen_distribution(name, params)
+    tr = np.asarray(tr, dtype=float)
+    q = np.full(tr.shape, np.nan)
+    valid = tr > 1
+    q[valid] = dist.ppf(1 - 1 / tr[valid])
+    return np.power(10, q) if is_log else q
+
+
+def anderson_darling(u):
+    """
+    Anderson-Darling statistic of the fitted cdf values u of a sample.
+    """
+    u = np.clip(np.sort(u), 1e-12, 1 - 1e-12)
+    n = len(u)
+    i = np.arange(1, n + 1)
+    return -n - np.sum((2 * i - 1) * (np.log(u) + np.log1p(-u[::-1]))) / n
+
+
+def fit_distribution(name, peaks, timeout=FIT_TIMEOUT):
+    """
+    Maximum likelihood fit of one candidate distribution to the annual
+    peaks, with its goodness-of-fit statistics.  The timeout uses SIGALRM,
+    so it only applies in the main thread of a process (e.g. in a pool
+    worker) on platforms that have it.
+    :return: dict (one row of the ranking table)
+    """
+    peaks = np.asarray(peaks, dtype=float)
+    row = {'distribution': name, 'status': 'ok'}
+    use_alarm = timeout and hasattr(signal, 'SIGALRM') and \
+        threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    time0 = time.time()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            dist, is_log = scipy_distribution(name)
+            x = np.log10(peaks) if is_log else peaks
+            params = dist.fit(x)
+            log_pdf = dist.logpdf(x, *params)
+            if is_log:
+                # change of variables back to flow units
+                log_pdf = log_pdf - np.log(peaks * np.log(10))
+            log_likelihood = np.sum(log_pdf)
+            u = dist.cdf(x, *params)
+            ks = st.kstest(u, 'uniform')
+        if not np.isfinite(log_likelihood):
+            raise ValueError('non-finite likelihood')
+        row.update({'params': tuple(float(p) for p in params),
+                    'n_params': len(params),
+                    'log_likelihood': log_likelihood,
+                    'aic': 2 * len(params) - 2 * log_likelihood,
+                    'ks_stat': ks.statistic,
+                    'ks_pvalue': ks.pvalue,
+                    'ad_stat': anderson_darling(u)})
+    except FitTimeout:
+        row['status'] = 'timeout'
+    except Exception as e:
+        row['status'] = 'error: {}'.format(e)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    row['fit_time'] = time.time() - time0
+    return row
+
+
+def _fit_task(args):
+    return fit_distribution(*args)
+
+
+def fit_distributions(peaks, candidates=CANDIDATES, timeout=FIT_TIMEOUT,
+                      processes=None, rank_by='aic', gof_alpha=GOF_ALPHA):
+    """
+    Fit every candidate distribution to the annual peaks (across a process
+    pool unless processes == 1) and rank the successful fits that pass the
+    Kolmogorov-Smirnov test at gof_alpha (None ranks every successful fit).
+    :param rank_by: one of RANK_CRITERIA (lower is better)
+    :return: DataFrame sorted by rank; failed and rejected fits are last
+        with a NaN rank
+    """
+    if rank_by not in RANK_CRITERIA:
+        raise ValueError('rank_by must be one of {}'.format(RANK_CRITERIA))
+    peaks = np.asarray(peaks, dtype=float)
+    tasks = [(name, peaks, timeout) for name in candidates]
+    if processes == 1:
+        rows = list(map(_fit_task, tasks))
+    else:
+        with Pool(processes) as pool:
+            rows = pool.map(_fit_task, tasks, chunksize=1)
+
+    fits = pd.DataFrame(rows)
+    for col in RANK_CRITERIA + ('ks_pvalue',):
+        if col not in fits:
+            fits[col] = np.nan
+    ok = fits['status'] == 'ok'
+    if gof_alpha is not None:
+        ok &= fits['ks_pvalue'] >= gof_alpha
+    fits['rank'] = fits[rank_by].where(ok).rank(method='first')
+    return fits.sort_values(['rank', 'distribution'], na_position='last').reset_index(drop=True)
+
+
+def get_station_fits(station, peaks, version, candidates=CANDIDATES, timeout=FIT_TIMEOUT,
+                     processes=None, rank_by='aic', gof_alpha=GOF_ALPHA):
+    """
+    fit_distributions for one station, cached by station, version,
+    candidate list, ranking criterion and test level.  Pass the station's data version
+    (hydat_diff.station_data_version) to reuse fits across HYDAT releases
+    that did not change the station.
+    """
+    key = (station, version, tuple(candidates), rank_by, gof_alpha)
+    return FIT_CACHE.get_or_compute(
+        key, lambda: fit_distributions(peaks, candidates, timeout, processes, rank_by,
+                                       gof_alpha))
+
+
+def top_fit_quantiles(fits, tr, k=3):
+    """
+    Quantile curves of the k best ranked fits (failed and rejected fits
+    have no rank).
+    :return: list of (distribution name, quantiles at tr)
+    """
+    best = fits[fits['rank'].notna()].head(k)
+    return [(row['distribution'], fit_quantiles(row['distribution'], row['params'], tr))
+            for _, row in best.iterrows()]
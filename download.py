@@ -1,38 +1,57 @@
-# Function for downloading the latest database version from WSC
-
-
+# Download (or update) the HYDAT sqlite database and its documentation
+# from Environment Canada, without prompts:
+#
+#   python download.py                  # install or update the database and docs
+#   python download.py --no-docs        # skip the documentation pdfs
+#   python download.py --url http://localhost:8000/   # e.g. a local mirror
+#
+# The zip is downloaded to a .part file that is resumed with HTTP range
+# requests after a dropped connection, checked against the advertised size
+# (and a sha256 checksum if given), and the sqlite member is streamed out
+# to a temporary file that is renamed into place only once it is complete.
 import os
-import requests
 import re
-import wget
+import sys
+import time
+import shutil
+import sqlite3
+import hashlib
 import zipfile
+import argparse
+
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+from post_install import build_indexes, post_install
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_DIR = os.path.join(BASE_DIR, 'hydat_db')
 
-# first, check if a database folder already exists
+HYDAT_URL = 'https://collaboration.cmc.ec.gc.ca/cmc/hydrometrics/www/'
 
-def check_for_db_directory():
-    """
-    Check if the a database directory named /hydat_db exists.
-    If not, create the db and 
-    """
+# bytes per read/write when downloading and extracting
+CHUNK_SIZE = 1024 * 1024
+
+# connection attempts before giving up (each one resumes the download)
+MAX_RETRIES = 5
+
+REQUEST_TIMEOUT = 60
 
-    db_directory = BASE_DIR + '/hydat_db'
-    directories = [d[0] for d in os.walk(BASE_DIR) if d[0] == db_directory]
 
-    if len(directories) != 0:
-        # directory exists, check for the database file
-        # and check the version against the newest file
+def check_for_db_directory(db_dir=DB_DIR):
+    """
+    Check if the database directory exists, and create it if not.
+    :return: True if it already existed
+    """
+    if os.path.isdir(db_dir):
         print('DB directory exists, check version.')
         return True
-    else:
-        # directory doesn't exist, create it
-        print('Creating directory {}'.format(db_directory))
-        os.mkdir(db_directory)
-        return False
-    
+    print('Creating directory {}'.format(db_dir))
+    os.makedirs(db_dir)
+    return False
 
-def get_filenames(url):
+
+def get_filenames(url, session=None):
     """
     The location where the hydat database has the sqlite database
     file itself, as well as supporting documentation.
@@ -44,21 +63,23 @@ def get_filenames(url):
         -the first is a list of the pdf filenames
         -the second is the database filename.
     """
-
-    s = requests.get(url).text
+    session = session or requests.Session()
+    response = session.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    s = response.text
 
     all_hrefs = [s.start() for s in re.finditer('a href=', s)]
-    
+
     pdf_files = []
     db_filename = None
     for l in all_hrefs:
 
         # skip past the positions corresponding to 'a href='
         start = l + 8
-        
+
         # get the non-DB readme files
         file_prefix = s[start:start + 10]
-        
+
         if file_prefix in ['ECDataExpl', 'HYDAT_Defi', 'HYDAT_Rele']:
             end = s[start:].find('.pdf') + len('.pdf')
 
@@ -71,138 +92,271 @@ def get_filenames(url):
             db_filename = s[start: start + end]
 
     if db_filename == None:
-        raise AssertionError('No database file was found.  Check https://collaboration.cmc.ec.gc.ca/cmc/hydrometrics/www/ to see if the page is up, and if a .zip file corresponding to the sqlite Hydat database file exists')
+        raise AssertionError('No database file was found.  Check {} to see if the page is up, and if a .zip file corresponding to the sqlite Hydat database file exists'.format(url))
     return pdf_files, db_filename
 
 
-def download_and_extract_db_file(dbf, url):
+def file_version(filename):
     """
-    Input the filename extracted from Environment Canada website.
-    Write and unzip the file in the db folder,
+    The HYDAT version (release date) in a zip or sqlite3 filename,
+    e.g. '20240117' for Hydat_sqlite3_20240117.zip or Hydat_20240117.sqlite3.
+    :return: version string, or None for an unversioned name
     """
-    db_dir = BASE_DIR + '/hydat_db'
+    match = re.search(r'_(\d{8})\.(zip|sqlite3)$', filename)
+    return match.group(1) if match else None
+
+
+def installed_versions(db_dir=DB_DIR):
+    """
+    :return: sorted list of the versions of the sqlite files in db_dir
+    """
+    if not os.path.isdir(db_dir):
+        return []
+    return sorted(v for v in (file_version(f) for f in os.listdir(db_dir)
+                              if f.endswith('.sqlite3')) if v)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _total_size(response, offset):
+    # the full file size from a 206 Content-Range or a 200 Content-Length
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range and not content_range.endswith('*'):
+        return int(content_range.rsplit('/', 1)[1])
+    length = response.headers.get('Content-Length')
+    if length is None:
+        return None
+    return int(length) + (offset if response.status_code == 206 else 0)
 
-    file_version =  dbf.split('_')[-1].split('.')[0]
-    txt = input("Download and extract the database file? \nNote: the file is roughly 280MB.  Please respond [y/n]")
-    if txt == 'y':
-        print('Downloading and saving documentation files to {}'.format(BASE_DIR + '/hydat_db'))
+
+def download_file(url, dest, session=None, max_retries=MAX_RETRIES, sha256=None):
+    """
+    Download url to dest, resuming a partial download in dest + '.part'
+    with HTTP range requests (also after a dropped connection).  A server
+    that ignores the range header restarts the file from the beginning.
+    The completed file is checked against the size the server reported and
+    the sha256 checksum if given, then renamed to dest.
+    :return: dest
+    """
+    session = session or requests.Session()
+    part = dest + '.part'
+    total = None
+    for attempt in range(1, max_retries + 1):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        # identity encoding: range offsets count the bytes as stored
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
         try:
-            print('Downloading file.')
-            wget.download(url + '/' + dbf, db_dir)
-            print('')
-            print('Download complete.  Extracting...')
-            z = zipfile.ZipFile(db_dir + '/' + dbf, 'r')
-            for i, f in enumerate(z.filelist):
-                f.filename = 'Hydat_{}.sqlite3'.format(file_version)
-                
-                z.extract(f, db_dir)
-            print('File extracted.')
-            return True
-        except Exception as e:
-            print('Error downloading and extracting the database file.')
-            print(e)
-            return False
-    elif txt == 'n':
-        print('Download cancelled.')
-        return False
+            with session.get(url, headers=headers, stream=True,
+                             timeout=REQUEST_TIMEOUT) as response:
+                if response.status_code == 416:
+                    # nothing left to fetch: the part file is already complete
+                    break
+                response.raise_for_status()
+                if response.status_code != 206:
+                    offset = 0
+                total = _total_size(response, offset) or total
+                mode = 'ab' if offset else 'wb'
+                print('Downloading {} ({} of {} bytes already on disk)'.format(
+                    url, offset, total if total is not None else 'unknown'))
+                # read1 (urllib3 >= 2.2) returns the bytes received so far, so
+                # a dropped transfer keeps them instead of losing a whole block
+                read = response.raw.read1
+                with open(part, mode) as f:
+                    for block in iter(lambda: read(CHUNK_SIZE, decode_content=False), b''):
+                        f.write(block)
+            if total is None or os.path.getsize(part) >= total:
+                break
+            print('Transfer ended early, resuming.')
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                ProtocolError, ReadTimeoutError) as e:
+            print('Download interrupted ({}), attempt {} of {}.'.format(e, attempt, max_retries))
+            time.sleep(min(2 ** attempt, 30))
     else:
-        print('Please type y for yes or n for no.')
-        download_and_extract_db_file(dbf, url)
-    
+        raise IOError('Download of {} did not complete after {} attempts.'.format(
+            url, max_retries))
+
+    size = os.path.getsize(part)
+    if total is not None and size != total:
+        raise IOError('Downloaded {} bytes of {}, expected {}.'.format(size, url, total))
+    if sha256 is not None:
+        digest = file_sha256(part)
+        if digest != sha256.lower():
+            os.remove(part)
+            raise IOError('Checksum mismatch for {}: {} != {}.'.format(url, digest, sha256))
+    os.replace(part, dest)
+    return dest
 
-def download_and_save_info_docs(files, url):
+
+def check_sqlite_file(path):
     """
-    Input the filenames extracted from Environment Canada website.
-    Write the pdf files to the db folder.
+    Check that path is a readable sqlite database with the HYDAT tables.
     """
-    txt = input("Download and extract the documentation?  Please respond [y/n]")
-    if txt == 'y':
-        print('Downloading and saving documentation files to {}'.format(BASE_DIR + '/hydat_db'))
+    conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    finally:
+        conn.close()
+    missing = {'ANNUAL_INSTANT_PEAKS', 'DLY_FLOWS'} - tables
+    if missing:
+        raise IOError('{} is missing the tables {}.'.format(path, sorted(missing)))
+
+
+def extract_db_file(zip_path, db_dir, version, prepare=None):
+    """
+    Stream the sqlite member of the HYDAT zip to a temporary file in db_dir
+    (memory use is bounded by CHUNK_SIZE; the member's CRC is verified as it
+    is read), check it opens, run prepare(path) on it (e.g. to build
+    indexes) and atomically rename it to Hydat_<version>.sqlite3.  The app
+    picks the newest file by name, so running servers only ever see a
+    complete database.
+    :return: path of the installed database
+    """
+    target = os.path.join(db_dir, 'Hydat_{}.sqlite3'.format(version))
+    # not named *.sqlite3, so find_newest_db_file never picks it up
+    tmp = os.path.join(db_dir, '.Hydat_{}.partial'.format(version))
+    with zipfile.ZipFile(zip_path) as z:
+        members = [m for m in z.infolist() if m.filename.endswith('.sqlite3')]
+        if not members:
+            raise IOError('No .sqlite3 file in {}.'.format(zip_path))
+        print('Extracting {} ({:.0f} MB)...'.format(members[0].filename,
+                                                   members[0].file_size / 1e6))
         try:
-            [wget.download(url + '/' + f, BASE_DIR + '/hydat_db') for f in files]
-        except Exception as e:
-            print('Error downloading documentation files.')
-            print(e)
-    elif txt == 'n':
-        print('Download cancelled.')
-    else:
-        print('Please type y for yes or n for no.')
-        download_and_save_info_docs(files, url) 
+            with z.open(members[0]) as src, open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            check_sqlite_file(tmp)
+            if prepare is not None:
+                prepare(tmp)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    os.replace(tmp, target)
+    print('Installed {}'.format(target))
+    return target
 
 
-def check_for_updated_zip_file(url, hydat_file, existing_file, db_fname):
+def download_and_extract_db_file(dbf, url, db_dir=DB_DIR, session=None, sha256=None,
+                                 keep_zip=False, derived=True):
     """
-    A zipped db file exists.  Check the date against the latest version.
-    Download and extract if newer version is available.
+    Download the HYDAT zip dbf from url, verify it and install the
+    sqlite database in db_dir with its indexes, then (if derived)
+    build its sidecar database (see post_install.py).
+    :return: path of the installed database
     """
+    version = file_version(dbf)
+    if version is None:
+        raise ValueError('Cannot read the HYDAT version from {}.'.format(dbf))
+    os.makedirs(db_dir, exist_ok=True)
+    zip_path = os.path.join(db_dir, dbf)
+    if not os.path.exists(zip_path):
+        download_file(url.rstrip('/') + '/' + dbf, zip_path, session=session, sha256=sha256)
+    db_path = extract_db_file(zip_path, db_dir, version, prepare=build_indexes)
+    if not keep_zip:
+        os.remove(zip_path)
+    if derived:
+        post_install(db_path, version, index=False)
+    return db_path
 
-    print('{} existing database file(s) found:'.format(len(hydat_file)))
-    for ef in hydat_file: 
-        print('    {}'.format(ef))
-    existing_file_version = existing_file.split('_')[-1].split('.')[0]
-    latest_file_version = db_fname.split('_')[-1].split('.')[0]
-    if int(existing_file_version) < int(latest_file_version):
-        print('Your database file version is dated {}.'.format(existing_file_version))
-        print('A newer version is available, dated {}.'.format(latest_file_version))
-        return download_and_extract_db_file(db_fname, url)
-    else:
-        print('You have the latest file version.')
-        return True
-        
 
-def check_for_updated_sql_file(url, hydat_file, existing_file, db_fname):
+def download_and_save_info_docs(files, url, db_dir=DB_DIR, session=None):
     """
-    A sqlite3 db file exists.  Check the date against the latest version.
-    Download and extract if newer version is available.
+    Download the documentation pdfs to the db folder (skipping any
+    already there).
     """
+    os.makedirs(db_dir, exist_ok=True)
+    for f in files:
+        dest = os.path.join(db_dir, f)
+        if not os.path.exists(dest):
+            try:
+                download_file(url.rstrip('/') + '/' + f, dest, session=session)
+            except (IOError, requests.RequestException) as e:
+                print('Error downloading documentation file {}.'.format(f))
+                print(e)
 
-    print('{} existing database file(s) found:'.format(len(hydat_file)))
-    if existing_file == 'Hydat.sqlite3':
-        return download_and_extract_db_file(db_fname, url)
-    else:
-        existing_file_version = existing_file.split('.')[0].split('_')[-1]
-        latest_file_version = db_fname.split('_')[-1].split('.')[0]
-        if int(existing_file_version) < int(latest_file_version):
-            print('Your database file version is dated {}.'.format(existing_file_version))
-            print('A newer version is available, dated {}.'.format(latest_file_version))
-            return download_and_extract_db_file(db_fname, url)
-        else:
-            print('You have the latest file version.')
-            return True
-            
-
-url = 'https://collaboration.cmc.ec.gc.ca/cmc/hydrometrics/www/'
-
-pdf_filenames, db_fname = get_filenames(url)
-
-check_db_directory = check_for_db_directory()
-
-if len(pdf_filenames) < 2:
-    # download the documentation for the hydat database
-    download_and_save_info_docs(pdf_filenames, url)
-
-if check_db_directory is False:
-    # if the database directory didn't already exist, download 
-    # all the info documents and the db file and extract to the db folder
-    # otherwise check the version to see if a newer database file exists.
-    download_and_save_info_docs(pdf_filenames, url)
-    download_and_extract_db_file(db_fname, url)
-else:
-    all_files = os.listdir(BASE_DIR + '/hydat_db')
-    hydat_zip_file = sorted([e for e in all_files if 'Hydat_sqlite3_' in e])
-    hydat_sql_file = sorted([e for e in all_files if '.sqlite3' in e])
-
-    print(hydat_zip_file)
-    if len(hydat_sql_file) == 0 and len(hydat_zip_file) == 0:
-        print('Hydat database file not found.  Downloading...')
-        db_file_updated = download_and_extract_db_file(db_fname, url)
-    if len(hydat_sql_file) != 0:
-        latest_file = hydat_sql_file[-1]
-        db_file_updated = check_for_updated_sql_file(url, hydat_sql_file, latest_file, db_fname)
-    if len(hydat_zip_file) != 0 and len(hydat_sql_file) == 0:
-        # don't download the zip if there was already an up-to-date sqlite3 file.
-        latest_file = hydat_zip_file[-1]
-        db_file_updated = check_for_updated_zip_file(url, hydat_zip_file, latest_file, db_fname)
-    if db_file_updated == True:
+
+def remove_old_db_files(db_dir, keep_version):
+    """
+    Delete installed databases older than keep_version.  Servers that
+    still have an old file open keep reading it until they reconnect.
+    """
+    for f in os.listdir(db_dir):
+        version = file_version(f)
+        if f.endswith('.sqlite3') and version and version < keep_version:
+            print('Removing {}'.format(f))
+            os.remove(os.path.join(db_dir, f))
+
+
+def update_hydat(url=HYDAT_URL, db_dir=DB_DIR, force=False, docs=True, sha256=None,
+                 keep_zip=False, prune=False, derived=True):
+    """
+    Install the latest HYDAT database if it is newer than the newest
+    installed version (or if force is set).
+    :return: path of the newly installed database, or None if up to date
+    """
+    session = requests.Session()
+    pdf_filenames, db_fname = get_filenames(url, session)
+    check_for_db_directory(db_dir)
+    if docs:
+        download_and_save_info_docs(pdf_filenames, url, db_dir, session)
+
+    latest_version = file_version(db_fname)
+    installed = installed_versions(db_dir)
+    if installed and not force and installed[-1] >= latest_version:
+        print('You have the latest file version ({}).'.format(installed[-1]))
+        return None
+    if installed:
+        print('Your database file version is dated {}.'.format(installed[-1]))
+    print('Installing version {}.'.format(latest_version))
+    db_path = download_and_extract_db_file(db_fname, url, db_dir, session, sha256, keep_zip,
+                                           derived)
+    if prune:
+        remove_old_db_files(db_dir, latest_version)
+    return db_path
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Download or update the HYDAT database.')
+    parser.add_argument('--url', default=HYDAT_URL, help='HYDAT download page')
+    parser.add_argument('--db-dir', default=DB_DIR, help='database directory')
+    parser.add_argument('--no-docs', action='store_true',
+                        help='skip downloading the documentation pdfs')
+    parser.add_argument('--force', action='store_true',
+                        help='download even if the installed version is current')
+    parser.add_argument('--sha256', help='expected sha256 checksum of the zip file')
+    parser.add_argument('--keep-zip', action='store_true', help='keep the downloaded zip file')
+    parser.add_argument('--prune', action='store_true',
+                        help='delete older database versions after installing')
+    parser.add_argument('--no-derived', action='store_true',
+                        help='skip building the derived tables (see post_install.py)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        db_path = update_hydat(args.url, args.db_dir, force=args.force, docs=not args.no_docs,
+                               sha256=args.sha256, keep_zip=args.keep_zip, prune=args.prune,
+                               derived=not args.no_derived)
+    except (IOError, AssertionError, ValueError, requests.RequestException,
+            zipfile.BadZipFile) as e:
+        print('Error downloading and extracting the database file.')
+        print(e)
+        return 1
+    if db_path is not None:
         print('DB file successfully updated.')
+    return 0
+
 
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,156 @@
+import math
+import warnings
+
+import numpy as np
+import scipy.stats as st
+
+from frequency_factors import z_from_Tr, lp3_frequency_factor
+from simulation import TR_GRID, Z_GRID, log_moments, lp3_quantiles, estimate_quantiles, \
+    simulate_lp3_parallel, simulate_lp3_streaming
+from streaming_stats import RunningMoments, QuantileSketch
+
+# return periods (years) reported for design floods
+DESIGN_RETURN_PERIODS = (2, 5, 10, 25, 50, 100, 200)
+
+
+def get_stats(data, param):
+    mean = data[param].mean()
+    var = np.var(data[param])
+    stdev = data[param].std()
+    skew = st.skew(data[param])
+    return mean, var, stdev, skew
+
+
+def calculate_Tr(data, param, correction_factor=None):
+    if correction_factor is None:
+        correction_factor = 1
+
+    data['rank'] = data[param].rank(ascending=False, method='first')
+    data.loc[:, 'logQ'] = list(map(math.log, data[param]))
+
+    data['Tr'] = (len(data) + 1) / \
+        data['rank'].astype(int).round(1)
+
+    data.sort_values(by='rank', inplace=True, ascending=False)
+
+    return data 
+
+
+def fit_full_record(df, target_param, estimator='lp3'):
+    """
+    LP3 fit (or another of simulation.ESTIMATORS) to the entire record.
+    :return: (peak data with Tr and fitted values, LP3 quantiles on TR_GRID)
+    """
+    data = calculate_Tr(df.copy(), target_param)
+    data.sort_values('Tr', ascending=False, inplace=True)
+
+    data['Mean'] = np.mean(data[target_param])
+
+    if estimator != 'lp3':
+        return fit_full_record_estimator(data, target_param, estimator)
+
+    # plot the log-pearson fit to the entire dataset
+    log_skew = st.skew(np.log10(data[target_param]))
+    z_empirical = z_from_Tr(data['Tr'].values)
+
+    lp3_model = lp3_frequency_factor(Z_GRID, log_skew)
+    lp3_empirical = lp3_frequency_factor(z_empirical, log_skew)
+
+    lp3_quantiles_model = np.power(10, np.mean(
+        np.log10(data[target_param])) + lp3_model*np.std(np.log10(data[target_param])))
+
+    lp3_quantiles_empirical = np.power(10, np.mean(
+        np.log10(data[target_param])) + lp3_empirical*np.std(np.log10(data[target_param])))
+
+    data['theoretical'] = lp3_quantiles_empirical
+
+    data['empirical_cdf'] = data['rank'] / (len(data) + 1)
+
+    # pearson_fit_params = st.pearson3.fit(np.log(data['PEAK']))
+
+    # reverse the order for proper plotting on P-P plot
+    data['theoretical_cdf'] = st.pearson3.cdf(z_empirical, skew=log_skew)[::-1]
+
+    return data, lp3_quantiles_model
+
+
+def fit_full_record_estimator(data, target_param, estimator):
+    """
+    The fitted values of fit_full_record for the L-moment estimators.
+    The P-P plot uses the exceedance probability of each peak under the
+    fit, interpolated from the quantiles on TR_GRID.
+    """
+    peaks = data[target_param].values.astype(float)
+    quantiles_model = estimate_quantiles(peaks, Z_GRID, estimator)
+    data['theoretical'] = estimate_quantiles(peaks, z_from_Tr(data['Tr'].values), estimator)
+    data['empirical_cdf'] = data['rank'] / (len(data) + 1)
+
+    valid = np.isfinite(quantiles_model)
+    order = np.argsort(quantiles_model[valid])
+    data['theoretical_cdf'] = np.interp(peaks, quantiles_model[valid][order],
+                                        1 / TR_GRID[valid][order])
+    return data, quantiles_model
+
+
+def design_flood_summary(peaks, sample_size, n_simulations, seed=None,
+                         return_periods=DESIGN_RETURN_PERIODS):
+    """
+    Design flood quantiles of the full-record LP3 fit and the spread of the
+    sampling simulation at a few return periods, as a flat dict suitable
+    for one row of a results table.
+    :param peaks: 1d array of annual peak flows
+    :param sample_size: years per simulated subsample (clamped to the
+        record length - 1, as in the app)
+    """
+    peaks = np.asarray(peaks, dtype=float)
+    z = z_from_Tr(np.asarray(return_periods, dtype=float))
+    mean, stdev, skew = log_moments(peaks)
+    full_record = lp3_quantiles(z, mean, stdev, skew)
+
+    sample_size = min(sample_size, len(peaks) - 1)
+    moments, sketch = simulate_lp3_streaming(
+        peaks, sample_size, n_simulations, z=z, seed=seed, processes=1,
+        accumulators=[RunningMoments(len(z)), QuantileSketch(len(z), seed=seed)])
+    sim_std = moments.std()
+    p_lo, p_hi = sketch.quantiles([0.025, 0.975])
+
+    row = {'n_years': len(peaks), 'sample_size': sample_size,
+           'n_simulations': n_simulations,
+           'log_mean': mean, 'log_std': stdev, 'log_skew': skew}
+    for i, tr in enumerate(return_periods):
+        row['Q{}'.format(tr)] = full_record[i]
+        row['Q{}_sim_mean'.format(tr)] = moments.mean[i]
+        row['Q{}_2_sigma_width'.format(tr)] = 4 * sim_std[i]
+        row['Q{}_95_pct_width'.format(tr)] = p_hi[i] - p_lo[i]
+    return row
+
+
+def bootstrap_ci(peaks, n_replicates=10000, resampling='bootstrap', estimator='lp3',
+                 return_periods=DESIGN_RETURN_PERIODS, confidence=0.9, seed=None,
+                 processes=1):
+    """
+    Confidence intervals of the full-record quantiles from bootstrap
+    replicates of the whole record (sample size = record length).
+    :param resampling: 'bootstrap' (with replacement) or 'parametric'
+        (drawn from the full record fit)
+    :param confidence: two-sided confidence level of the interval
+    :return: dict of arrays indexed like return_periods: the full record
+        estimate, the replicates' median and std, and the interval bounds
+    """
+    peaks = np.asarray(peaks, dtype=float)
+    z = z_from_Tr(np.asarray(return_periods, dtype=float))
+    replicates = simulate_lp3_parallel(peaks, len(peaks), n_replicates, z=z, seed=seed,
+                                       processes=processes, estimator=estimator,
+                                       resampling=resampling)
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        # all-NaN columns for return periods <= 1 year
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, median, upper = np.nanquantile(replicates, [alpha, 0.5, 1 - alpha], axis=0)
+        std = np.nanstd(replicates, axis=0, ddof=1)
+    return {'Tr': np.asarray(return_periods),
+            'estimate': estimate_quantiles(peaks, z, estimator),
+            'median': median,
+            'std': std,
+            'lower': lower,
+            'upper': upper}
@@ -0,0 +1,58 @@
+from functools import lru_cache
+
+import numpy as np
+import scipy.special
+
+
+def z_from_Tr(tr):
+    """
+    Standard normal quantile of the annual non-exceedance probability
+    1 - 1/Tr, for an array of return periods.
+    An annual maximum series has no quantile at Tr <= 1 (the probability
+    would be <= 0), so those return periods give NaN rather than a
+    warning or a value from a nudged Tr.
+    """
+    tr = np.asarray(tr, dtype=float)
+    z = np.full(tr.shape, np.nan)
+    valid = tr > 1
+    # ndtri is the inverse of the standard normal cdf (st.norm.ppf)
+    z[valid] = scipy.special.ndtri(1 - 1 / tr[valid])
+    return z if z.ndim else z[()]
+
+
+@lru_cache(maxsize=32)
+def tr_grid(start=-2, stop=3, num=500):
+    """
+    Log-spaced grid of return periods from 10**start to 10**stop years.
+    Cached by grid spec; the returned array is read-only.
+    """
+    tr = np.logspace(start, stop, num)
+    tr.flags.writeable = False
+    return tr
+
+
+@lru_cache(maxsize=32)
+def z_grid(start=-2, stop=3, num=500):
+    """
+    z_from_Tr of tr_grid(start, stop, num), computed once per grid spec.
+    The returned array is read-only.
+    """
+    z = z_from_Tr(tr_grid(start, stop, num))
+    z.flags.writeable = False
+    return z
+
+
+def lp3_frequency_factor(z, skew):
+    """
+    Wilson-Hilferty approximation of the Pearson III frequency factor
+    evaluated for every (skew, z) pair by broadcasting.
+    :param z: standard normal quantiles, shape (T,)
+    :param skew: skew coefficient(s), scalar or shape (M,)
+    :return: array of shape (M, T) (or (T,) for a scalar skew)
+    """
+    z = np.asarray(z, dtype=float)
+    g = np.asarray(skew, dtype=float)[..., np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = 2 / g * (np.power((z - g / 6) * g / 6 + 1, 3) - 1)
+    # K -> z as the skew goes to zero
+    return np.where(g == 0, z, k)
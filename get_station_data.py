@@ -10,9 +10,14 @@ from datetime import date
 import logging
 
 import sqlite3
-import scipy.spatial
+import threading
+from multiprocessing import Pool
 
-from stations import IDS_AND_DAS, STATIONS_DF
+from stations import STATION_CATALOGUE
+from peaks_cache import CACHE_DIR, build_peaks_cache, open_peaks_cache, remove_stale_caches
+from daily_archive import build_daily_archive, open_daily_archive, remove_stale_archives
+from db_pool import ConnectionPool, open_read_only
+from spatial_index import StationIndex
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # This BASE_DIR is for my personal system, where the DB
@@ -41,23 +46,62 @@ def melt_(df):
     return df.reset_index().melt(id_vars=id_vars).set_index(id_vars)
 
 
-def create_connection():
-    """ create a database connection to the SQLite database
-        specified by the db_file
-    :param db_file: database file
+def create_connection(db_filename=None):
+    """ create a read-only database connection to the SQLite database
+        specified by the db_file.  Prefer get_connection_pool().connection()
+        for repeated queries.
+    :param db_filename: database file (default: newest file in DB_DIR)
     :return: Connection object or None
     """
-    db_filename = get_newest_db_file([f for f in os.listdir(DB_DIR) if '.sqlite3' in f])
-    
-    print(db_filename)
+    if db_filename is None:
+        db_filename = find_newest_db_file()
     try:
-        conn = sqlite3.connect(db_filename)
-        return conn
+        return open_read_only(db_filename)
     except sqlite3.Error as e:
-        logging.warn('Sqlite3 connection Error: {}'.format(e))
+        logging.warning('Sqlite3 connection Error: {}'.format(e))
         print(e)
     return None
 
+
+def find_newest_db_file():
+    # skip the hidden temporary files of installs in progress
+    return get_newest_db_file([f for f in os.listdir(DB_DIR)
+                               if f.endswith('.sqlite3') and not f.startswith('.')])
+
+
+CONNECTION_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_connection_pool():
+    """
+    Return the process-wide read-only connection pool.  The newest
+    database file is resolved once, when the pool is created.
+    """
+    global CONNECTION_POOL
+    with _POOL_LOCK:
+        if CONNECTION_POOL is None:
+            CONNECTION_POOL = ConnectionPool(find_newest_db_file())
+        return CONNECTION_POOL
+
+
+def refresh_db():
+    """
+    Re-resolve the newest database file, e.g. after a HYDAT update,
+    and replace the connection pool if it has changed.
+    :return: True if a newer file was picked up
+    """
+    global CONNECTION_POOL
+    db_filename = find_newest_db_file()
+    with _POOL_LOCK:
+        if CONNECTION_POOL is not None and CONNECTION_POOL.db_filename == db_filename:
+            return False
+        old_pool, CONNECTION_POOL = CONNECTION_POOL, ConnectionPool(db_filename)
+    if old_pool is not None:
+        old_pool.close()
+    return True
+
+
 def get_newest_db_file(files):
     if len(files) == 0:
         print('No database file found.  Check the database path.')
@@ -73,25 +117,22 @@ def get_newest_db_file(files):
 
 
 def get_daily_UR(station):
-    time0 = time.time()
-    # create a database connection
-    cols = ['STATION_NUMBER', 'YEAR', 'MONTH', 'NO_DAYS']
-
-    cols += day_labels.keys()
-
-    # columns = ['YEAR', 'MONTH', 'NO_DAYS']
-
-    conn = create_connection()
+    """
+    Daily unit runoff and flags of one station (see daily_UR_frame),
+    read from the sidecar database if it has been built (post_install.py),
+    otherwise reshaped from DLY_FLOWS.
+    """
+    df = get_daily_flows(station)
+    if df is not None:
+        return daily_UR_frame_from_arrays(station, df.index.values, df['FLOW'].values,
+                                          df['SYMBOL'].values)
 
-    with conn:
+    with get_connection_pool().connection() as conn:
         return select_dly_flows_by_station_ID(conn, station)
 
-    conn.close()
-
 
 def get_data_type(label, table_name, var_name):
-    conn = create_connection()
-    with conn:
+    with get_connection_pool().connection() as conn:
         cur = conn.cursor()
         cur.execute(
             "SELECT * FROM {}".format(table_name), ())
@@ -101,20 +142,149 @@ def get_data_type(label, table_name, var_name):
 
         df = pd.DataFrame(rows, columns=column_headers)
 
-    conn.close()
-
     return df
 
 
-def get_annual_inst_peaks(station):
-    # create a database connection
-    conn = create_connection()
-    with conn:
+def get_db_version(db_filename):
+    """
+    Version (date) string of a HYDAT file, e.g. Hydat_20200115.sqlite3 -> 20200115
+    """
+    return os.path.basename(db_filename).split('.')[0].split('_')[-1]
+
+
+def get_hydat_version():
+    """
+    Version string of the HYDAT file currently served by the connection pool.
+    """
+    return get_db_version(get_connection_pool().db_filename)
+
+
+# tables of the sidecar database
+DERIVED_DAILY_FLOWS_TABLE = 'DAILY_FLOWS'
+DERIVED_PEAKS_TABLE = 'ANNUAL_PEAKS'
+
+
+def derived_db_path(version):
+    """
+    Sidecar database with the derived tables of a HYDAT version
+    (built by post_install.py).
+    """
+    return os.path.join(CACHE_DIR, 'hydat_derived_{}.sqlite3'.format(version))
+
+
+DERIVED_POOL = None
+
+
+def get_derived_pool():
+    """
+    Read-only connection pool for the sidecar database of the HYDAT
+    version in use, or None if it has not been built.
+    """
+    global DERIVED_POOL
+    path = derived_db_path(get_hydat_version())
+    with _POOL_LOCK:
+        if DERIVED_POOL is not None and DERIVED_POOL.db_filename == path:
+            return DERIVED_POOL
+        if not os.path.exists(path):
+            return None
+        old_pool, DERIVED_POOL = DERIVED_POOL, ConnectionPool(path)
+    if old_pool is not None:
+        old_pool.close()
+    return DERIVED_POOL
+
+
+def get_daily_flows(station):
+    """
+    Daily flows of one station in long format (DATE index, FLOW, SYMBOL)
+    from the sidecar database: a single range scan of its primary key.
+    :return: DataFrame, or None if the sidecar has not been built
+    """
+    pool = get_derived_pool()
+    if pool is None:
+        return None
+    with pool.connection() as conn:
+        df = pd.read_sql_query(
+            "SELECT DATE, FLOW, SYMBOL FROM {} WHERE STATION_NUMBER=? ORDER BY DATE".format(
+                DERIVED_DAILY_FLOWS_TABLE), con=conn, params=(station,), parse_dates=['DATE'])
+    return df.set_index('DATE')
+
+
+class VersionedCache:
+    """
+    One memory-mapped cache (the peak flow cache or the daily flow
+    archive) for the HYDAT file served by the connection pool, built on
+    first use, one build at a time.  A cache from an older HYDAT version
+    is replaced once refresh_db() picks up a newer database file.
+    :param open_cache: open_cache(version) returns the cache, or None if
+        it has not been built
+    :param build_cache: build_cache(conn, version) builds it
+    :param remove_stale: remove_stale(version) deletes other versions
+    """
+
+    def __init__(self, open_cache, build_cache, remove_stale):
+        self.open_cache = open_cache
+        self.build_cache = build_cache
+        self.remove_stale = remove_stale
+        self.current = None
+        self._lock = threading.Lock()
+
+    def get(self, build=True):
+        """
+        :return: the cache, or None if it has not been built and build
+            is False
+        """
+        pool = get_connection_pool()
+        version = get_db_version(pool.db_filename)
+        current = self.current
+        if current is not None and current.version == version:
+            return current
+
+        if not build:
+            # only a finished cache is ever visible under its final name,
+            # so this never waits on a build in progress
+            cache = self.open_cache(version)
+            if cache is not None:
+                self.current = cache
+            return cache
+
+        with self._lock:
+            # another thread may have built it while this one waited
+            cache = self.open_cache(version)
+            if cache is None:
+                with pool.connection() as conn:
+                    self.build_cache(conn, version)
+                self.remove_stale(version)
+                cache = self.open_cache(version)
+            self.current = cache
+        return cache
+
+
+PEAKS_CACHE = VersionedCache(open_peaks_cache, build_peaks_cache, remove_stale_caches)
+
+
+def get_peaks_cache():
+    """
+    Return the memory-mapped peak flow cache for the HYDAT file served
+    by the connection pool, building it on first use.
+    """
+    return PEAKS_CACHE.get()
+
+
+def get_annual_inst_peaks(station, use_cache=True):
+    if use_cache:
+        return get_peaks_cache().get(station)
+
+    # the sidecar copy is clustered on station, data type and peak code
+    pool = get_derived_pool()
+    if pool is not None:
+        with pool.connection() as conn:
+            return get_peak_inst_flows_by_station_ID(conn, station, DERIVED_PEAKS_TABLE)
+
+    with get_connection_pool().connection() as conn:
         return get_peak_inst_flows_by_station_ID(conn, station)
-    conn.close()
 
 
-def get_peak_inst_flows_by_station_ID(conn, station):
+def get_peak_inst_flows_by_station_ID(conn, station, table='ANNUAL_INSTANT_PEAKS'):
     """
     Query tasks by priority
     :param conn: the Connection object
@@ -126,12 +296,68 @@ def get_peak_inst_flows_by_station_ID(conn, station):
     need to figure out how to access this info.)
     """
     time0 = time.time()
-    query = "SELECT * FROM ANNUAL_INSTANT_PEAKS WHERE STATION_NUMBER=? AND DATA_TYPE=? AND PEAK_CODE=?"
+    query = "SELECT * FROM {} WHERE STATION_NUMBER=? AND DATA_TYPE=? AND PEAK_CODE=?".format(table)
     df = pd.read_sql_query(query, con=conn, params=(station, 'Q', 'H'))
 
     return df
 
 
+DAILY_ARCHIVE = VersionedCache(open_daily_archive, build_daily_archive, remove_stale_archives)
+
+
+def get_daily_archive(build=True):
+    """
+    Return the memory-mapped daily flow archive for the HYDAT file
+    served by the connection pool, building it on first use.  The build
+    reads all of DLY_FLOWS; with build=False a missing archive returns
+    None instead.
+    """
+    return DAILY_ARCHIVE.get(build)
+
+
+def get_daily_series(station):
+    """
+    Zero-copy alternative to get_daily_UR: views of the station's daily
+    record in the daily flow archive, with NaN on days without data.
+    Flows are float32 m3/s (not unit runoff) and flags are uint8 codes,
+    see DailyArchive.symbols.
+    :return: (dates, flows, flag codes) arrays, or None
+    """
+    return get_daily_archive().get(station)
+
+
+DLY_FLOW_COLUMNS = ['YEAR', 'MONTH', 'NO_DAYS'] + \
+    ['FLOW' + str(i) for i in range(1, 32)] + \
+    ['FLOW_SYMBOL' + str(i) for i in range(1, 32)]
+
+
+def reshape_dly_flows(rows):
+    """
+    Convert DLY_FLOWS rows (one row per station-month, in DLY_FLOW_COLUMNS
+    order) to a chronological daily series.  The FLOW1..31 and
+    FLOW_SYMBOL1..31 blocks are flattened row-major after sorting by
+    year and month, days beyond NO_DAYS and missing flows are masked
+    out, and dates are built as month start + (day - 1).
+    :param rows: list of tuples or 2d object array
+    :return: (dates as datetime64[D], daily flows, flags) arrays
+    """
+    block = np.asarray(rows, dtype=object).reshape(-1, len(DLY_FLOW_COLUMNS))
+    ym = block[:, :3].astype(np.int64)
+    order = np.lexsort((ym[:, 1], ym[:, 0]))
+    block, ym = block[order], ym[order]
+
+    flows = block[:, 3:34].astype(float)
+    flags = block[:, 34:65]
+    days = np.arange(1, 32)
+    valid = (days[np.newaxis, :] <= ym[:, 2:3]) & ~np.isnan(flows)
+
+    months = (ym[:, 0] - 1970) * 12 + (ym[:, 1] - 1)
+    month_start = months.astype('datetime64[M]').astype('datetime64[D]')
+    dates = month_start[:, np.newaxis] + (days - 1)
+
+    return dates[valid], flows[valid], flags[valid]
+
+
 def select_dly_flows_by_station_ID(conn, station):
     """
     Query tasks by priority
@@ -139,99 +365,133 @@ def select_dly_flows_by_station_ID(conn, station):
     :param station: station number (ID) according to WSC convention
     :return: dataframe object of daily flows
     """
-    time0 = time.time()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM DLY_FLOWS WHERE STATION_NUMBER=?", (station,))
+    cur.execute("SELECT {} FROM DLY_FLOWS WHERE STATION_NUMBER=?".format(
+        ', '.join(DLY_FLOW_COLUMNS)), (station,))
 
     rows = cur.fetchall()
+    if len(rows) == 0:
+        return None
+
+    return daily_UR_frame(station, rows)
+
+
+def daily_UR_frame(station, rows):
+    """
+    Build the DAILY_UR_<id> / FLAG_<id> frame from DLY_FLOWS rows
+    (see reshape_dly_flows), or None if there are no valid days.
+    """
+    return daily_UR_frame_from_arrays(station, *reshape_dly_flows(rows))
+
 
-    column_headers = [description[0] for description in cur.description]
-    id_var_headers = column_headers[:11]
-
-    df = pd.DataFrame(rows, columns=column_headers)
-    df.drop(['MONTHLY_MEAN', 'MONTHLY_TOTAL', 'FIRST_DAY_MIN',
-             'MIN', 'FIRST_DAY_MAX', 'MAX'], axis=1, inplace=True)
-
-    timex = time.time()
-    all_val_vars = [e for e in column_headers if 'FLOW' in e]
-    flag_val_vars = [e for e in all_val_vars if 'FLOW_SYMBOL' in e]
-    flow_val_vars = [e for e in all_val_vars if '_' not in e]
-
-    df_flows = pd.melt(df,
-                       id_vars=id_var_headers,
-                       value_vars=flow_val_vars,
-                       value_name='DAILY_FLOW',
-                       var_name='DAY').sort_values(by=['YEAR', 'MONTH'])
-
-    df_flows['DAY'] = df_flows['DAY'].apply(
-        map_day_to_var_name)
-
-    df_flags = pd.melt(df,
-                       id_vars=id_var_headers,
-                       value_vars=flag_val_vars,
-                       value_name='FLAG',
-                       var_name='DAY').sort_values(by=['YEAR', 'MONTH'])
-
-    # print('time to melt = ', time.time() - timex)
-    df_flows['FLAG'] = df_flags['FLAG']
-    # filter out day row if it's not a day that exists in given month
-    df_flows = df_flows[df_flows['DAY'].astype(
-        int) <= df_flows['NO_DAYS'].astype(int)].dropna(subset=['DAILY_FLOW'])
-
-    dates = df_flows['YEAR'].astype(
-        str) + '-' + df_flows['MONTH'].astype(str) + '-' + df_flows['DAY'].astype(str)
-    df_flows['DATE'] = pd.to_datetime(dates, format='%Y-%m-%d')
-
-    out = pd.DataFrame()
-    out['DATE'] = df_flows['DATE']
-    if IDS_AND_DAS[station] > 0:
+def daily_UR_frame_from_arrays(station, dates, flows, flags):
+    # daily_UR_frame from a daily series (dates, flows in m3/s, flags)
+    out = pd.DataFrame(index=pd.DatetimeIndex(
+        dates.astype('datetime64[ns]'), name='DATE'))
+    drainage_area = STATION_CATALOGUE.IDS_AND_DAS[station]
+    if drainage_area > 0:
         out['DAILY_UR_{}'.format(
-            station)] = df_flows['DAILY_FLOW'] / IDS_AND_DAS[station] * 1000
-    out['FLAG_{}'.format(station)] = df_flows['FLAG']
-    out.set_index('DATE', inplace=True)
+            station)] = flows / drainage_area * 1000
+    out['FLAG_{}'.format(station)] = flags
     if len(out) > 0:
         return out
     else:
         return None
 
 
-def deg2rad(degree):
-    rad = degree * 2 * np.pi / 360
-    return rad
+def _daily_UR_frame(args):
+    return args[0], daily_UR_frame(*args)
 
 
-def get_xyz_distance(lat, lon, target):
+def iter_dly_flows_rows(conn, stations, chunk_size=50):
     """
-    Converts lat/lon to x, y, z.
-    Does not account for elevation of target location.
-    Just assumes stations are at same elevation
+    Query DLY_FLOWS for many stations, chunk_size stations per query,
+    and yield (station, rows) with rows as a 2d object array in
+    DLY_FLOW_COLUMNS order.  Only one chunk is held in memory at a time.
     """
-    r = 6378137 + target.Elevation
-    x = r * np.cos(deg2rad(lat)) * np.cos(deg2rad(lon))
-    y = r * np.cos(deg2rad(lat)) * np.sin(deg2rad(lon))
-    z = r * np.sin(deg2rad(lat)) * (1 - 1 / 298.257223563)
-
-    return scipy.spatial.distance.euclidean(target.xyz_coords, [x, y, z])
+    stations = list(dict.fromkeys(stations))
+    for i in range(0, len(stations), chunk_size):
+        chunk = stations[i:i + chunk_size]
+        cur = conn.cursor()
+        cur.execute("SELECT STATION_NUMBER, {} FROM DLY_FLOWS WHERE STATION_NUMBER IN ({}) "
+                    "ORDER BY STATION_NUMBER".format(', '.join(DLY_FLOW_COLUMNS),
+                                                     ', '.join('?' * len(chunk))), chunk)
+        block = np.asarray(cur.fetchall(), dtype=object)
+        if len(block) == 0:
+            continue
+        ids, starts = np.unique(block[:, 0].astype(str), return_index=True)
+        bounds = np.append(starts, len(block))
+        for j, station in enumerate(ids):
+            yield station, block[bounds[j]:bounds[j + 1], 1:]
+
+
+def iter_daily_UR(stations, chunk_size=50, processes=1):
+    """
+    Generator of (station, frame) for each station with daily flows
+    (sorted by station number within each chunk), with the same frame as
+    get_daily_UR.  Stations with no valid days are skipped.  A pooled
+    connection is held until the generator is exhausted or closed.
+    :param chunk_size: number of stations fetched per query
+    :param processes: >1 decodes the frames in a process pool
+    """
+    with get_connection_pool().connection() as conn:
+        rows = iter_dly_flows_rows(conn, stations, chunk_size)
+        if processes == 1:
+            frames = (_daily_UR_frame(r) for r in rows)
+            for station, df in frames:
+                if df is not None:
+                    yield station, df
+        else:
+            with Pool(processes) as p:
+                for station, df in p.imap(_daily_UR_frame, rows):
+                    if df is not None:
+                        yield station, df
+
+
+def get_daily_UR_many(stations, wide=True, chunk_size=50, processes=1):
+    """
+    Daily flows for a list of stations (e.g. the output of
+    get_stations_by_distance) with one query per chunk of stations.
+    :param wide: True returns one DataFrame of all stations aligned on
+        DATE; False returns the iter_daily_UR generator, which keeps
+        memory bounded to one chunk
+    :return: DataFrame or generator of (station, frame)
+    """
+    frames = iter_daily_UR(stations, chunk_size=chunk_size, processes=processes)
+    if not wide:
+        return frames
+    frames = [df for _, df in frames]
+    if len(frames) == 0:
+        return None
+    return pd.concat(frames, axis=1).sort_index()
 
 
-def get_stations_by_distance(lat, lon, radius):
-    # input target location decimal degrees [lat, lon]
-    # (search) radius in km
-    # Returns a dataframe of stations sorted by closest to the
-    # current location
+STATION_INDEX = None
+_INDEX_LOCK = threading.Lock()
 
-    dist = [get_xyz_distance(lat, lon, station[1])
-            for station in STATIONS_DF.iterrows()]
 
-    # STATIONS_DF['distance_to_target'] = round(np.sqrt((STATIONS_DF['utm_E'] - target_loc[0])**2 +
-    #                                                   (STATIONS_DF['utm_N'] - target_loc[1])**2) / 1000, 1)
+def get_station_index():
+    """
+    KD-tree spatial index over all WSC stations, built on first use.
+    """
+    global STATION_INDEX
+    with _INDEX_LOCK:
+        if STATION_INDEX is None:
+            STATION_INDEX = StationIndex(STATION_CATALOGUE.STATIONS_DF)
+        return STATION_INDEX
 
-    STATIONS_DF['distance_to_target'] = [round(e / 1000, 1) for e in dist]
 
-    # enter the distance from the target to search for stations
-    search_radius = radius
+def get_stations_by_distance(lat, lon, radius):
+    # input target location decimal degrees [lat, lon]
+    # (search) radius in km
+    # Returns a new dataframe of stations within the radius, sorted by
+    # closest to the target location, with a distance_to_target (km) column.
+    # Pass arrays of lat/lon to get a list of dataframes, one per target.
+    return get_station_index().query_radius(lat, lon, radius)
 
-    target_stns = STATIONS_DF[STATIONS_DF['distance_to_target']
-                              <= search_radius].sort_values('distance_to_target')
 
-    return target_stns
+def get_nearest_stations(lat, lon, k=10):
+    # input target location decimal degrees [lat, lon]
+    # Returns a new dataframe of the k closest stations, sorted by distance,
+    # with a distance_to_target (km) column.
+    return get_station_index().query_nearest(lat, lon, k)
@@ -0,0 +1,255 @@
+# Per-station differences between two HYDAT versions.  Each station's
+# rows in ANNUAL_INSTANT_PEAKS and DLY_FLOWS are hashed (in key order) and
+# the hashes are kept in cache/station_hashes_<version>.json, so a diff
+# only reads a database once.  Most stations' history does not change
+# between releases; caches keyed on station_data_version() carry over for
+# those stations, and batch jobs can rerun only the changed ones:
+#
+#   python hydat_diff.py [old.sqlite3 new.sqlite3] [--output changed.txt]
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from itertools import groupby
+
+from peaks_cache import CACHE_DIR
+from get_station_data import DB_DIR, get_db_version
+
+# table: columns after STATION_NUMBER that order a station's rows
+HASHED_TABLES = {
+    'ANNUAL_INSTANT_PEAKS': ('DATA_TYPE', 'PEAK_CODE', 'YEAR'),
+    'DLY_FLOWS': ('YEAR', 'MONTH'),
+}
+
+# loaded hash files by version
+STATION_HASHES = {}
+# (cache dir, version): [(version, hashes)] of it and the older hashed
+# versions, newest first, for station_data_version
+VERSION_CHAINS = {}
+_HASH_LOCK = threading.Lock()
+
+
+def station_hashes_path(version, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, 'station_hashes_{}.json'.format(version))
+
+
+def hash_table(conn, table, order_by):
+    """
+    Hash the rows of every station in a table.  Rows are read in
+    (STATION_NUMBER, *order_by) order, which the post-install indexes
+    serve without a sort, and each value's repr is hashed, so any change
+    to a value, flag or column list changes the station's hash.
+    :return: dict of hex digest by station number
+    """
+    columns = [r[1] for r in conn.execute("PRAGMA table_info({})".format(table))]
+    columns.remove('STATION_NUMBER')
+    cur = conn.execute("SELECT STATION_NUMBER, {} FROM {} ORDER BY STATION_NUMBER, {}".format(
+        ', '.join(columns), table, ', '.join(order_by)))
+    hashes = {}
+    for station, rows in groupby(cur, key=lambda row: row[0]):
+        h = hashlib.blake2b(repr(columns).encode(), digest_size=16)
+        for row in rows:
+            h.update(repr(row[1:]).encode())
+        hashes[station] = h.hexdigest()
+    return hashes
+
+
+def build_station_hashes(db_path, version=None, cache_dir=CACHE_DIR):
+    """
+    Hash every station of HASHED_TABLES in a HYDAT file and save the
+    hashes for its version.
+    :return: dict of {station: digest} by table name
+    """
+    if version is None:
+        version = get_db_version(db_path)
+    time0 = time.time()
+    conn = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+    try:
+        hashes = {table: hash_table(conn, table, order_by)
+                  for table, order_by in HASHED_TABLES.items()}
+    finally:
+        conn.close()
+
+    path = station_hashes_path(version, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp{}'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(hashes, f)
+    os.replace(tmp, path)
+    with _HASH_LOCK:
+        STATION_HASHES[version] = hashes
+        # a new hash file can extend any chain
+        VERSION_CHAINS.clear()
+    print('Hashed {} stations (HYDAT {}) in {:.1f} s'.format(
+        len(set().union(*hashes.values())), version, time.time() - time0))
+    return hashes
+
+
+def load_station_hashes(version, cache_dir=CACHE_DIR):
+    """
+    The station hashes of a HYDAT version, or None if they have not
+    been built.  Loaded once per process.
+    """
+    with _HASH_LOCK:
+        if version in STATION_HASHES:
+            return STATION_HASHES[version]
+    path = station_hashes_path(version, cache_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        hashes = json.load(f)
+    with _HASH_LOCK:
+        STATION_HASHES[version] = hashes
+    return hashes
+
+
+def get_station_hashes(db_path, version=None, cache_dir=CACHE_DIR):
+    """
+    Saved station hashes for a HYDAT file, built if missing.
+    """
+    if version is None:
+        version = get_db_version(db_path)
+    hashes = load_station_hashes(version, cache_dir)
+    if hashes is None:
+        hashes = build_station_hashes(db_path, version, cache_dir)
+    return hashes
+
+
+def station_signature(hashes, station):
+    # one tuple over all tables (None where the station has no rows)
+    return tuple(hashes.get(table, {}).get(station) for table in sorted(HASHED_TABLES))
+
+
+def station_signatures(hashes):
+    stations = set().union(*hashes.values())
+    return {s: station_signature(hashes, s) for s in stations}
+
+
+def diff_hashes(old, new):
+    """
+    Compare the station hashes of two versions.
+    :return: dict of sorted station lists: 'changed' (in both versions,
+        different rows in any table), 'added', 'removed' and 'unchanged',
+        plus 'tables', the changed stations of each table
+    """
+    old_sig, new_sig = station_signatures(old), station_signatures(new)
+    common = old_sig.keys() & new_sig.keys()
+    tables = {}
+    for table in sorted(set(old) | set(new)):
+        old_t, new_t = old.get(table, {}), new.get(table, {})
+        tables[table] = sorted(s for s in old_t.keys() | new_t.keys()
+                               if old_t.get(s) != new_t.get(s))
+    return {'changed': sorted(s for s in common if old_sig[s] != new_sig[s]),
+            'added': sorted(new_sig.keys() - old_sig.keys()),
+            'removed': sorted(old_sig.keys() - new_sig.keys()),
+            'unchanged': sorted(s for s in common if old_sig[s] == new_sig[s]),
+            'tables': tables}
+
+
+def diff_versions(old_db, new_db, cache_dir=CACHE_DIR):
+    """
+    Per-station diff of two HYDAT files (see diff_hashes).
+    """
+    return diff_hashes(get_station_hashes(old_db, cache_dir=cache_dir),
+                       get_station_hashes(new_db, cache_dir=cache_dir))
+
+
+def changed_stations(old_db, new_db, cache_dir=CACHE_DIR):
+    """
+    Stations whose results must be recomputed when moving from old_db
+    to new_db: changed or new in new_db.
+    :return: set of station numbers
+    """
+    diff = diff_versions(old_db, new_db, cache_dir)
+    return set(diff['changed']) | set(diff['added'])
+
+
+def hashed_versions(cache_dir=CACHE_DIR):
+    """
+    :return: sorted list of the versions with saved station hashes
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    prefix, suffix = 'station_hashes_', '.json'
+    return sorted(f[len(prefix):-len(suffix)] for f in os.listdir(cache_dir)
+                  if f.startswith(prefix) and f.endswith(suffix))
+
+
+def version_chain(version, cache_dir=CACHE_DIR):
+    """
+    The hashes of version and of every older hashed version, newest
+    first (empty if version has none).  Listed and loaded once per
+    version, so per-station lookups do not touch the disk.
+    """
+    key = (cache_dir, version)
+    with _HASH_LOCK:
+        if key in VERSION_CHAINS:
+            return VERSION_CHAINS[key]
+    versions = [v for v in hashed_versions(cache_dir) if v <= version]
+    chain = []
+    if versions and versions[-1] == version:
+        chain = [(v, load_station_hashes(v, cache_dir)) for v in reversed(versions)]
+    with _HASH_LOCK:
+        VERSION_CHAINS[key] = chain
+    return chain
+
+
+def station_data_version(station, version, cache_dir=CACHE_DIR):
+    """
+    The oldest HYDAT version, going back through consecutive hashed
+    versions, in which the station's rows are the same as in version.
+    Results keyed on it are reused across releases that did not change
+    the station.  Without saved hashes this is version itself.
+    """
+    chain = version_chain(version, cache_dir)
+    if not chain:
+        return version
+    signature = station_signature(chain[0][1], station)
+    if not any(signature):
+        return version
+    data_version = version
+    for older, hashes in chain[1:]:
+        if station_signature(hashes, station) != signature:
+            break
+        data_version = older
+    return data_version
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Stations changed between two HYDAT versions.')
+    parser.add_argument('old_db', nargs='?',
+                        help='older HYDAT sqlite file (default: second newest in DB_DIR)')
+    parser.add_argument('new_db', nargs='?',
+                        help='newer HYDAT sqlite file (default: newest in DB_DIR)')
+    parser.add_argument('--output', help='write the changed and added station numbers here')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    old_db, new_db = args.old_db, args.new_db
+    if old_db is None or new_db is None:
+        files = sorted(f for f in os.listdir(DB_DIR)
+                       if f.endswith('.sqlite3') and not f.startswith('.'))
+        if len(files) < 2:
+            raise SystemExit('Need two HYDAT files in {} to compare.'.format(DB_DIR))
+        old_db, new_db = (os.path.join(DB_DIR, f) for f in files[-2:])
+
+    diff = diff_versions(old_db, new_db)
+    print('HYDAT {} -> {}: {} changed, {} added, {} removed, {} unchanged stations'.format(
+        get_db_version(old_db), get_db_version(new_db), len(diff['changed']),
+        len(diff['added']), len(diff['removed']), len(diff['unchanged'])))
+    for table, stations in diff['tables'].items():
+        print('  {}: {} stations differ'.format(table, len(stations)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(''.join(s + '\n' for s in sorted(set(diff['changed']) | set(diff['added']))))
+    return diff
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
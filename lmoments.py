@@ -0,0 +1,127 @@
+import numpy as np
+import scipy.special
+
+from frequency_factors import lp3_frequency_factor
+
+# distributions with an L-moment fit; lp3 is pe3 fitted to log10 flows
+LMOMENT_DISTRIBUTIONS = ('lp3', 'pe3', 'gev', 'glo')
+
+EULER_GAMMA = 0.5772156649015329
+
+
+def sample_lmoments(samples):
+    """
+    First four sample L-moments of each row, from the unbiased
+    probability weighted moments b0..b3 of the sorted row (Hosking, 1990).
+    :param samples: array of shape (M, N) (or (N,))
+    :return: l1, l2, t3, t4 as arrays of shape (M,) (L-location, L-scale,
+        L-skewness and L-kurtosis)
+    """
+    x = np.sort(np.asarray(samples, dtype=float), axis=-1)
+    n = x.shape[-1]
+    j = np.arange(n, dtype=float)
+    # weights C(j, r) / C(n - 1, r) for the j-th smallest value (j from 0)
+    w1 = j / (n - 1)
+    w2 = w1 * (j - 1) / (n - 2) if n > 2 else np.zeros(n)
+    w3 = w2 * (j - 2) / (n - 3) if n > 3 else np.zeros(n)
+    b0 = x.mean(axis=-1)
+    b1 = np.dot(x, w1) / n
+    b2 = np.dot(x, w2) / n
+    b3 = np.dot(x, w3) / n
+    l2 = 2 * b1 - b0
+    l3 = 6 * b2 - 6 * b1 + b0
+    l4 = 20 * b3 - 30 * b2 + 12 * b1 - b0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return b0, l2, l3 / l2, l4 / l2
+
+
+def gev_params(l1, l2, t3):
+    """
+    GEV location, scale and shape k from L-moments, using Hosking's
+    approximation for k (k > 0 is bounded above, k = 0 is Gumbel).
+    """
+    c = 2 / (3 + t3) - np.log(2) / np.log(3)
+    k = 7.8590 * c + 2.9554 * c**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g = scipy.special.gamma(1 + k)
+        alpha = np.where(k == 0, l2 / np.log(2), l2 * k / ((1 - 2**-k) * g))
+        xi = np.where(k == 0, l1 - EULER_GAMMA * alpha, l1 - alpha * (1 - g) / k)
+    return xi, alpha, k
+
+
+def glo_params(l1, l2, t3):
+    """
+    Generalized logistic location, scale and shape k from L-moments.
+    """
+    k = -t3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(k == 0, 1., k * np.pi / np.sin(k * np.pi))
+        alpha = l2 / ratio
+        xi = np.where(k == 0, l1, l1 - alpha * (1 / k - np.pi / np.sin(k * np.pi)))
+    return xi, alpha, k
+
+
+def pe3_params(l1, l2, t3):
+    """
+    Pearson III mean, standard deviation and skew from L-moments, using
+    Hosking's rational approximation of the shape from t3.
+    """
+    t = np.abs(t3)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        z = np.where(t >= 1 / 3, 1 - t, 3 * np.pi * t**2)
+        shape = np.where(
+            t >= 1 / 3,
+            (0.36067 * z - 0.59567 * z**2 + 0.25361 * z**3) /
+            (1 - 2.78861 * z + 2.56096 * z**2 - 0.77045 * z**3),
+            (1 + 0.2906 * z) / (z + 0.1882 * z**2 + 0.0442 * z**3))
+        # sqrt(shape) * gamma(shape) / gamma(shape + 1/2) -> 1 as the skew -> 0
+        ratio = np.sqrt(shape) * np.exp(scipy.special.gammaln(shape) -
+                                        scipy.special.gammaln(shape + 0.5))
+        ratio = np.where(np.isfinite(shape), ratio, 1.)
+        skew = np.where(np.isfinite(shape), 2 * np.sign(t3) / np.sqrt(shape), 0.)
+    return l1, l2 * np.sqrt(np.pi) * ratio, skew
+
+
+def quantiles_from_lmoments(l1, l2, t3, z, distribution='pe3'):
+    """
+    Quantiles of the pe3, gev or glo distribution with the given
+    L-moments at the non-exceedance probabilities of the z grid.
+    Pearson III quantiles use the same Wilson-Hilferty frequency factor
+    as the product moment fit.
+    :param l1, l2, t3: scalars or arrays of shape (M,)
+    :param z: standard normal quantiles, shape (T,)
+    :return: array of shape (M, T) (or (T,))
+    """
+    z = np.asarray(z, dtype=float)
+    if distribution == 'pe3':
+        mean, stdev, skew = pe3_params(l1, l2, t3)
+        return np.asarray(mean)[..., np.newaxis] + \
+            lp3_frequency_factor(z, skew) * np.asarray(stdev)[..., np.newaxis]
+
+    params = gev_params(l1, l2, t3) if distribution == 'gev' else glo_params(l1, l2, t3)
+    xi, alpha, k = (np.asarray(p)[..., np.newaxis] for p in params)
+    F = scipy.special.ndtr(z)
+    # reduced variate y, with x = xi + alpha * (1 - exp(-k y)) / k
+    y = -np.log(-np.log(F)) if distribution == 'gev' else np.log(F / (1 - F))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return np.where(k == 0, xi + alpha * y, xi + alpha * (1 - np.exp(-k * y)) / k)
+
+
+def lmoment_quantiles(samples, z, distribution='lp3'):
+    """
+    Fit distribution to each row of samples by L-moments and evaluate
+    the fits at the non-exceedance probabilities of the z grid
+    (lp3 is pe3 fitted to log10 of the samples).
+    :param samples: array of shape (M, N) of positive flows (or (N,))
+    :param z: standard normal quantiles, shape (T,)
+    :return: array of flow quantiles of shape (M, T) (or (T,))
+    """
+    if distribution not in LMOMENT_DISTRIBUTIONS:
+        raise ValueError('distribution must be one of {}'.format(LMOMENT_DISTRIBUTIONS))
+    samples = np.asarray(samples, dtype=float)
+    if distribution == 'lp3':
+        samples = np.log10(samples)
+    l1, l2, t3, _ = sample_lmoments(samples)
+    if distribution == 'lp3':
+        return np.power(10, quantiles_from_lmoments(l1, l2, t3, z, 'pe3'))
+    return quantiles_from_lmoments(l1, l2, t3, z, distribution)
@@ -1,5 +1,7 @@
 import os
 import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 import pandas as pd
@@ -8,194 +10,461 @@ import time
 import scipy.special
 import scipy.stats as st
 
-from multiprocessing import Pool
-
 from bokeh.layouts import row, column
 from bokeh.models import CustomJS, Slider, Band, Spinner
 from bokeh.plotting import figure, curdoc, ColumnDataSource
-from bokeh.models.widgets import AutocompleteInput, Div
-
-from get_station_data import get_daily_UR, get_annual_inst_peaks
-
-from stations import IDS_AND_DAS, STATIONS_DF, IDS_TO_NAMES, NAMES_TO_IDS
-
-def get_stats(data, param):
-    mean = data[param].mean()
-    var = np.var(data[param])
-    stdev = data[param].std()
-    skew = st.skew(data[param])
-    return mean, var, stdev, skew
-
-
-def calculate_Tr(data, param, correction_factor=None):
-    if correction_factor is None:
-        correction_factor = 1
+from bokeh.models.widgets import AutocompleteInput, Div, RadioButtonGroup, Select
 
-    data['rank'] = data[param].rank(ascending=False, method='first')
-    data.loc[:, 'logQ'] = list(map(math.log, data[param]))
+from get_station_data import get_daily_UR, get_hydat_version
+from annual_maxima import get_station_series, annual_maxima_ready, \
+    start_prepare_annual_maxima
+from result_cache import SIMULATION_CACHE
+from design_flood_index import get_design_floods, quantile_columns
+from simulation import TR_GRID, Z_GRID, RESAMPLING_METHODS, simulate_lp3_streaming
+from ffa import fit_full_record
+from distribution_fits import get_station_fits, top_fit_quantiles
+from hydat_diff import station_data_version
+from regional import regional_ffa
+from nonstationarity import station_windows
+from streaming_stats import RunningMoments, QuantileSketch
 
-    data['Tr'] = (len(data) + 1) / \
-        data['rank'].astype(int).round(1)
+from stations import IDS_TO_NAMES, NAMES_TO_IDS, STATION_NAMES, IDS_AND_COORDS
 
-    data.sort_values(by='rank', inplace=True, ascending=False)
+# number of worker processes for the sampling simulation.
+# 1 runs in the server process; None uses all available cores.
+SIMULATION_PROCESSES = 1
 
-    return data 
+# simulations per batch; partial bands are drawn after each batch
+SIMULATION_CHUNK_SIZE = 100
 
+# worker processes for the distribution fits.  1 fits in the server
+# process: the default candidates take well under a second, and forking a
+# pool from the threaded server can deadlock
+FIT_PROCESSES = 1
 
-def norm_ppf(x):
-    if x == 1.0:
-        x += 0.001
-    return st.norm.ppf(1-(1/x))
-
+FIT_COLORS = ['#d95f02', '#7570b3', '#e7298a', '#66a61e', '#e6ab02']
 
 def update_UI_text_output(n_years):
-    ffa_info.text = """Mean of {} simulations of a sample size {} \n
-    out of a total {} years of record.  \n
-    Bands indicate 1 and 2 standard deviations from the mean, respectively.""".format(
-        simulation_number_input.value, sample_size_input.value, n_years)
+    if band_type_input.active == 0:
+        band_text = "Bands indicate 1 and 2 standard deviations from the mean, respectively."
+    else:
+        band_text = "Bands indicate the 16-84 and 2.5-97.5 percentile ranges, respectively."
+    resampling = RESAMPLING_METHODS[resampling_input.active]
+    if resampling == 'subsample':
+        ffa_info.text = """Mean of {} simulations of a sample size {} \n
+        out of a total {} years of record.  \n
+        {}""".format(
+            simulation_number_input.value, sample_size_input.value, n_years, band_text)
+    else:
+        source_text = "with replacement" if resampling == 'bootstrap' else \
+            "drawn from the full record fit"
+        ffa_info.text = """Mean of {} bootstrap replicates of the full {} years of record,  \n
+        {}.  \n
+        {}""".format(simulation_number_input.value, n_years, source_text, band_text)
 
     error_info.text = ""
 
 
-def run_ffa_simulation(data, target_param, n_simulations):
+def run_ffa_simulation(data, target_param, n_simulations, sample_size, seed=None,
+                       callback=None, estimator='lp3', resampling='subsample'):
     # reference:
     # https://nbviewer.jupyter.org/github/demotu/BMC/blob/master/notebooks/CurveFitting.ipynb
 
-    model = pd.DataFrame()
-    model['Tr'] = np.logspace(-2, 3, 500)
-    model.set_index('Tr', inplace=True)
-   
-    model['z'] = list(map(norm_ppf, model.index.values))
+    # fit the n_simulations subsamples in batches and keep only the
+    # running mean/variance and a quantile sketch at each return period
+    accumulators = [RunningMoments(len(Z_GRID)), QuantileSketch(len(Z_GRID), seed=seed)]
+    moments, sketch = simulate_lp3_streaming(data[target_param].values, sample_size,
+                                             n_simulations, z=Z_GRID, seed=seed,
+                                             processes=SIMULATION_PROCESSES,
+                                             chunk_size=SIMULATION_CHUNK_SIZE,
+                                             accumulators=accumulators,
+                                             callback=callback,
+                                             estimator=estimator,
+                                             resampling=resampling)
+    return moments, sketch
+
+
+def distribution_data(moments, sketch, lp3_quantiles_model):
+    # the simulation error bounds and the full record fit
+    simulation = moments.sigma_bands(k=(1, 2))
+    simulation.update(sketch.percentile_bands())
+    simulation['Tr'] = TR_GRID
+    simulation['lp3_model'] = lp3_quantiles_model
+    return simulation
+
+
+def compute_ffa(df, target_param, sample_size, n_simulations, seed,
+                on_partial=None, cancelled=None, estimator='lp3', resampling='subsample'):
+    """
+    Full-record LP3 fit and sampling simulation for one station.
+    Depends only on its arguments, so results can be shared between
+    sessions through SIMULATION_CACHE.
+    :param on_partial: called as on_partial(data, simulation, n_done)
+        after each batch of simulations
+    :param cancelled: returns True if the result is no longer wanted
+    :return: (peak data with Tr and fitted values, distribution data dict),
+        or None if cancelled
+    """
+    data, lp3_quantiles_model = fit_full_record(df, target_param, estimator)
+
+    def callback(accumulators):
+        if cancelled is not None and cancelled():
+            return True
+        if on_partial is not None:
+            moments, sketch = accumulators
+            on_partial(data, distribution_data(moments, sketch, lp3_quantiles_model),
+                       moments.n)
+        return False
 
-    for i in range(n_simulations):
+    time0 = time.time()
+    moments, sketch = run_ffa_simulation(data, target_param, n_simulations,
+                                         sample_size, seed=seed, callback=callback,
+                                         estimator=estimator, resampling=resampling)
+    time_end = time.time()
+    if cancelled is not None and cancelled():
+        return None
+    print("Time for {:.0f} simulations = {:0.2f} s".format(
+        n_simulations, time_end - time0))
 
-        sample_set = data.sample(
-            sample_size_input.value, replace=False)
+    return data, distribution_data(moments, sketch, lp3_quantiles_model)
 
-        selection = calculate_Tr(sample_set, target_param)
 
-        # log-pearson distribution
-        log_skew = st.skew(np.log10(selection[target_param]))
+def apply_results(generation, data, simulation, n_years, n_done=None):
+    """
+    Push results to the plot data sources.  Runs on the bokeh event loop
+    (via add_next_tick_callback); results from superseded runs are dropped.
+    """
+    if generation != RUN_STATE['generation']:
+        return
+    if data is not None:
+        peak_source.data = peak_source.from_df(data)
+        data_flag_filter = data[~data['SYMBOL'].isin([None, ' '])]
+        peak_flagged_source.data = peak_flagged_source.from_df(data_flag_filter)
 
-        lp3 = 2 / log_skew * \
-            (np.power((model['z'] - log_skew / 6) * log_skew / 6 + 1, 3) - 1)
+    distribution_source.data = dict(simulation)
 
-        lp3_model = np.power(10, np.mean(
-            np.log10(selection[target_param])) + lp3 * np.std(np.log10(selection[target_param])))
+    update_UI_text_output(n_years)
+    if n_done is not None and n_done < simulation_number_input.value:
+        ffa_info.text += "  \n(running: {} of {} simulations)".format(
+            n_done, simulation_number_input.value)
+
+
+def run_update(generation, station, target_param, sample_size, n_simulations, seed,
+               estimator='lp3', resampling='subsample'):
+    """
+    Worker side of update(): runs in EXECUTOR, off the event loop.  Loads
+    the station's series, sends it to apply_series and, if the record is
+    long enough, runs the simulation.
+    """
+    def cancelled():
+        return generation != RUN_STATE['generation']
+
+    if cancelled():
+        return
+
+    try:
+        # instantaneous peaks, or the (precomputed) annual maxima of the
+        # daily flows if there are too few
+        df, source = get_station_series(station)
+        floods = get_design_floods(station, get_hydat_version())
+    except Exception as e:
+        print('Error loading the data for {}:'.format(station))
+        print(e)
+        return
+    doc.add_next_tick_callback(partial(
+        apply_series, generation, station, df, source, floods, sample_size))
+
+    n_years = len(df)
+    # apply_series resets the inputs (and so re-runs the update)
+    if n_years < 2 or n_years < sample_size or cancelled():
+        return
+    if resampling != 'subsample':
+        # bootstrap samples are the length of the full record
+        sample_size = n_years
+
+    first_paint = []
+
+    def on_partial(data, simulation, n_done):
+        # send the peak data with the first batch only
+        doc.add_next_tick_callback(partial(
+            apply_results, generation, None if first_paint else data,
+            simulation, n_years, n_done))
+        first_paint.append(True)
+
+    try:
+        key = (station, sample_size, n_simulations, seed, estimator, resampling,
+               station_data_version(station, get_hydat_version()))
+        result = SIMULATION_CACHE.get(key)
+        if result is None:
+            result = compute_ffa(df, target_param, sample_size, n_simulations, seed,
+                                 on_partial=on_partial, cancelled=cancelled,
+                                 estimator=estimator, resampling=resampling)
+            if result is None:
+                return
+            SIMULATION_CACHE.put(key, result)
+    except Exception as e:
+        print('Error running the FFA simulation for {}:'.format(station))
+        print(e)
+        return
+
+    data, simulation = result
+    doc.add_next_tick_callback(partial(
+        apply_results, generation, data, simulation, n_years))
+
+
+def apply_series(generation, station, df, source, floods, sample_size):
+    """
+    Show a station's series once run_update has loaded it, or reset the
+    inputs if the record is too short.  Runs on the bokeh event loop.
+    """
+    if generation != RUN_STATE['generation']:
+        return
+    n_years = len(df)
+    if n_years < 2:
+        error_info.text = "Error, insufficient data in record (n = {}).  Resetting to default.".format(
+            n_years)
+        if not annual_maxima_ready():
+            # one background build per process, never on the document
+            # thread or the session's simulation executor
+            start_prepare_annual_maxima()
+            error_info.text += "  The annual maximum daily flows are being prepared; " \
+                               "try this station again shortly."
+        station_name_input.value = IDS_TO_NAMES['08MH016']
+        return
+
+    print('number of years of data = {}'.format(n_years))
+    print("")
 
-        model[i] = lp3_model
-    return model
+    # prevent the sample size from exceeding the
+    # length of record (the widget callback re-runs the update)
+    if n_years < sample_size:
+        sample_size_input.value = n_years - 1
+        return
+
+    series_info.text = ""
+    if source == 'daily_max':
+        series_info.text = "Too few instantaneous peaks: using the annual maximum " \
+                           "daily flows of {} water years.".format(n_years)
+    update_design_flood_text(floods)
+    update_window_trend(station)
+    update_fits(station)
+    update_regional(station)
+
+
+def run_fits(generation, station, k):
+    """
+    Fit the candidate distributions (cached per station) in FIT_EXECUTOR
+    and send the quantile curves of the k best fits to the plot.
+    """
+    if generation != RUN_STATE['fit_generation']:
+        return
+    try:
+        df = get_station_series(station)[0]
+        if generation != RUN_STATE['fit_generation']:
+            return
+        peaks = df['PEAK'].dropna().values
+        fits = get_station_fits(station, peaks[peaks > 0],
+                                station_data_version(station, get_hydat_version()),
+                                processes=FIT_PROCESSES)
+    except Exception as e:
+        print('Error fitting distributions for {}:'.format(station))
+        print(e)
+        return
+    curves = top_fit_quantiles(fits, TR_GRID, k)
+    doc.add_next_tick_callback(partial(apply_fits, generation, curves))
+
+
+def apply_fits(generation, curves):
+    if generation != RUN_STATE['fit_generation']:
+        return
+    fit_source.data = {'xs': [TR_GRID] * len(curves),
+                       'ys': [q for _, q in curves],
+                       'label': ['{} (#{})'.format(name, i + 1)
+                                 for i, (name, _) in enumerate(curves)],
+                       'color': FIT_COLORS[:len(curves)]}
+
+
+def update_fits(station):
+    RUN_STATE['fit_generation'] += 1
+    k = n_fits_input.value
+    if k == 0:
+        fit_source.data = {'xs': [], 'ys': [], 'label': [], 'color': []}
+        return
+    FIT_EXECUTOR.submit(run_fits, RUN_STATE['fit_generation'], station, k)
+
+
+def run_regional(generation, station, radius):
+    """
+    Pooled (index flood) growth curve over the stations within radius km,
+    computed in REGIONAL_EXECUTOR; station summaries are cached across updates.
+    """
+    if generation != RUN_STATE['regional_generation']:
+        return
+    lat, lon = IDS_AND_COORDS[station]
+    try:
+        result = regional_ffa(lat, lon, radius, target_station=station,
+                              return_periods=TR_GRID)
+    except Exception as e:
+        print('Error running the regional analysis for {}:'.format(station))
+        print(e)
+        return
+    doc.add_next_tick_callback(partial(apply_regional, generation, result))
+
+
+def apply_regional(generation, result):
+    if generation != RUN_STATE['regional_generation']:
+        return
+    regional_source.data = {'Tr': TR_GRID, 'regional': result['quantiles']}
+    regional_info.text = "Regional growth curve: {} stations, {} station-years (L-CV {:.2f}, L-skew {:.2f}).".format(
+        result['n_stations'], result['station_years'], result['lcv'], result['t3'])
+
+
+def update_regional(station):
+    RUN_STATE['regional_generation'] += 1
+    radius = regional_radius_input.value
+    if radius == 0:
+        regional_source.data = {'Tr': [], 'regional': []}
+        regional_info.text = ""
+        return
+    REGIONAL_EXECUTOR.submit(run_regional, RUN_STATE['regional_generation'], station, radius)
+
+
+def run_window_trend(generation, station, window):
+    # design floods of each rolling (or expanding) window of the record
+    if generation != RUN_STATE['window_generation']:
+        return
+    try:
+        windows = station_windows(get_station_series(station)[0], window=window)
+    except Exception as e:
+        print('Error computing the window trend for {}:'.format(station))
+        print(e)
+        return
+    doc.add_next_tick_callback(partial(apply_window_trend, generation, windows))
+
+
+def apply_window_trend(generation, windows):
+    if generation != RUN_STATE['window_generation']:
+        return
+    window_source.data = window_source.from_df(windows[['END_YEAR', 'N_YEARS', 'Q100']])
+
+
+def update_window_trend(station):
+    RUN_STATE['window_generation'] += 1
+    FIT_EXECUTOR.submit(run_window_trend, RUN_STATE['window_generation'], station,
+                        window_length_input.value or None)
+
+
+def update_design_flood_text(floods):
+    # full record design floods from the precomputed index (if built)
+    if floods is None:
+        design_flood_info.text = ""
+        return
+    design_flood_info.text = "Full record LP3 design floods (m³/s): " + ", ".join(
+        "{}: {:.1f}".format(col, floods[col]) for col in quantile_columns())
 
 
 def update():
     station_name = station_name_input.value.split(':')[-1].strip()
-    df = get_annual_inst_peaks(
-        NAMES_TO_IDS[station_name])
-
+    station = NAMES_TO_IDS[station_name]
 
     # set the target param to PEAK to extract peak annual values 
     target_param = 'PEAK'
 
-    if len(df) < 2:
-        error_info.text = "Error, insufficient data in record (n = {}).  Resetting to default.".format(
-            len(df))
-        station_name_input.value = IDS_TO_NAMES['08MH016']
-        update()
+    # Run the FFA fit simulation on a sample of specified size
+    ## number of times to run the simulation
+    n_simulations = simulation_number_input.value
+    sample_size = sample_size_input.value
+    seed = seed_input.value
+    estimator = estimator_input.value
+    resampling = RESAMPLING_METHODS[resampling_input.active]
 
-    data = calculate_Tr(df, 'PEAK')
-    data.sort_values('Tr', ascending=False, inplace=True)
+    # the data is loaded in the worker; a new generation supersedes
+    # (cancels) any run still in progress
+    RUN_STATE['generation'] += 1
+    EXECUTOR.submit(run_update, RUN_STATE['generation'], station, target_param,
+                    sample_size, n_simulations, seed, estimator, resampling)
 
-    data['Mean'] = np.mean(data['PEAK'])
 
-    n_years = len(data)
-    print('number of years of data = {}'.format(n_years))
-    print("")
+def update_station(attr, old, new):
+    update()
 
-    # prevent the sample size from exceeding the
-    # length of record
-    if n_years < sample_size_input.value:
-        sample_size_input.value = n_years - 1
 
+def update_n_simulations(attr, old, new):
+    if new > 1000:
+        simulation_number_input.value = 1000
+        error_info.text = "Max simulation size is 500"
+    update()
 
-    # Run the FFA fit simulation on a sample of specified size
-    ## number of times to run the simulation
-    n_simulations = simulation_number_input.value
 
-    time0 = time.time()
-    model = run_ffa_simulation(data, target_param, n_simulations)
-    time_end = time.time()
-    print("Time for {:.0f} simulations = {:0.2f} s".format(
-        n_simulations, time_end - time0))
+def update_simulation_sample_size(attr, old, new):
+    update()
 
-    # plot the log-pearson fit to the entire dataset
-    log_skew = st.skew(np.log10(data[target_param]))
-    z_model = np.array(list(map(norm_ppf, model.index.values)))
-    z_empirical = np.array(list(map(norm_ppf, data['Tr'])))
 
-    lp3_model = 2 / log_skew * \
-        (np.power((z_model - log_skew / 6) * log_skew / 6 + 1, 3) - 1)
+def update_seed(attr, old, new):
+    update()
 
-    lp3_empirical = 2 / log_skew * \
-        (np.power((z_empirical - log_skew/6)*log_skew/6 + 1, 3)-1)
 
-    lp3_quantiles_model = np.power(10, np.mean(
-        np.log10(data[target_param])) + lp3_model*np.std(np.log10(data[target_param])))
+def update_estimator(attr, old, new):
+    update()
 
-    lp3_quantiles_empirical = np.power(10, np.mean(
-        np.log10(data[target_param])) + lp3_empirical*np.std(np.log10(data[target_param])))
 
-    data['theoretical'] = lp3_quantiles_empirical
+def update_resampling(attr, old, new):
+    sample_size_input.disabled = RESAMPLING_METHODS[new] != 'subsample'
+    update()
 
-    data['empirical_cdf'] = data['rank'] / (len(data) + 1)
 
-    # pearson_fit_params = st.pearson3.fit(np.log(data['PEAK']))
+def update_n_fits(attr, old, new):
+    station_name = station_name_input.value.split(':')[-1].strip()
+    update_fits(NAMES_TO_IDS[station_name])
 
-    # reverse the order for proper plotting on P-P plot
-    data['theoretical_cdf'] = st.pearson3.cdf(z_empirical, skew=log_skew)[::-1]
 
-    # update the peak flow data source
-    peak_source.data = peak_source.from_df(data)
-    data_flag_filter = data[~data['SYMBOL'].isin([None, ' '])]
-    peak_flagged_source.data = peak_flagged_source.from_df(data_flag_filter)
+def update_regional_radius(attr, old, new):
+    station_name = station_name_input.value.split(':')[-1].strip()
+    update_regional(NAMES_TO_IDS[station_name])
 
-    # plot the simulation error bounds
-    mean_models = model.apply(lambda row: row.mean(), axis=1)
-    stdev_models = model.apply(lambda row: row.std(), axis=1)
 
-    simulation = {'Tr': model.index,
-                  'lower_1_sigma': np.subtract(mean_models, stdev_models),
-                  'upper_1_sigma': np.add(mean_models, stdev_models),
-                  'lower_2_sigma': np.subtract(mean_models, 2*stdev_models),
-                  'upper_2_sigma': np.add(mean_models, 2*stdev_models),
-                  'mean': mean_models,
-                  'lp3_model': lp3_quantiles_model
-                  }    
+def update_window_length(attr, old, new):
+    station_name = station_name_input.value.split(':')[-1].strip()
+    update_window_trend(NAMES_TO_IDS[station_name])
 
-    distribution_source.data = simulation
-    
-    update_UI_text_output(n_years)
 
+def update_band_type(attr, old, new):
+    show_percentiles = new == 1
+    for band in [ffa_1_sigma_band, ffa_2_sigma_band]:
+        band.visible = not show_percentiles
+    for band in [ffa_16_84_band, ffa_2_5_97_5_band, ffa_median_line]:
+        band.visible = show_percentiles
+    # no peak data until the first result arrives (or after a reset)
+    update_UI_text_output(len(peak_source.data.get('PEAK', [])))
 
-def update_station(attr, old, new):
-    update()
 
+# data loads and the simulation run in worker threads so the document
+# stays responsive; RUN_STATE['generation'] identifies the latest request
+# of this session.  Fits (and window trends) and regional analyses have
+# their own workers, so a superseded one never delays the next simulation.
+doc = curdoc()
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
+FIT_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+REGIONAL_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+RUN_STATE = {'generation': 0, 'fit_generation': 0, 'regional_generation': 0,
+             'window_generation': 0}
 
-def update_n_simulations(attr, old, new):
-    if new > 1000:
-        simulation_number_input.value = 1000
-        error_info.text = "Max simulation size is 500"
-    update()
 
+def shutdown_executors(session_context):
+    for executor in (EXECUTOR, FIT_EXECUTOR, REGIONAL_EXECUTOR):
+        executor.shutdown(wait=False)
 
-def update_simulation_sample_size(attr, old, new):
-    update()
 
+doc.on_session_destroyed(shutdown_executors)
 
 # configure Bokeh Inputs, data sources, and plots
-autocomplete_station_names = list(STATIONS_DF['Station Name'])
+autocomplete_station_names = STATION_NAMES
 peak_source = ColumnDataSource(data=dict())
 peak_flagged_source = ColumnDataSource(data=dict())
 distribution_source = ColumnDataSource(data=dict())
+fit_source = ColumnDataSource(data=dict(xs=[], ys=[], label=[], color=[]))
+regional_source = ColumnDataSource(data=dict(Tr=[], regional=[]))
+window_source = ColumnDataSource(data=dict(END_YEAR=[], N_YEARS=[], Q100=[]))
 qq_source = ColumnDataSource(data=dict())
 
 
@@ -214,13 +483,59 @@ sample_size_input = Spinner(
 ffa_info = Div(
     text="Mean of {} simulations of a sample size {}.".format('x', 'y'))
 
+seed_input = Spinner(
+    high=2**31 - 1, low=0, step=1, value=0, title="Random Seed"
+)
+
+n_fits_input = Spinner(
+    high=len(FIT_COLORS), low=0, step=1, value=0,
+    title="Overlay Best Fitted Distributions (ranked by AIC)"
+)
+
+estimator_input = Select(
+    title="Fitted Distribution (Estimation Method)", value='lp3',
+    options=[('lp3', 'Log-Pearson III (product moments)'),
+             ('lp3_lmoments', 'Log-Pearson III (L-moments)'),
+             ('gev_lmoments', 'GEV (L-moments)'),
+             ('glo_lmoments', 'Generalized Logistic (L-moments)')])
+
+# in the order of RESAMPLING_METHODS
+resampling_input = RadioButtonGroup(
+    labels=['Subsampling', 'Bootstrap', 'Parametric Bootstrap'], active=0)
+
+regional_radius_input = Spinner(
+    high=1000, low=0, step=25, value=0,
+    title="Regional Growth Curve Radius (km, 0 = off)"
+)
+
+window_length_input = Spinner(
+    high=100, low=0, step=5, value=30,
+    title="Q100 Trend Window (years, 0 = expanding)"
+)
+
+band_type_input = RadioButtonGroup(
+    labels=['Mean ± 1σ/2σ', 'Percentiles 16-84 / 2.5-97.5'], active=0)
+
 error_info = Div(text="", style={'color': 'red'})
 
+design_flood_info = Div(text="")
+
+series_info = Div(text="")
+
+regional_info = Div(text="")
+
 # callback for updating the plot based on a changes to inputs
 station_name_input.on_change('value', update_station)
 simulation_number_input.on_change('value', update_n_simulations)
 sample_size_input.on_change(
     'value', update_simulation_sample_size)
+seed_input.on_change('value', update_seed)
+estimator_input.on_change('value', update_estimator)
+resampling_input.on_change('active', update_resampling)
+band_type_input.on_change('active', update_band_type)
+n_fits_input.on_change('value', update_n_fits)
+regional_radius_input.on_change('value', update_regional_radius)
+window_length_input.on_change('value', update_window_length)
 
 update()
 
@@ -244,6 +559,17 @@ ts_plot.line('YEAR', 'Mean', source=peak_source, color='red',
 ts_plot.legend.location = "top_left"
 ts_plot.legend.click_policy = 'hide'
 
+# LP3 100-year flood of the window of record ending in each year
+trend_plot = figure(title="100-Year Flood by Window End Year",
+                    width=800,
+                    height=250,
+                    output_backend="webgl")
+
+trend_plot.xaxis.axis_label = "Window End Year"
+trend_plot.yaxis.axis_label = "Q100 (m³/s)"
+trend_plot.line('END_YEAR', 'Q100', source=window_source, color='navy')
+trend_plot.circle('END_YEAR', 'Q100', source=window_source, color='navy', size=4)
+
 # create a plot for the Flood Frequency Values and style its properties
 ffa_plot = figure(title="Flood Frequency Analysis Explorer",
                   x_range=(0.9, 2E2),
@@ -260,7 +586,16 @@ ffa_plot.circle('Tr', 'PEAK', source=peak_flagged_source, color="orange",
                 legend_label="Measured Data (QA/QC Flag)")
 ffa_plot.line('Tr', 'lp3_model', color='red',
               source=distribution_source,
-              legend_label='Log-Pearson3 (All Data)')
+              legend_label='Fitted Distribution (All Data)')
+
+# index flood estimate from the pooled regional growth curve (optional)
+ffa_plot.line('Tr', 'regional', color='green', line_width=2,
+              source=regional_source,
+              legend_label='Regional Growth Curve (GEV)')
+
+# maximum likelihood fits of other distributions (optional)
+ffa_plot.multi_line('xs', 'ys', line_color='color', line_width=2, line_alpha=0.8,
+                    legend_field='label', source=fit_source)
 
 ffa_plot.line('Tr', 'mean', color='navy',
               line_dash='dashed',
@@ -276,8 +611,23 @@ ffa_1_sigma_band = Band(base='Tr', lower='lower_1_sigma', upper='upper_1_sigma',
                         fill_alpha=0.65, fill_color='#a6bddb', 
                         source=distribution_source)
 
+# empirical percentile bands from the quantile sketch (hidden by default)
+ffa_2_5_97_5_band = Band(base='Tr', lower='pct_2_5', upper='pct_97_5', level='underlay',
+                         fill_alpha=0.25, fill_color='#1c9099', visible=False,
+                         source=distribution_source)
+ffa_16_84_band = Band(base='Tr', lower='pct_16', upper='pct_84', level='underlay',
+                      fill_alpha=0.65, fill_color='#a6bddb', visible=False,
+                      source=distribution_source)
+
+ffa_median_line = ffa_plot.line('Tr', 'pct_50', color='navy',
+                                line_dash='dotted', visible=False,
+                                source=distribution_source,
+                                legend_label='Median Simulation')
+
 ffa_plot.add_layout(ffa_2_sigma_band)
 ffa_plot.add_layout(ffa_1_sigma_band)
+ffa_plot.add_layout(ffa_2_5_97_5_band)
+ffa_plot.add_layout(ffa_16_84_band)
 
 ffa_plot.legend.location = "top_left"
 ffa_plot.legend.click_policy = "hide"
@@ -316,11 +666,22 @@ pp_plot.legend.location = 'top_left'
 layout = column(station_name_input,
                 sample_size_input,
                 simulation_number_input,
+                seed_input,
+                estimator_input,
+                resampling_input,
+                band_type_input,
+                n_fits_input,
+                regional_radius_input,
                 ffa_info,
+                design_flood_info,
+                series_info,
+                regional_info,
                 error_info,
                 ts_plot,
+                window_length_input,
+                trend_plot,
                 ffa_plot,
                 row(qq_plot, pp_plot)
                 )
 
-curdoc().add_root(layout)
+doc.add_root(layout)
@@ -0,0 +1,131 @@
+# Rolling and expanding window LP3 fits over the years of record, to see
+# how the design floods of a station change as years are added.
+# The log-moments of every window come from running power sums, so each
+# window adds one year and (for a rolling window) removes one, and all
+# windows of all stations are computed in one pass:
+#
+#   python nonstationarity.py windows.csv --window 30
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from ffa import DESIGN_RETURN_PERIODS
+from frequency_factors import z_from_Tr
+from simulation import lp3_quantiles, moments_from_power_sums
+
+# windows with fewer annual peaks get NaN quantiles
+MIN_YEARS = 10
+
+
+def window_log_moments(groups, years, peaks, window=None):
+    """
+    Log-moments of the peaks in every window ending at each record,
+    for records sorted by (group, year).  A window of w years ending in
+    year Y holds the group's peaks from years Y - w + 1 to Y (so gaps in
+    the record give fewer peaks); window=None gives expanding windows
+    from the start of each group's record.
+    Power sums of the group-centred logs are accumulated once; each window
+    is the difference of two running sums (see
+    simulation.moments_from_power_sums).
+    :param groups: integer group (station) codes, non-decreasing
+    :param years: years, increasing within each group
+    :param peaks: positive peak flows
+    :return: n, mean, stdev, skew as arrays with one value per record
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    years = np.asarray(years, dtype=np.int64)
+    logs = np.log10(np.asarray(peaks, dtype=float))
+
+    n_groups = groups.max() + 1 if len(groups) else 0
+    counts = np.bincount(groups, minlength=n_groups)
+    group_start = np.concatenate([[0], np.cumsum(counts)[:-1]])[groups]
+    # centre each group so the running sums do not lose precision
+    shift = (np.bincount(groups, logs, n_groups) / np.maximum(counts, 1))[groups]
+    dev = logs - shift
+
+    sums = [np.concatenate([[0.], np.cumsum(dev**p)]) for p in (1, 2, 3)]
+    stop = np.arange(1, len(logs) + 1)
+    if window is None:
+        start = group_start
+    else:
+        # years are unique and increasing within a group, so the combined
+        # key is sorted and the search stays inside the group
+        key = groups * 10000 + years
+        start = np.searchsorted(key, key - window + 1)
+
+    n = (stop - start).astype(float)
+    mean, stdev, skew = moments_from_power_sums(n, *(s[stop] - s[start] for s in sums),
+                                                shift=shift)
+    return n.astype(int), mean, stdev, skew
+
+
+def window_quantiles(n, mean, stdev, skew, return_periods=DESIGN_RETURN_PERIODS,
+                     min_years=MIN_YEARS):
+    """
+    LP3 quantiles of each window's log-moments (NaN below min_years).
+    :return: dict of arrays keyed Q{tr}
+    """
+    z = z_from_Tr(np.asarray(return_periods, dtype=float))
+    with np.errstate(over='ignore', invalid='ignore'):
+        q = lp3_quantiles(z, mean, stdev, skew)
+    q[n < min_years] = np.nan
+    return {'Q{}'.format(tr): q[:, j] for j, tr in enumerate(return_periods)}
+
+
+def station_windows(df, window=None, return_periods=DESIGN_RETURN_PERIODS,
+                    min_years=MIN_YEARS):
+    """
+    Window fits for one station.
+    :param df: annual peaks with YEAR and PEAK (get_annual_inst_peaks)
+    :return: DataFrame with one row per window end year
+    """
+    df = df[df['PEAK'] > 0].sort_values('YEAR')
+    years = df['YEAR'].values
+    n, mean, stdev, skew = window_log_moments(np.zeros(len(df), dtype=int), years,
+                                              df['PEAK'].values, window)
+    out = pd.DataFrame({'END_YEAR': years, 'N_YEARS': n, 'LOG_MEAN': mean,
+                        'LOG_STD': stdev, 'LOG_SKEW': skew})
+    for col, q in window_quantiles(n, mean, stdev, skew, return_periods, min_years).items():
+        out[col] = q
+    return out
+
+
+def all_station_windows(peaks_cache, window=None, return_periods=DESIGN_RETURN_PERIODS,
+                        min_years=MIN_YEARS, data_type='Q', peak_code='H'):
+    """
+    Window fits for every station in the peak flow cache in one pass.
+    :return: DataFrame with one row per (station, window end year)
+    """
+    station_ids, row_station, keep = peaks_cache.row_stations(data_type, peak_code)
+    peak = np.asarray(peaks_cache.arrays['PEAK'], dtype=float)
+    keep &= np.isfinite(peak) & (peak > 0)
+    years = np.asarray(peaks_cache.arrays['YEAR'], dtype=np.int64)[keep]
+    groups = row_station[keep]
+    order = np.lexsort((years, groups))
+    groups, years, peak = groups[order], years[order], peak[keep][order]
+
+    n, mean, stdev, skew = window_log_moments(groups, years, peak, window)
+    out = pd.DataFrame({'STATION_NUMBER': station_ids[groups], 'END_YEAR': years,
+                        'N_YEARS': n, 'LOG_MEAN': mean, 'LOG_STD': stdev, 'LOG_SKEW': skew})
+    for col, q in window_quantiles(n, mean, stdev, skew, return_periods, min_years).items():
+        out[col] = q
+    return out
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Rolling/expanding window LP3 fits for all stations.')
+    parser.add_argument('output', help='results CSV file')
+    parser.add_argument('--window', type=int, default=None,
+                        help='window length in years (default: expanding windows)')
+    parser.add_argument('--min-years', type=int, default=MIN_YEARS,
+                        help='minimum number of peaks in a window')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    from get_station_data import get_peaks_cache
+    args = parse_args(sys.argv[1:])
+    all_station_windows(get_peaks_cache(), window=args.window,
+                        min_years=args.min_years).to_csv(args.output, index=False)
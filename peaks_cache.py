@@ -0,0 +1,195 @@
+import os
+import json
+import shutil
+import time
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(BASE_DIR, 'cache/')
+
+PEAKS_TABLE = 'ANNUAL_INSTANT_PEAKS'
+
+
+def peaks_cache_dir(version, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, 'peaks_{}'.format(version))
+
+
+def make_build_dir(out_dir):
+    """
+    A new, uniquely named temporary directory next to out_dir, so
+    concurrent builders (threads or processes) never share one.
+    """
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    return tempfile.mkdtemp(prefix=os.path.basename(out_dir) + '.tmp', dir=os.path.dirname(out_dir))
+
+
+def install_build_dir(tmp_dir, out_dir):
+    """
+    Rename a finished build directory to out_dir.  If another builder
+    installed a complete out_dir first, keep theirs; an incomplete one
+    (without meta.json) is moved aside and deleted.
+    """
+    try:
+        os.rename(tmp_dir, out_dir)
+        return
+    except OSError:
+        if os.path.exists(os.path.join(out_dir, 'meta.json')):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+    trash = make_build_dir(out_dir)
+    os.rename(out_dir, os.path.join(trash, 'old'))
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+def is_build_dir(name):
+    # temporary directories of builds in progress
+    return '.tmp' in name
+
+
+def build_peaks_cache(conn, version, cache_dir=CACHE_DIR):
+    """
+    Extract the ANNUAL_INSTANT_PEAKS table for all stations into one
+    .npy file per column, sorted by station, plus a per-station offset
+    index.  Rows keep their table order within each station so a
+    lookup returns the same rows as the SQL query.  The directory is
+    written under a temporary name and renamed into place.
+    :param conn: sqlite3 Connection to the HYDAT database
+    :param version: HYDAT version string the cache is keyed on
+    :return: path of the cache directory
+    """
+    time0 = time.time()
+    df = pd.read_sql_query(
+        "SELECT * FROM {} ORDER BY STATION_NUMBER, rowid".format(PEAKS_TABLE), con=conn)
+
+    out_dir = peaks_cache_dir(version, cache_dir)
+    tmp_dir = make_build_dir(out_dir)
+
+    stations, starts = np.unique(df['STATION_NUMBER'].values.astype(str), return_index=True)
+    offsets = np.append(starts, len(df)).astype(np.int64)
+    np.save(os.path.join(tmp_dir, 'stations.npy'), stations)
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+
+    declared = {row[1]: row[2].upper() for row in conn.execute(
+        "PRAGMA table_info({})".format(PEAKS_TABLE))}
+
+    kinds = {}
+    for col in df.columns:
+        values = df[col]
+        if declared.get(col) == 'TEXT' or values.dtype == object:
+            # text columns: fixed width unicode plus a null mask so that
+            # None (vs ' ') flags survive the round trip
+            kinds[col] = 'str'
+            np.save(os.path.join(tmp_dir, col + '.null.npy'), values.isnull().values)
+            np.save(os.path.join(tmp_dir, col + '.npy'),
+                    values.fillna('').values.astype(str))
+        else:
+            # integer columns containing NULLs are read as float; restore
+            # the int dtype on lookup when a station has no NULLs
+            kinds[col] = 'int' if declared.get(col) == 'INTEGER' else 'float'
+            np.save(os.path.join(tmp_dir, col + '.npy'), values.values.astype(float))
+
+    meta = {'version': version, 'table': PEAKS_TABLE,
+            'columns': list(df.columns), 'kinds': kinds, 'n_rows': len(df)}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    install_build_dir(tmp_dir, out_dir)
+    print('Built peak flow cache for {} stations ({} rows) in {:.1f} s'.format(
+        len(stations), len(df), time.time() - time0))
+    return out_dir
+
+
+class PeaksCache:
+    """
+    Read-only, memory-mapped view of a cache written by build_peaks_cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.version = self.meta['version']
+        self.columns = self.meta['columns']
+        self.kinds = self.meta['kinds']
+
+        self.stations = np.load(os.path.join(path, 'stations.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.index = {s: (self.offsets[i], self.offsets[i + 1])
+                      for i, s in enumerate(self.stations)}
+
+        self.arrays = {col: np.load(os.path.join(path, col + '.npy'), mmap_mode='r')
+                       for col in self.columns}
+        self.nulls = {col: np.load(os.path.join(path, col + '.null.npy'), mmap_mode='r')
+                      for col in self.columns if self.kinds[col] == 'str'}
+
+    def __contains__(self, station):
+        return station in self.index
+
+    def _column(self, col, start, stop, mask):
+        values = self.arrays[col][start:stop][mask]
+        if self.kinds[col] == 'str':
+            values = values.astype(object)
+            values[self.nulls[col][start:stop][mask]] = None
+        elif self.kinds[col] == 'int' and not np.isnan(values).any():
+            values = values.astype(np.int64)
+        else:
+            values = np.array(values)
+        return values
+
+    def row_stations(self, data_type='Q', peak_code='H'):
+        """
+        Station of every row, for scans over all stations at once.
+        :return: (station numbers, per-row index into them, per-row mask
+            of the rows of data_type and peak_code)
+        """
+        codes = np.repeat(np.arange(len(self.stations)), np.diff(self.offsets))
+        mask = (self.arrays['DATA_TYPE'] == data_type) & \
+            (self.arrays['PEAK_CODE'] == peak_code)
+        return self.stations, codes, mask
+
+    def get(self, station, data_type='Q', peak_code='H'):
+        """
+        Equivalent of get_peak_inst_flows_by_station_ID.
+        :return: dataframe of annual maximum peak instantaneous flows
+        """
+        start, stop = self.index.get(station, (0, 0))
+        mask = (self.arrays['DATA_TYPE'][start:stop] == data_type) & \
+            (self.arrays['PEAK_CODE'][start:stop] == peak_code)
+        return pd.DataFrame({col: self._column(col, start, stop, mask)
+                             for col in self.columns})
+
+
+def open_peaks_cache(version, cache_dir=CACHE_DIR):
+    """
+    Open the cache for the given HYDAT version, or return None
+    if it has not been built.
+    """
+    path = peaks_cache_dir(version, cache_dir)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    return PeaksCache(path)
+
+
+def remove_stale_dirs(current_dir, prefix, cache_dir=CACHE_DIR):
+    """
+    Delete the directories in cache_dir named prefix + <version> other
+    than current_dir (but not the temporary directories of builds in
+    progress).  Shared by the versioned caches.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    current = os.path.basename(os.path.normpath(current_dir))
+    for d in os.listdir(cache_dir):
+        if d.startswith(prefix) and d != current and not is_build_dir(d):
+            shutil.rmtree(os.path.join(cache_dir, d), ignore_errors=True)
+
+
+def remove_stale_caches(version, cache_dir=CACHE_DIR):
+    """
+    Delete peak flow caches built from other HYDAT versions.
+    """
+    remove_stale_dirs(peaks_cache_dir(version, cache_dir), 'peaks_', cache_dir)
@@ -0,0 +1,204 @@
+# Post-install stage for a new HYDAT file: covering indexes for the
+# queries in get_station_data.py, built in the HYDAT file itself, and a
+# sidecar database (cache/hydat_derived_<version>.sqlite3) with the daily
+# flows in long format and the annual peaks, both clustered on station
+# number so every read is a single index range scan.  It also builds the
+# memory-mapped daily flow archive (daily_archive.py) with the annual
+# maximum daily flows of every station (annual_maxima.py), and saves the
+# per-station row hashes used to diff versions (hydat_diff.py).
+#
+# download.py runs it on each new database; for an existing install:
+#
+#   python post_install.py [path/to/Hydat_<version>.sqlite3]
+import os
+import sys
+import time
+import shutil
+import sqlite3
+
+import numpy as np
+
+from hydat_diff import build_station_hashes
+from daily_archive import build_daily_archive, DailyArchive
+from annual_maxima import build_annual_maxima
+from get_station_data import reshape_dly_flows, iter_dly_flows_rows, derived_db_path, \
+    get_db_version, find_newest_db_file, DERIVED_DAILY_FLOWS_TABLE, DERIVED_PEAKS_TABLE
+
+# (name, statement): ANNUAL_INSTANT_PEAKS is read by (station, data type,
+# peak code) and the index holds every column, so SELECT * never touches
+# the table; DLY_FLOWS is read by station, ordered by year and month
+INDEXES = [
+    ('IDX_ANNUAL_INSTANT_PEAKS_STATION',
+     "CREATE INDEX IDX_ANNUAL_INSTANT_PEAKS_STATION ON ANNUAL_INSTANT_PEAKS "
+     "(STATION_NUMBER, DATA_TYPE, PEAK_CODE, YEAR, PRECISION_CODE, MONTH, DAY, "
+     "HOUR, MINUTE, TIME_ZONE, PEAK, SYMBOL)"),
+    ('IDX_DLY_FLOWS_STATION',
+     "CREATE INDEX IDX_DLY_FLOWS_STATION ON DLY_FLOWS (STATION_NUMBER, YEAR, MONTH)"),
+]
+
+DAILY_FLOWS_TABLE = DERIVED_DAILY_FLOWS_TABLE
+ANNUAL_PEAKS_TABLE = DERIVED_PEAKS_TABLE
+
+# stations per DLY_FLOWS query while materializing the daily flows
+STATION_CHUNK_SIZE = 200
+
+
+def missing_indexes(conn):
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    return [(name, sql) for name, sql in INDEXES if name not in existing]
+
+
+def build_indexes(db_path):
+    """
+    Create the INDEXES that db_path does not have yet, in place.  Only run
+    this on a file no server has open (e.g. before it is renamed into the
+    database directory); see index_installed_db for an installed file.
+    :return: number of indexes created
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        todo = missing_indexes(conn)
+        for name, sql in todo:
+            time0 = time.time()
+            conn.execute(sql)
+            print('Built index {} in {:.1f} s'.format(name, time.time() - time0))
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+    return len(todo)
+
+
+def index_installed_db(db_path):
+    """
+    Add the missing indexes to an installed database by indexing a copy
+    and renaming it over the original.  Open (immutable) connections keep
+    reading the old file, which is never modified; new connections get
+    the same data with the indexes.
+    """
+    conn = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+    try:
+        todo = missing_indexes(conn)
+    finally:
+        conn.close()
+    if not todo:
+        print('{} is already indexed.'.format(os.path.basename(db_path)))
+        return 0
+    # not named *.sqlite3, so find_newest_db_file never picks it up
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    tmp = os.path.join(os.path.dirname(db_path), '.{}.partial'.format(name))
+    shutil.copyfile(db_path, tmp)
+    try:
+        n = build_indexes(tmp)
+    except Exception:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, db_path)
+    return n
+
+
+def materialize_derived_tables(db_path, version=None, path=None):
+    """
+    Build the sidecar database for a HYDAT file: DAILY_FLOWS with one row
+    per station and day (DATE as YYYY-MM-DD, FLOW, SYMBOL), reshaped with
+    reshape_dly_flows, and ANNUAL_PEAKS, a copy of ANNUAL_INSTANT_PEAKS.
+    Both are WITHOUT ROWID tables keyed on station number first.
+    It is written to a temporary file and renamed into place when done.
+    :return: path of the sidecar database
+    """
+    if version is None:
+        version = get_db_version(db_path)
+    if path is None:
+        path = derived_db_path(version)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # one temporary file per process, so concurrent runs never share one
+    tmp = path + '.tmp{}'.format(os.getpid())
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    src = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+    out = sqlite3.connect(tmp)
+    try:
+        out.execute('PRAGMA journal_mode=OFF')
+        out.execute('PRAGMA synchronous=OFF')
+        out.execute("CREATE TABLE {} (STATION_NUMBER TEXT, DATE TEXT, FLOW REAL, SYMBOL TEXT, "
+                    "PRIMARY KEY (STATION_NUMBER, DATE)) WITHOUT ROWID".format(DAILY_FLOWS_TABLE))
+        stations = [r[0] for r in src.execute(
+            "SELECT DISTINCT STATION_NUMBER FROM DLY_FLOWS ORDER BY STATION_NUMBER")]
+        n_days = 0
+        for station, rows in iter_dly_flows_rows(src, stations, STATION_CHUNK_SIZE):
+            dates, flows, flags = reshape_dly_flows(rows)
+            out.executemany("INSERT INTO {} VALUES (?, ?, ?, ?)".format(DAILY_FLOWS_TABLE),
+                            zip([station] * len(dates), np.datetime_as_string(dates).tolist(),
+                                flows.tolist(), flags.tolist()))
+            n_days += len(dates)
+
+        columns = [r[1] for r in src.execute("PRAGMA table_info(ANNUAL_INSTANT_PEAKS)")]
+        declared = {r[1]: r[2] for r in src.execute("PRAGMA table_info(ANNUAL_INSTANT_PEAKS)")}
+        out.execute("CREATE TABLE {} ({}, PRIMARY KEY (STATION_NUMBER, DATA_TYPE, PEAK_CODE, YEAR)) "
+                    "WITHOUT ROWID".format(ANNUAL_PEAKS_TABLE,
+                                           ', '.join('{} {}'.format(c, declared[c]) for c in columns)))
+        cur = src.execute("SELECT {} FROM ANNUAL_INSTANT_PEAKS".format(', '.join(columns)))
+        out.executemany("INSERT INTO {} ({}) VALUES ({})".format(
+            ANNUAL_PEAKS_TABLE, ', '.join(columns), ', '.join('?' * len(columns))), cur)
+        out.commit()
+        out.execute('ANALYZE')
+        out.commit()
+    except Exception:
+        out.close()
+        os.remove(tmp)
+        raise
+    finally:
+        src.close()
+        out.close()
+    os.replace(tmp, path)
+    print('Materialized {} daily flows for {} stations'.format(n_days, len(stations)))
+    return path
+
+
+def post_install(db_path, version=None, index=True):
+    """
+    Index the HYDAT file (if index, via index_installed_db), build its
+    sidecar database, daily flow archive (with the annual maxima) and
+    station hashes, printing the
+    time taken and the file sizes.
+    :return: dict of build times (s) and sizes (MB)
+    """
+    if version is None:
+        version = get_db_version(db_path)
+    report = {}
+    time0 = time.time()
+    if index:
+        index_installed_db(db_path)
+    report['index_time'] = time.time() - time0
+    report['db_size'] = os.path.getsize(db_path) / 1e6
+
+    time0 = time.time()
+    path = materialize_derived_tables(db_path, version)
+    report['derived_time'] = time.time() - time0
+    report['derived_size'] = os.path.getsize(path) / 1e6
+
+    time0 = time.time()
+    conn = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+    try:
+        archive = build_daily_archive(conn, version)
+    finally:
+        conn.close()
+    build_annual_maxima(DailyArchive(archive))
+    report['archive_time'] = time.time() - time0
+    report['archive_size'] = sum(os.path.getsize(os.path.join(archive, f))
+                                 for f in os.listdir(archive)) / 1e6
+
+    time0 = time.time()
+    build_station_hashes(db_path, version)
+    report['hash_time'] = time.time() - time0
+    print('HYDAT {}: indexes {:.1f} s ({:.1f} MB database), derived tables {:.1f} s '
+          '({:.1f} MB sidecar), daily archive {:.1f} s ({:.1f} MB), station hashes {:.1f} s'.format(
+              version, report['index_time'], report['db_size'], report['derived_time'],
+              report['derived_size'], report['archive_time'], report['archive_size'],
+              report['hash_time']))
+    return report
+
+
+if __name__ == '__main__':
+    post_install(sys.argv[1] if len(sys.argv) > 1 else find_newest_db_file())
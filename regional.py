@@ -0,0 +1,130 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from ffa import DESIGN_RETURN_PERIODS
+from frequency_factors import z_from_Tr
+from lmoments import sample_lmoments, quantiles_from_lmoments
+from get_station_data import get_annual_inst_peaks, get_hydat_version, get_stations_by_distance
+from hydat_diff import station_data_version
+from stations import STATION_CATALOGUE
+
+REGIONAL_DISTRIBUTIONS = ('gev', 'glo', 'pe3')
+
+# stations with fewer annual peaks are left out of the pooled growth curve
+MIN_YEARS = 10
+
+SUMMARY_COLUMNS = ['N_YEARS', 'DRAINAGE_AREA', 'L1', 'L2', 'LCV', 'T3', 'T4',
+                   'UNIT_INDEX_FLOOD']
+
+# per-station summaries by (data version, station number), where the data
+# version is the oldest HYDAT release with the station's current rows
+# (see hydat_diff.py); a region only summarizes the stations that are not
+# in here yet, so a new release only recomputes the stations it changed
+STATION_SUMMARIES = {}
+_SUMMARY_LOCK = threading.Lock()
+
+
+def summarize_station(station):
+    """
+    Record length, drainage area and sample L-moments of the annual
+    peaks of one station.  The index flood is the mean annual peak (L1);
+    divided by the gross drainage area it gives the unit index flood
+    (m3/s/km2) used to transfer the index flood between stations.
+    :return: dict of SUMMARY_COLUMNS
+    """
+    peaks = get_annual_inst_peaks(station)['PEAK'].dropna().values.astype(float)
+    peaks = peaks[peaks > 0]
+    area = STATION_CATALOGUE.IDS_AND_DAS.get(station, np.nan)
+    row = dict.fromkeys(SUMMARY_COLUMNS, np.nan)
+    row['N_YEARS'] = len(peaks)
+    row['DRAINAGE_AREA'] = area
+    if len(peaks) >= 4:
+        l1, l2, t3, t4 = sample_lmoments(peaks)
+        row.update({'L1': l1, 'L2': l2, 'LCV': l2 / l1, 'T3': t3, 'T4': t4,
+                    'UNIT_INDEX_FLOOD': l1 / area if area and area > 0 else np.nan})
+    return row
+
+
+def station_summaries(stations, version=None):
+    """
+    Summaries of the given stations, computing only those not already
+    cached for their data in this HYDAT version.
+    :return: DataFrame of SUMMARY_COLUMNS indexed by station number
+    """
+    if version is None:
+        version = get_hydat_version()
+    keys = [(station_data_version(s, version), s) for s in stations]
+    with _SUMMARY_LOCK:
+        missing = [key for key in keys if key not in STATION_SUMMARIES]
+    if missing:
+        new = {key: summarize_station(key[1]) for key in missing}
+        with _SUMMARY_LOCK:
+            STATION_SUMMARIES.update(new)
+        print('Summarized {} new stations ({} cached)'.format(
+            len(missing), len(stations) - len(missing)))
+    rows = [STATION_SUMMARIES[key] for key in keys]
+    return pd.DataFrame(rows, index=pd.Index(list(stations), name='STATION_NUMBER'),
+                        columns=SUMMARY_COLUMNS)
+
+
+def pooled_lmoment_ratios(summaries, min_years=MIN_YEARS):
+    """
+    Record-length weighted regional L-CV, L-skewness and L-kurtosis
+    over the usable stations of a region (Hosking & Wallis, 1997).
+    :return: (t, t3, t4, boolean mask of the stations used)
+    """
+    used = (summaries['N_YEARS'] >= min_years) & np.isfinite(summaries['LCV'])
+    w = summaries.loc[used, 'N_YEARS'].values.astype(float)
+    if w.sum() == 0:
+        return np.nan, np.nan, np.nan, used
+    t, t3, t4 = (np.average(summaries.loc[used, col].values, weights=w)
+                 for col in ('LCV', 'T3', 'T4'))
+    return t, t3, t4, used
+
+
+def regional_ffa(lat, lon, radius, target_station=None, target_area=None,
+                 return_periods=DESIGN_RETURN_PERIODS, distribution='gev',
+                 min_years=MIN_YEARS, version=None):
+    """
+    Index flood analysis over the stations within radius (km) of a point.
+    The growth curve is fitted by L-moments to the pooled L-moment ratios
+    (with L1 = 1).  The index flood is the target station's own mean annual
+    peak if it has at least min_years of record, otherwise the target
+    drainage area times the weighted mean unit index flood of the region.
+    :param return_periods: return periods (years) of the growth curve
+    :return: dict with the regional stations (summaries and distance),
+        the pooled ratios, the growth factors, index flood and quantiles
+    """
+    if distribution not in REGIONAL_DISTRIBUTIONS:
+        raise ValueError('distribution must be one of {}'.format(REGIONAL_DISTRIBUTIONS))
+    neighbours = get_stations_by_distance(lat, lon, radius)
+    summaries = station_summaries(neighbours['Station Number'].tolist(), version)
+    summaries['DISTANCE'] = neighbours['distance_to_target'].values
+
+    t, t3, t4, used = pooled_lmoment_ratios(summaries, min_years)
+    summaries['USED'] = used
+    z = z_from_Tr(np.asarray(return_periods, dtype=float))
+    growth = quantiles_from_lmoments(1., t, t3, z, distribution)
+
+    index_flood = np.nan
+    if target_station is not None and target_station in summaries.index and \
+            summaries.loc[target_station, 'N_YEARS'] >= min_years:
+        index_flood = summaries.loc[target_station, 'L1']
+    else:
+        if target_area is None and target_station is not None:
+            target_area = STATION_CATALOGUE.IDS_AND_DAS.get(target_station)
+        unit = summaries.loc[used & np.isfinite(summaries['UNIT_INDEX_FLOOD'])]
+        if target_area and len(unit):
+            index_flood = target_area * np.average(unit['UNIT_INDEX_FLOOD'],
+                                                   weights=unit['N_YEARS'])
+
+    return {'stations': summaries,
+            'n_stations': int(used.sum()),
+            'station_years': int(summaries.loc[used, 'N_YEARS'].sum()),
+            'lcv': t, 't3': t3, 't4': t4,
+            'Tr': np.asarray(return_periods),
+            'growth': growth,
+            'index_flood': index_flood,
+            'quantiles': index_flood * growth}
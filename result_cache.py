@@ -0,0 +1,119 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with an optional time-to-live and an optional
+    on-disk store (one pickle per key) that survives server restarts and
+    can be shared by several server processes.
+    Keys must be hashable and have a stable repr, e.g. tuples of str/int.
+    """
+
+    def __init__(self, max_entries=256, ttl=None, disk_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.disk_dir, digest + '.pkl')
+
+    def _expired(self, stored_at, now):
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def _get_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            if self._expired(os.path.getmtime(path), time.time()):
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                stored_key, value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        return value if stored_key == key else None
+
+    def _put_disk(self, key, value):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        path = self._disk_path(key)
+        tmp_path = path + '.tmp{}.{}'.format(os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _store(self, key, value):
+        # caller holds the lock
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], time.monotonic()):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+        if self.disk_dir is not None:
+            value = self._get_disk(key)
+            if value is not None:
+                with self._lock:
+                    self._store(key, value)
+                    self.disk_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+        if self.disk_dir is not None:
+            self._put_disk(key, value)
+
+    def get_or_compute(self, key, func):
+        """
+        Return the cached value for key, or call func() and cache its result.
+        Concurrent misses on the same key may both compute; the last put wins.
+        """
+        value = self.get(key)
+        if value is None:
+            value = func()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            n = self.hits + self.disk_hits + self.misses
+            return {'entries': len(self._entries),
+                    'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': (self.hits + self.disk_hits) / n if n else 0.}
+
+
+# Shared by all sessions of a bokeh server process: the app script is
+# re-run for every session, but imported modules are executed only once.
+# Pass disk_dir (e.g. os.path.join(CACHE_DIR, 'results')) to persist results.
+SIMULATION_CACHE = ResultCache(max_entries=256, ttl=24 * 3600)
@@ -0,0 +1,265 @@
+from multiprocessing import Pool
+
+import numpy as np
+
+from frequency_factors import tr_grid, z_grid, lp3_frequency_factor
+from lmoments import lmoment_quantiles
+from streaming_stats import RunningMoments, accumulate
+
+# return periods (years) at which the simulated distributions are evaluated,
+# and their standard normal quantiles (NaN for Tr <= 1)
+TR_GRID = tr_grid(-2, 3, 500)
+Z_GRID = z_grid(-2, 3, 500)
+
+# distribution/estimation method of each fit: LP3 by product moments of
+# log10 flows (the original method), or LP3, GEV or GLO by L-moments
+ESTIMATORS = ('lp3', 'lp3_lmoments', 'gev_lmoments', 'glo_lmoments')
+
+# how the simulated samples are drawn: subsamples of the record without
+# replacement (the original method), non-parametric bootstrap (with
+# replacement) or parametric bootstrap from the full record fit
+RESAMPLING_METHODS = ('subsample', 'bootstrap', 'parametric')
+
+# number of simulations handled by one task in the chunked/parallel mode.
+# Chunks (not workers) own an RNG stream, so results do not depend
+# on the number of processes.
+CHUNK_SIZE = 1000
+
+
+def get_rng(seed=None):
+    """
+    Return a numpy Generator.  Passing an existing Generator
+    returns it unchanged so callers can thread one stream
+    through several steps.
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def sample_indices(n_records, sample_size, n_simulations, rng=None):
+    """
+    Draw n_simulations subsamples of size sample_size without
+    replacement from range(n_records) in a single call.
+    :return: integer array of shape (n_simulations, sample_size)
+    """
+    if sample_size > n_records:
+        raise ValueError('Sample size ({}) exceeds the record length ({}).'.format(
+            sample_size, n_records))
+    rng = get_rng(rng)
+    keys = rng.random((n_simulations, n_records))
+    # the first sample_size positions of a random ordering of each row
+    # are a uniform draw without replacement; order within the sample
+    # is irrelevant for the moments so a partition is sufficient
+    if sample_size == n_records:
+        return np.argsort(keys, axis=1)
+    return np.argpartition(keys, sample_size - 1, axis=1)[:, :sample_size]
+
+
+def moments_from_power_sums(n, s1, s2, s3, shift=0.):
+    """
+    Mean, standard deviation and skew from the power sums s1, s2, s3 of
+    n values less shift (a value near their mean, so the sums keep their
+    precision).  These are the moments of the LP3 fit: they match np.mean,
+    np.std (ddof=0) and st.skew (bias=True), with a skew of 0 for a
+    constant sample.  Every log-moment calculation goes through here.
+    :return: three arrays shaped like the sums
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = s1 / n
+        m2 = np.maximum(s2 / n - mean**2, 0.)
+        m3 = s3 / n - 3 * mean * s2 / n + 2 * mean**3
+        skew = np.where(m2 > 0, m3 / m2**1.5, 0.)
+    return mean + shift, np.sqrt(m2), skew
+
+
+def log_moments(samples):
+    """
+    Row-wise mean, standard deviation and skew of log10(samples)
+    (see moments_from_power_sums).
+    :param samples: array of shape (M, N) of positive flows
+    :return: three arrays of shape (M,)
+    """
+    logs = np.log10(samples)
+    shift = logs.mean(axis=-1)
+    dev = logs - shift[..., np.newaxis]
+    return moments_from_power_sums(logs.shape[-1], dev.sum(axis=-1), np.sum(dev**2, axis=-1),
+                                   np.sum(dev**3, axis=-1), shift)
+
+
+def lp3_quantiles(z, mean, stdev, skew):
+    """
+    Log-Pearson III flow quantiles for each set of log-moments.
+    :return: array of shape (M, T) (or (T,) for scalar moments)
+    """
+    k = lp3_frequency_factor(z, skew)
+    mean = np.asarray(mean, dtype=float)[..., np.newaxis]
+    stdev = np.asarray(stdev, dtype=float)[..., np.newaxis]
+    return np.power(10, mean + k * stdev)
+
+
+def estimate_quantiles(samples, z, estimator='lp3'):
+    """
+    Fit each row of samples with one of ESTIMATORS and evaluate
+    the fits on the z grid.
+    :param samples: array of shape (M, N) of positive flows (or (N,))
+    :return: array of flow quantiles of shape (M, T) (or (T,))
+    """
+    if estimator == 'lp3':
+        mean, stdev, skew = log_moments(samples)
+        return lp3_quantiles(z, mean, stdev, skew)
+    if estimator not in ESTIMATORS:
+        raise ValueError('estimator must be one of {}'.format(ESTIMATORS))
+    return lmoment_quantiles(samples, z, estimator.split('_')[0])
+
+
+def draw_samples(peaks, sample_size, n_simulations, rng=None, resampling='subsample',
+                 estimator='lp3'):
+    """
+    Draw n_simulations samples of sample_size years from the record.
+    Parametric samples are drawn by inverse transform from the fit of
+    the full record with the same estimator.
+    :param resampling: one of RESAMPLING_METHODS
+    :return: array of shape (n_simulations, sample_size)
+    """
+    rng = get_rng(rng)
+    if resampling == 'subsample':
+        return peaks[sample_indices(len(peaks), sample_size, n_simulations, rng)]
+    if resampling == 'bootstrap':
+        return peaks[rng.integers(0, len(peaks), size=(n_simulations, sample_size))]
+    if resampling == 'parametric':
+        z = rng.standard_normal(n_simulations * sample_size)
+        return estimate_quantiles(peaks, z, estimator).reshape(n_simulations, sample_size)
+    raise ValueError('resampling must be one of {}'.format(RESAMPLING_METHODS))
+
+
+def simulate_lp3(peaks, sample_size, n_simulations, z=None, seed=None, estimator='lp3',
+                 resampling='subsample'):
+    """
+    Batch version of the sampling simulation: fit LP3 by moments (or
+    another of ESTIMATORS) to n_simulations random subsamples (without
+    replacement, or bootstrap samples) of the annual peak series and
+    evaluate each fit on the z grid.
+    :param peaks: 1d array of annual peak flows
+    :param sample_size: number of years drawn for each simulation
+    :param n_simulations: number of subsamples (M)
+    :param z: standard normal quantiles to evaluate (default Z_GRID)
+    :param seed: int, None or np.random.Generator
+    :param estimator: one of ESTIMATORS
+    :param resampling: one of RESAMPLING_METHODS
+    :return: array of flow quantiles of shape (M, len(z))
+    """
+    peaks = np.asarray(peaks, dtype=float)
+    if z is None:
+        z = Z_GRID
+    samples = draw_samples(peaks, sample_size, n_simulations, seed, resampling, estimator)
+    return estimate_quantiles(samples, z, estimator)
+
+
+def chunk_seeds(seed, n_simulations, chunk_size=CHUNK_SIZE):
+    """
+    Split n_simulations into chunks of at most chunk_size and spawn
+    an independent SeedSequence for each chunk from the master seed.
+    :return: list of (chunk length, SeedSequence) tuples
+    """
+    master = seed if isinstance(seed, np.random.SeedSequence) \
+        else np.random.SeedSequence(seed)
+    n_chunks = max(1, -(-n_simulations // chunk_size))
+    sizes = [chunk_size] * (n_chunks - 1)
+    sizes.append(n_simulations - chunk_size * (n_chunks - 1))
+    return list(zip(sizes, master.spawn(n_chunks)))
+
+
+def _simulate_chunk(args):
+    # top-level so it can be pickled for the process pool
+    peaks, sample_size, z, n, seed_seq, estimator, resampling = args
+    return simulate_lp3(peaks, sample_size, n, z=z, seed=np.random.default_rng(seed_seq),
+                        estimator=estimator, resampling=resampling)
+
+
+def iter_lp3_chunks(peaks, sample_size, n_simulations, z=None, seed=None,
+                    processes=None, chunk_size=CHUNK_SIZE, pool=None, estimator='lp3',
+                    resampling='subsample'):
+    """
+    Generate the simulated LP3 quantiles chunk by chunk, in chunk order.
+    Each chunk draws from its own stream spawned from the master seed,
+    so for a given seed and chunk_size the stream is identical for any
+    number of processes (processes=1 runs the chunks serially in this
+    process).  Only the chunks in flight are held in memory.
+    :param processes: number of worker processes (None = cpu count)
+    :param pool: an existing multiprocessing Pool to reuse
+    :param estimator: one of ESTIMATORS
+    :param resampling: one of RESAMPLING_METHODS
+    :return: generator of arrays of shape (<= chunk_size, len(z))
+    """
+    peaks = np.asarray(peaks, dtype=float)
+    if z is None:
+        z = Z_GRID
+    tasks = [(peaks, sample_size, z, n, s, estimator, resampling)
+             for n, s in chunk_seeds(seed, n_simulations, chunk_size)]
+
+    # imap preserves task order, so any merge downstream is deterministic
+    if pool is not None:
+        yield from pool.imap(_simulate_chunk, tasks)
+    elif processes == 1 or len(tasks) == 1:
+        for t in tasks:
+            yield _simulate_chunk(t)
+    else:
+        with Pool(processes) as p:
+            yield from p.imap(_simulate_chunk, tasks)
+
+
+def simulate_lp3_parallel(peaks, sample_size, n_simulations, z=None, seed=None,
+                          processes=None, chunk_size=CHUNK_SIZE, pool=None, estimator='lp3',
+                          resampling='subsample'):
+    """
+    Chunked/parallel version of simulate_lp3 (see iter_lp3_chunks).
+    :return: array of flow quantiles of shape (M, len(z))
+    """
+    return np.concatenate(list(iter_lp3_chunks(
+        peaks, sample_size, n_simulations, z=z, seed=seed,
+        processes=processes, chunk_size=chunk_size, pool=pool,
+        estimator=estimator, resampling=resampling)), axis=0)
+
+
+def simulate_lp3_streaming(peaks, sample_size, n_simulations, z=None, seed=None,
+                           processes=None, chunk_size=CHUNK_SIZE, pool=None,
+                           accumulators=None, callback=None, estimator='lp3',
+                           resampling='subsample'):
+    """
+    Run the simulation without keeping the (M, T) matrix: each chunk is
+    fed to the accumulators (RunningMoments by default) and dropped,
+    so memory depends on chunk_size, not n_simulations.
+    :param accumulators: list of objects with an update(batch) method
+    :param callback: called with the accumulators after each chunk, e.g.
+        to report partial results; returning True stops the run early
+    :return: the list of accumulators
+    """
+    if z is None:
+        z = Z_GRID
+    if accumulators is None:
+        accumulators = [RunningMoments(len(z))]
+    chunks = iter_lp3_chunks(peaks, sample_size, n_simulations, z=z, seed=seed,
+                             processes=processes, chunk_size=chunk_size, pool=pool,
+                             estimator=estimator, resampling=resampling)
+    if callback is None:
+        accumulate(chunks, *accumulators)
+        return accumulators
+
+    for chunk in chunks:
+        accumulate([chunk], *accumulators)
+        if callback(accumulators):
+            # closing the generator also shuts down its process pool
+            chunks.close()
+            break
+    return accumulators
+
+
+def summarize(quantiles):
+    """
+    Mean and sample standard deviation (ddof=1, as DataFrame.std)
+    across simulations for each return period.
+    :param quantiles: array of shape (M, T)
+    :return: two arrays of shape (T,)
+    """
+    return np.mean(quantiles, axis=0), np.std(quantiles, axis=0, ddof=1)
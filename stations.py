@@ -9,6 +9,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import hashlib
+import pickle
+import threading
 
 import pandas as pd
 import numpy as np
@@ -63,28 +66,118 @@ def convert_coords(data):
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, 'data/')
+CACHE_DIR = os.path.join(BASE_DIR, 'cache/')
 
-stations_df = pd.read_csv(DATA_DIR + 'WSC_Stations_Master.csv')
+STATIONS_CSV = os.path.join(DATA_DIR, 'WSC_Stations_Master.csv')
 
-print(stations_df.columns.values)
 
-# stations_df.dropna(axis=0, subset=['Gross Drainage Area (km2)'], inplace=True)
+def build_catalogue(csv_path):
+    """
+    Parse the WSC station list and derive the lookup tables used by the app.
+    :return: dict of the catalogue tables
+    """
+    stations_df = pd.read_csv(csv_path)
+
+    # stations_df.dropna(axis=0, subset=['Gross Drainage Area (km2)'], inplace=True)
+
+    stations_df['record_length'] = stations_df['Year To'] - \
+        stations_df['Year From']
+
+    ids = stations_df['Station Number'].tolist()
+    names = stations_df['Station Name'].tolist()
 
-STATIONS_DF = stations_df.copy()  # convert_coords(stations_df)
+    # da_subset = stations_df[['Station Number', 'Gross Drainage Area (km2)']]
+    stations = list(zip(ids, names))
+    coords = list(zip(ids, stations_df['Latitude'].tolist(), stations_df['Longitude'].tolist()))
+    drainage_areas = list(zip(ids, stations_df['Gross Drainage Area (km2)'].tolist()))
 
-STATIONS_DF['record_length'] = STATIONS_DF['Year To'] - \
-    STATIONS_DF['Year From']
+    return {
+        'STATIONS_DF': stations_df,  # convert_coords(stations_df)
+        'STATIONS': stations,
+        'COORDS': coords,
+        'DRAINAGE_AREAS': drainage_areas,
+        'STATION_NAMES': names,
+        'IDS_TO_NAMES': {k: '{}: {}'.format(k, v) for (k, v) in stations},
+        'NAMES_TO_IDS': {v: k for (k, v) in stations},
+        'IDS_AND_DAS': dict(drainage_areas),
+        'IDS_AND_COORDS': {k: (lat, lon) for (k, lat, lon) in coords},
+    }
 
-STATIONS = [tuple(x)
-            for x in STATIONS_DF[['Station Number', 'Station Name']].values]
-COORDS = [tuple(x)
-          for x in STATIONS_DF[['Station Number', 'Latitude', 'Longitude']].values]
 
-# da_subset = stations_df[['Station Number', 'Gross Drainage Area (km2)']]
-DRAINAGE_AREAS = [tuple(x) for x in STATIONS_DF[[
-    'Station Number', 'Gross Drainage Area (km2)']].values]
+CATALOGUE_TABLES = ('STATIONS_DF', 'STATIONS', 'COORDS', 'DRAINAGE_AREAS', 'STATION_NAMES',
+                    'IDS_TO_NAMES', 'NAMES_TO_IDS', 'IDS_AND_DAS', 'IDS_AND_COORDS')
+
+
+class StationCatalogue:
+    """
+    Lazily loaded station catalogue.  Each table is pickled to its own
+    file under CACHE_DIR/stations/ and only unpickled when first used,
+    so e.g. the app's name lookups never pay for STATIONS_DF.  The
+    snapshot records a hash of the CSV and is rebuilt whenever the CSV
+    contents change.  Tables are available as attributes,
+    e.g. STATION_CATALOGUE.IDS_TO_NAMES.
+    """
 
-IDS_TO_NAMES = {k: '{}: {}'.format(k, v) for (k, v) in STATIONS}
-NAMES_TO_IDS = {v: k for (k, v) in STATIONS}
-IDS_AND_DAS = {k: v for (k, v) in DRAINAGE_AREAS}
-IDS_AND_COORDS = {k: (lat, lon) for (k, lat, lon) in COORDS}
+    def __init__(self, csv_path=STATIONS_CSV, cache_dir=CACHE_DIR):
+        self.csv_path = csv_path
+        self.snapshot_dir = os.path.join(cache_dir, 'stations')
+        self._tables = {}
+        self._checked = False
+        self._lock = threading.RLock()
+
+    def _csv_hash(self):
+        with open(self.csv_path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _table_path(self, name):
+        return os.path.join(self.snapshot_dir, name + '.pkl')
+
+    def _check_snapshot(self):
+        """
+        Rebuild the snapshot if it is missing or was built from another CSV.
+        """
+        csv_hash = self._csv_hash()
+        manifest = os.path.join(self.snapshot_dir, 'csv_hash')
+        try:
+            with open(manifest) as f:
+                if f.read().strip() == csv_hash:
+                    return
+        except OSError:
+            pass
+
+        tables = build_catalogue(self.csv_path)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        for name, table in tables.items():
+            tmp_path = self._table_path(name) + '.tmp{}'.format(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._table_path(name))
+        # written last, so an interrupted build is redone next time
+        with open(manifest + '.tmp{}'.format(os.getpid()), 'w') as f:
+            f.write(csv_hash)
+        os.replace(manifest + '.tmp{}'.format(os.getpid()), manifest)
+        self._tables = tables
+
+    def __getattr__(self, name):
+        if name not in CATALOGUE_TABLES:
+            raise AttributeError(name)
+        with self._lock:
+            if not self._checked:
+                self._check_snapshot()
+                self._checked = True
+            if name not in self._tables:
+                with open(self._table_path(name), 'rb') as f:
+                    self._tables[name] = pickle.load(f)
+            return self._tables[name]
+
+
+STATION_CATALOGUE = StationCatalogue()
+
+
+def __getattr__(name):
+    # module level STATIONS_DF, IDS_TO_NAMES, NAMES_TO_IDS, IDS_AND_DAS,
+    # IDS_AND_COORDS etc. are served from the lazily loaded catalogue
+    try:
+        return getattr(STATION_CATALOGUE, name)
+    except AttributeError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
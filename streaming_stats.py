@@ -0,0 +1,162 @@
+import numpy as np
+
+
+class RunningMoments:
+    """
+    Online mean and variance for each column of a stream of
+    (k, T) batches, e.g. k simulated LP3 curves evaluated at T return
+    periods.  Batches are merged with the pairwise form of Welford's
+    update (Chan et al.), so only the current batch is held in memory
+    and the result does not depend on how the stream was chunked
+    (up to floating point round-off).
+    """
+
+    def __init__(self, n_columns):
+        self.n = 0
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)
+
+    def update(self, batch):
+        batch = np.atleast_2d(np.asarray(batch, dtype=float))
+        n_b = batch.shape[0]
+        if n_b == 0:
+            return self
+        mean_b = batch.mean(axis=0)
+        m2_b = np.sum((batch - mean_b)**2, axis=0)
+
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * n_b / n
+        self.m2 = self.m2 + m2_b + delta**2 * self.n * n_b / n
+        self.n = n
+        return self
+
+    def merge(self, other):
+        """
+        Combine with another RunningMoments over the same columns.
+        """
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta**2 * self.n * other.n / n
+        self.n = n
+        return self
+
+    def variance(self, ddof=1):
+        if self.n - ddof <= 0:
+            return np.full_like(self.mean, np.nan)
+        return self.m2 / (self.n - ddof)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.variance(ddof))
+
+    def sigma_bands(self, k=(1, 2)):
+        """
+        mean +/- k standard deviations (ddof=1), keyed with the
+        column names used by the distribution data source.
+        """
+        stdev = self.std()
+        bands = {'mean': self.mean}
+        for i in k:
+            bands['lower_{}_sigma'.format(i)] = self.mean - i * stdev
+            bands['upper_{}_sigma'.format(i)] = self.mean + i * stdev
+        return bands
+
+
+def accumulate(batches, *accumulators):
+    """
+    Feed each batch of a stream to every accumulator in turn.
+    The batches are discarded once consumed.
+    """
+    for batch in batches:
+        for acc in accumulators:
+            acc.update(batch)
+    return accumulators
+
+
+# percentiles reported by QuantileSketch.percentile_bands; 16/84 and
+# 2.5/97.5 are the empirical counterparts of the 1 and 2 sigma bands
+PERCENTILES = (2.5, 16, 50, 84, 97.5)
+
+
+def percentile_label(p):
+    return 'pct_{}'.format('{:g}'.format(p).replace('.', '_'))
+
+
+class QuantileSketch:
+    """
+    Bounded-memory quantile sketch for each column of a stream of
+    (k, T) batches.  A simplified KLL/MRL compactor hierarchy: level i
+    holds values of weight 2**i, and whenever a level holds `capacity`
+    rows it is sorted per column and every other row (random offset)
+    is promoted to the next level.  Every column sees the same number
+    of values, so all T sketches are compacted together with array
+    operations.  Memory is O(capacity * log2(n / capacity)) per column;
+    results are exact while fewer than `capacity` values have been seen.
+    """
+
+    def __init__(self, n_columns, capacity=512, seed=None):
+        self.n_columns = n_columns
+        self.capacity = capacity
+        self.n = 0
+        self.levels = [np.empty((0, n_columns))]
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, batch):
+        batch = np.atleast_2d(np.asarray(batch, dtype=float))
+        self.n += batch.shape[0]
+        self.levels[0] = np.concatenate([self.levels[0], batch], axis=0)
+        self._compress()
+        return self
+
+    def _compress(self):
+        i = 0
+        while i < len(self.levels):
+            level = self.levels[i]
+            if len(level) >= self.capacity:
+                level = np.sort(level, axis=0)
+                n_pairs = len(level) // 2
+                offset = self.rng.integers(2)
+                promoted = level[offset:2 * n_pairs:2]
+                # an odd row out stays at this level
+                self.levels[i] = level[2 * n_pairs:]
+                if i + 1 == len(self.levels):
+                    self.levels.append(np.empty((0, self.n_columns)))
+                self.levels[i + 1] = np.concatenate(
+                    [self.levels[i + 1], promoted], axis=0)
+            i += 1
+
+    def quantiles(self, probs):
+        """
+        :param probs: non-exceedance probabilities in [0, 1]
+        :return: array of shape (len(probs), T)
+        """
+        probs = np.atleast_1d(probs)
+        values = np.concatenate(self.levels, axis=0)
+        if len(values) == 0:
+            return np.full((len(probs), self.n_columns), np.nan)
+        weights = np.concatenate([np.full(len(level), 2.**i)
+                                  for i, level in enumerate(self.levels)])
+        order = np.argsort(values, axis=0)
+        sorted_values = np.take_along_axis(values, order, axis=0)
+        cum_weights = np.cumsum(weights[order], axis=0)
+        total = cum_weights[-1]
+
+        out = np.empty((len(probs), self.n_columns))
+        for j, p in enumerate(probs):
+            # first sorted value whose cumulative weight reaches p
+            idx = np.argmax(cum_weights >= p * total, axis=0)
+            out[j] = np.take_along_axis(sorted_values, idx[np.newaxis], axis=0)[0]
+        # the LP3 curve is undefined for some return periods (Tr < 1)
+        out[:, np.isnan(values).any(axis=0)] = np.nan
+        return out
+
+    def percentile_bands(self, percentiles=PERCENTILES):
+        """
+        Percentiles of the simulated flows at each return period,
+        keyed with percentile_label (e.g. 'pct_2_5', 'pct_50').
+        """
+        q = self.quantiles(np.asarray(percentiles) / 100.)
+        return {percentile_label(p): q[j] for j, p in enumerate(percentiles)}
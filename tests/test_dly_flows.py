@@ -0,0 +1,86 @@
+# The vectorized DLY_FLOWS reshape against the previous melt-based
+# implementation (benchmarks/bench_dly_flows.py), on synthetic rows in an
+# in-memory database.
+#
+#   python -m pytest tests/test_dly_flows.py
+import os
+import sys
+import sqlite3
+import unittest
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, 'benchmarks'))
+
+from get_station_data import DLY_FLOW_COLUMNS, reshape_dly_flows, \
+    select_dly_flows_by_station_ID
+from bench_dly_flows import select_dly_flows_melt
+
+STATION = '08MH016'
+
+HEADER_COLUMNS = ['STATION_NUMBER', 'YEAR', 'MONTH', 'FULL_MONTH', 'NO_DAYS', 'MONTHLY_MEAN',
+                  'MONTHLY_TOTAL', 'FIRST_DAY_MIN', 'MIN', 'FIRST_DAY_MAX', 'MAX']
+DAY_COLUMNS = [c for i in range(1, 32) for c in ('FLOW{}'.format(i), 'FLOW_SYMBOL{}'.format(i))]
+
+
+def synthetic_dly_flows(station, months, seed=0):
+    """
+    DLY_FLOWS rows for (year, month) pairs, in the given order: random
+    flows with some missing days and flags, and None past NO_DAYS.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for year, month in months:
+        no_days = pd.Period(year=year, month=month, freq='M').days_in_month
+        days = []
+        for day in range(1, 32):
+            flow, symbol = None, None
+            if day <= no_days and rng.random() > 0.1:
+                flow = float(np.round(rng.lognormal(2, 1), 3))
+                symbol = rng.choice(['B', 'E', 'A']) if rng.random() < 0.2 else None
+            days += [flow, symbol]
+        rows.append([station, year, month, 1, no_days, None, None, None, None, None, None]
+                    + days)
+    return rows
+
+
+class ReshapeDlyFlowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE DLY_FLOWS ({})'.format(
+            ', '.join(HEADER_COLUMNS + DAY_COLUMNS)))
+        # out of order, across a leap February and a year boundary
+        months = [(2000, 3), (1999, 12), (2000, 2), (2000, 1), (1999, 11), (2001, 2)]
+        self.conn.executemany('INSERT INTO DLY_FLOWS VALUES ({})'.format(
+            ', '.join('?' * (len(HEADER_COLUMNS) + len(DAY_COLUMNS)))),
+            synthetic_dly_flows(STATION, months))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_matches_melt(self):
+        result = select_dly_flows_by_station_ID(self.conn, STATION)
+        expected = select_dly_flows_melt(self.conn, STATION)
+        pd.testing.assert_frame_equal(result, expected, check_index_type=False)
+
+    def test_dates_are_chronological_and_within_no_days(self):
+        # a stray value past NO_DAYS is not a day of the record
+        self.conn.execute("UPDATE DLY_FLOWS SET FLOW31=1.0 WHERE YEAR=2001 AND MONTH=2")
+        rows = self.conn.execute('SELECT {} FROM DLY_FLOWS'.format(
+            ', '.join(DLY_FLOW_COLUMNS))).fetchall()
+        dates, flows, flags = reshape_dly_flows(rows)
+        self.assertTrue(np.all(np.diff(dates.astype(np.int64)) > 0))
+        self.assertFalse(np.isnan(flows).any())
+        self.assertEqual(len(dates), len(flags))
+        self.assertLess(dates.max(), np.datetime64('2001-03-01'))
+
+    def test_unknown_station(self):
+        self.assertIsNone(select_dly_flows_by_station_ID(self.conn, '00XX000'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# download_file against a local HTTP server: a transfer that is cut short
+# keeps the bytes it received and resumes with a Range request, and a
+# checksum mismatch discards the part file.
+#
+#   python -m pytest tests/test_download.py
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import download
+
+PAYLOAD = os.urandom(3 * 65536 + 123)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves PAYLOAD at any path, honouring 'Range: bytes=<start>-'.  The
+    first full (non-range) response advertises the whole file but closes
+    after half of it, like a dropped transfer.
+    """
+    requests_seen = []
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        self.requests_seen.append(range_header)
+        if range_header:
+            start = int(range_header.split('=', 1)[1].rstrip('-'))
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(PAYLOAD)))
+                self.end_headers()
+                return
+            body = PAYLOAD[start:]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(PAYLOAD) - 1, len(PAYLOAD)))
+        else:
+            body = PAYLOAD[:len(PAYLOAD) // 2]
+            self.send_response(200)
+        # the short 200 response still advertises the full length
+        self.send_header('Content-Length', str(len(body) if range_header else len(PAYLOAD)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadFileTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:{}/Hydat_sqlite3_20240117.zip'.format(
+            cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        RangeHandler.requests_seen = []
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp_dir, 'hydat.zip')
+        # no back-off between attempts
+        patcher = mock.patch('download.time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resumes_short_transfer(self):
+        download.download_file(self.url, self.dest,
+                               sha256=hashlib.sha256(PAYLOAD).hexdigest())
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        self.assertEqual(RangeHandler.requests_seen,
+                         [None, 'bytes={}-'.format(len(PAYLOAD) // 2)])
+
+    def test_resumes_existing_part_file(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(PAYLOAD[:1000])
+        download.download_file(self.url, self.dest)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertEqual(RangeHandler.requests_seen, ['bytes=1000-'])
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(IOError) as cm:
+            download.download_file(self.url, self.dest, sha256='0' * 64)
+        self.assertIn('Checksum mismatch', str(cm.exception))
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# The batch simulation engine against the original per-simulation loop,
+# and the shared log-moment helper against np.std and st.skew.
+#
+#   python -m pytest tests/test_simulation.py
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+import scipy.stats as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulation import Z_GRID, log_moments, sample_indices, simulate_lp3
+from design_flood_index import grouped_log_moments
+from nonstationarity import window_log_moments
+
+RNG = np.random.default_rng(42)
+
+
+def reference_moments(peaks):
+    logs = np.log10(peaks)
+    return np.mean(logs), np.std(logs), st.skew(logs)
+
+
+def loop_simulation(peaks, samples, z):
+    """
+    The original per-simulation loop of the app (one pandas sample, st.skew
+    and the Wilson-Hilferty frequency factor per simulation), run on the
+    given rows of sample indices instead of DataFrame.sample.
+    """
+    data = pd.DataFrame({'PEAK': peaks})
+    model = np.empty((len(samples), len(z)))
+    for i, idx in enumerate(samples):
+        selection = data.iloc[idx]
+        log_skew = st.skew(np.log10(selection['PEAK']))
+        lp3 = 2 / log_skew * \
+            (np.power((z - log_skew / 6) * log_skew / 6 + 1, 3) - 1)
+        model[i] = np.power(10, np.mean(
+            np.log10(selection['PEAK'])) + lp3 * np.std(np.log10(selection['PEAK'])))
+    return model
+
+
+class BatchEngineTest(unittest.TestCase):
+
+    def test_matches_per_simulation_loop(self):
+        peaks = RNG.lognormal(5, 0.5, size=40)
+        n_simulations, sample_size, seed = 200, 15, 1234
+        z = Z_GRID[np.isfinite(Z_GRID)]
+        batch = simulate_lp3(peaks, sample_size, n_simulations, z=z, seed=seed)
+        # simulate_lp3 draws its subsamples with sample_indices from the seed
+        samples = sample_indices(len(peaks), sample_size, n_simulations,
+                                 np.random.default_rng(seed))
+        self.assertTrue(np.allclose(batch, loop_simulation(peaks, samples, z)))
+
+    def test_seed_is_reproducible(self):
+        peaks = RNG.lognormal(5, 0.5, size=30)
+        np.testing.assert_array_equal(simulate_lp3(peaks, 10, 50, seed=7),
+                                      simulate_lp3(peaks, 10, 50, seed=7))
+
+
+class FakePeaksCache:
+    # the arrays and row_stations of a PeaksCache, for grouped_log_moments
+
+    def __init__(self, stations, counts, peaks):
+        self.stations = np.array(stations)
+        self.arrays = {'PEAK': peaks, 'DATA_TYPE': np.full(len(peaks), 'Q'),
+                       'PEAK_CODE': np.full(len(peaks), 'H')}
+        self.codes = np.repeat(np.arange(len(stations)), counts)
+
+    def row_stations(self, data_type='Q', peak_code='H'):
+        return self.stations, self.codes, np.ones(len(self.codes), dtype=bool)
+
+
+class LogMomentsTest(unittest.TestCase):
+
+    def test_log_moments_match_scipy(self):
+        samples = RNG.lognormal(4, 0.6, size=(20, 15))
+        mean, stdev, skew = log_moments(samples)
+        for i, row in enumerate(samples):
+            np.testing.assert_allclose((mean[i], stdev[i], skew[i]), reference_moments(row),
+                                       rtol=1e-10, atol=1e-12)
+
+    def test_constant_sample_has_zero_skew(self):
+        mean, stdev, skew = log_moments(np.full((1, 5), 10.))
+        np.testing.assert_allclose((mean[0], stdev[0], skew[0]), (1., 0., 0.), atol=1e-12)
+
+    def test_grouped_log_moments(self):
+        counts = [12, 30, 7]
+        peaks = RNG.lognormal(3, 0.5, size=sum(counts))
+        df = grouped_log_moments(FakePeaksCache(['A', 'B', 'C'], counts, peaks))
+        bounds = np.cumsum([0] + counts)
+        for i, station in enumerate(['A', 'B', 'C']):
+            expected = reference_moments(peaks[bounds[i]:bounds[i + 1]])
+            row = df.loc[station]
+            np.testing.assert_allclose((row['LOG_MEAN'], row['LOG_STD'], row['LOG_SKEW']),
+                                       expected, rtol=1e-10, atol=1e-12)
+
+    def test_window_log_moments(self):
+        years = np.arange(1950, 1990)
+        peaks = RNG.lognormal(5, 0.4, size=len(years))
+        n, mean, stdev, skew = window_log_moments(np.zeros(len(years), dtype=int), years,
+                                                  peaks, window=10)
+        # st.skew is NaN for a single value (the helper gives 0)
+        for i in range(1, len(years)):
+            window = peaks[max(0, i - 9):i + 1]
+            self.assertEqual(n[i], len(window))
+            np.testing.assert_allclose((mean[i], stdev[i], skew[i]), reference_moments(window),
+                                       rtol=1e-8, atol=1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()